@@ -1,228 +1,363 @@
-# import PySimpleGUI as sg  # Qt works on MacOS better
-import PySimpleGUIQt as sg  # Qt works on MacOS better
+# CRDIR_GUI_32.py
+# Image browser for the Cosmic Ray Damage Image Repair (CRDIR) project
+#
+# Usage:  python CRDIR_GUI_32.py [image directory]
+#
+# Importing this module only defines main() and the settings: the Qt application, the window and the scan of the
+# image directory are made when main() runs, and Qt / PySimpleGUIQt are only imported then.
+
 import sys
 import os
 
-from PyQt5 import QtWidgets
+import numpy as np
 
+import crdir_display as display
 import crdir_funcs_v2 as cf
+import crdir_noise
+from crdir_diskcache import disk_cache
+from crdir_jobs import JobCancelled, JobRunner
+from crdir_prefetch import Prefetcher, neighbor_indices
+from crdir_progressive import ProgressiveRenderer
 
-STDEV = 75  # Assumed constant standard deviation of pixels in image
+STDEV = 75  # Assumed constant standard deviation of pixels in image (used if the camera has no noise model)
 Z_LIMIT = 3 # Z-score flagged as bad pixel
+RENDER_POLL_MS = 100  # While a full render is running, check for it this often
+DEFAULT_PRESET = 'default'  # rawpy postprocess preset of the color images (see cf.POSTPROCESS_PRESETS)
+PREFETCH_RADIUS = 1  # Frames on either side of the current one rendered in the background, in the current view
+
+VIEW_BUTTONS = ('Color Image', 'Bayer Images 4up', 'Zscore Images 4up', 'Zscore > Limit 4up', 'Repaired Image')
 
-verbose = True
-
-# Read the display resolution using QtGui
-app = QtWidgets.QApplication(sys.argv)
-mainScreenPix = QtWidgets.QDesktopWidget().screenGeometry(0)  # Rect: (x,y, width,height)
-
-if verbose:
-    print("Screen Resolution : " + str(mainScreenPix.height()) + " x " + str(mainScreenPix.width()))
-    print("mainScreenPix.width() = {}".format(mainScreenPix.width()))
-    print("=============================================\n")
-
-MAX_WINDOW_WIDTH = int(mainScreenPix.width() * (3/4) )
-MAX_WINDOW_HEIGHT = int(MAX_WINDOW_WIDTH/(5/3))  # 16/9
-
-# Determine whose computer we're on:
-if os.path.exists('/Users/pelz'):  # You are on Jeff's computer
-    USER = 'Jeff'
-    userPath = '/Users/pelz'
-    crdirDirPath = 'Documents/CRDIR/to process images'  # 'Documents/CRDIR'
-
-elif os.path.exists('/Users/peterablacksberg'):  # You are on Peter's computer:
-    USER = 'PeterABlacksberg'
-    userPath = '/Users/peterablacksberg'
-    crdirDirPath = 'Documents/CRDIR/to process images'
-
-else:
-    USER = "Unknown"
-    userPath = '/Users'
-    crdirDirPath = ''
-
-# Set basePath based on which computer we're on
-basePath = "{}/{}".format(userPath, crdirDirPath)
-
-if verbose:
-    print("user = {}   basePath = {}".format(USER, basePath))
-    print("=============================================\n")
-
-# Set up the SimpleGUI (sg)
-sg.ChangeLookAndFeel('Reddit')
-refDirectoryPath = basePath
-imgExtensionType = '.nef' # '.jpg'
-
-# Select a directory and read in the IMAGE files from that directory
-img_files, img_fileNames = cf.get_img_files(refDirectoryPath, imgExtensionType)
-
-if verbose:
-    print("img_fileNames = {}".format(img_fileNames))
-
-# ####  Image browser ####
-# create the imageBrowser that returns keyboard events
-imageBrowser = sg.FlexForm('Image Browser', return_keyboard_events=True, location=(0,0), use_default_focus=False )
-
-# Check to be sure there are images to read
-try:  # Try to read in the first image:
-    displayImage = cf.postprocessed_from_raw(refDirectoryPath, img_fileNames[0], verbose=verbose)  # extract the RGB image
-    imgData, imgResizeLabel = cf.prep_img_for_display(displayImage,
-                                                      maxDisplayWidth=MAX_WINDOW_WIDTH,
-                                                      maxDisplayHeight=MAX_WINDOW_HEIGHT,
-                                                      verbose=verbose)  # Convert to GUI window format
-
-except IndexError:  # If no images of the correct type could be found:
-    print('\n > > > > > > > > No "{}" images found in directory "{}". Quitting.\n'.format(imgExtensionType, refDirectoryPath))
-    exit(0)
-
-# Initialize image_elem to the first file in the list
-image_elem = sg.Image(data=imgData)  # Image display element; will be updated later with other images
-
-filename_display_elem = sg.Text(img_files[0],   size=(80, 1), font=("Helvetica", 18))
-resize_display_elem   = sg.Text(imgResizeLabel, size=(80, 1), font=("Helvetica", 18))
-file_num_display_elem = sg.Text('File 1 of {}'.format(len(img_files)), size=(10,1), font=("Helvetica", 18))
-
-ref_dir_elem = [[sg.Text('Choose a directory containing the REFERENCE images: ', font=("Helvetica", 18))],
-                [sg.InputText(basePath, key='_REF_DIR_', size=(50, 0.75), font=("Helvetica", 12)),
-                 sg.FolderBrowse(initial_folder=basePath, font=("Helvetica", 16))]
-                ]
-
-file_listbox_elem = sg.Listbox(values=img_fileNames, size=(40,20), font=("Helvetica", 16), key='listbox')
-
-# define layout, show and read the imageBrowser
-# Define the buttons:
-rightColumn = [[filename_display_elem], [resize_display_elem],
-               [sg.ReadFormButton('Prev', size=(6,1), font=("Helvetica", 20)),
-                sg.ReadFormButton('Next', size=(6,1), font=("Helvetica", 20)), file_num_display_elem,
-                sg.ReadFormButton('Color Image', size=(14,1), font=("Helvetica", 20)),
-                sg.ReadFormButton('Bayer Images 4up', size=(18, 1), font=("Helvetica", 20)),
-                sg.ReadFormButton('Zscore Images 4up', size=(19, 1), font=("Helvetica", 20)),
-                sg.ReadFormButton('Zscore > Limit 4up', size=(19, 1), font=("Helvetica", 20)),
-                sg.ReadFormButton('QUIT', size=(10, 1.25), font=("Helvetica", 24))],
-                [image_elem]
-               ]
-
-topRow = [[sg.Text('Choose a directory containing the REFERENCE images: ', font=("Helvetica", 18))],
-          [sg.InputText(basePath, key='_REF_DIR_', size=(50, 0.75), font=("Helvetica", 12)),
-           sg.FolderBrowse(initial_folder=basePath, font=("Helvetica", 16))],
-          [sg.ReadFormButton('Change Directory', font=("Helvetica", 18))]
-          ]
-
-leftColumn = [[file_listbox_elem],
-              [sg.ReadFormButton('Read selected image', font=("Helvetica", 18))]
+##############################################################################################################
+def default_image_dir():
+    # Directory browsed when none is given: the images folder on whose computer we're on
+    if os.path.exists('/Users/pelz'):  # You are on Jeff's computer
+        USER = 'Jeff'
+        userPath = '/Users/pelz'
+        crdirDirPath = 'Documents/CRDIR/to process images'  # 'Documents/CRDIR'
+
+    elif os.path.exists('/Users/peterablacksberg'):  # You are on Peter's computer:
+        USER = 'PeterABlacksberg'
+        userPath = '/Users/peterablacksberg'
+        crdirDirPath = 'Documents/CRDIR/to process images'
+
+    else:
+        USER = "Unknown"
+        userPath = '/Users'
+        crdirDirPath = ''
+
+    print("user = {}".format(USER))
+
+    # Set basePath based on which computer we're on
+    return "{}/{}".format(userPath, crdirDirPath)
+
+##############################################################################################################
+def main(argv=None):
+    # Run the image browser (on the directory given as argv[1], if any)
+    argv = sys.argv if argv is None else argv
+
+    # import PySimpleGUI as sg  # Qt works on MacOS better
+    import PySimpleGUIQt as sg  # Qt works on MacOS better
+    from PyQt5 import QtWidgets
+
+    TIMEOUT_KEY = getattr(sg, 'TIMEOUT_KEY', '__TIMEOUT__')  # Event returned by Read(timeout) when nothing happened
+
+    verbose = True
+
+    # Read the display resolution using QtGui
+    app = QtWidgets.QApplication(argv)
+    mainScreenPix = QtWidgets.QDesktopWidget().screenGeometry(0)  # Rect: (x,y, width,height)
+
+    if verbose:
+        print("Screen Resolution : " + str(mainScreenPix.height()) + " x " + str(mainScreenPix.width()))
+        print("mainScreenPix.width() = {}".format(mainScreenPix.width()))
+        print("=============================================\n")
+
+    MAX_WINDOW_WIDTH = int(mainScreenPix.width() * (3/4) )
+    MAX_WINDOW_HEIGHT = int(MAX_WINDOW_WIDTH/(5/3))  # 16/9
+
+    basePath = default_image_dir() if len(argv) < 2 else argv[1]
+
+    if verbose:
+        print("basePath = {}".format(basePath))
+        print("=============================================\n")
+
+    # Set up the SimpleGUI (sg)
+    sg.ChangeLookAndFeel('Reddit')
+    refDirectoryPath = basePath
+    imgExtensionType = '.nef' # '.jpg'
+
+    # Select a directory and read in the IMAGE files from that directory
+    img_files, img_fileNames = cf.get_img_files(refDirectoryPath, imgExtensionType)
+
+    if verbose:
+        print("img_fileNames = {}".format(img_fileNames))
+
+    # ####  Image browser ####
+    # create the imageBrowser that returns keyboard events
+    imageBrowser = sg.FlexForm('Image Browser', return_keyboard_events=True, location=(0,0), use_default_focus=False )
+
+    # Color images are shown progressively: the embedded preview at once, the full render when it is ready
+    progressive = ProgressiveRenderer(verbose=verbose)
+
+    # Check to be sure there are images to read
+    try:  # Try to read in the first image:
+        displayImage, previewSource = progressive.request(refDirectoryPath, img_fileNames[0],
+                                                          preset=DEFAULT_PRESET)  # preview of the RGB image
+        imgData, imgResizeLabel = display.prep_img_for_display(displayImage,
+                                                               maxDisplayWidth=MAX_WINDOW_WIDTH,
+                                                               maxDisplayHeight=MAX_WINDOW_HEIGHT,
+                                                               verbose=verbose)  # Convert to GUI window format
+        imgResizeLabel = '{}   [{} preview; rendering ...]'.format(imgResizeLabel, previewSource)
+
+    except IndexError:  # If no images of the correct type could be found:
+        print('\n > > > > > > > > No "{}" images found in directory "{}". Quitting.\n'.format(imgExtensionType,
+                                                                                         refDirectoryPath))
+        return 0
+
+    # Initialize image_elem to the first file in the list
+    image_elem = sg.Image(data=imgData)  # Image display element; will be updated later with other images
+
+    filename_display_elem = sg.Text(img_files[0],   size=(80, 1), font=("Helvetica", 18))
+    resize_display_elem   = sg.Text(imgResizeLabel, size=(80, 1), font=("Helvetica", 18))
+    file_num_display_elem = sg.Text('File 1 of {}'.format(len(img_files)), size=(10,1), font=("Helvetica", 18))
+
+    ref_dir_elem = [[sg.Text('Choose a directory containing the REFERENCE images: ', font=("Helvetica", 18))],
+                    [sg.InputText(basePath, key='_REF_DIR_', size=(50, 0.75), font=("Helvetica", 12)),
+                     sg.FolderBrowse(initial_folder=basePath, font=("Helvetica", 16))]
+                    ]
+
+    file_listbox_elem = sg.Listbox(values=img_fileNames, size=(40,20), font=("Helvetica", 16), key='listbox')
+
+    # define layout, show and read the imageBrowser
+    # Define the buttons:
+    rightColumn = [[filename_display_elem], [resize_display_elem],
+                   [sg.ReadFormButton('Prev', size=(6,1), font=("Helvetica", 20)),
+                    sg.ReadFormButton('Next', size=(6,1), font=("Helvetica", 20)), file_num_display_elem,
+                    sg.ReadFormButton('Color Image', size=(14,1), font=("Helvetica", 20)),
+                    sg.ReadFormButton('Bayer Images 4up', size=(18, 1), font=("Helvetica", 20)),
+                    sg.ReadFormButton('Zscore Images 4up', size=(19, 1), font=("Helvetica", 20)),
+                    sg.ReadFormButton('Zscore > Limit 4up', size=(19, 1), font=("Helvetica", 20)),
+                    sg.ReadFormButton('Repaired Image', size=(16, 1), font=("Helvetica", 20)),
+                    sg.ReadFormButton('QUIT', size=(10, 1.25), font=("Helvetica", 24))],
+                   [sg.Text('Render preset:', font=("Helvetica", 16)),
+                    sg.InputCombo(list(cf.POSTPROCESS_PRESETS), default_value=DEFAULT_PRESET, key='_PRESET_',
+                                  size=(12, 1), font=("Helvetica", 16)),
+                    sg.Text('postprocess parameters:', font=("Helvetica", 16)),
+                    sg.InputText('', key='_POSTPROCESS_', size=(40, 1), font=("Helvetica", 14))],  # e.g. bright=1.5
+                    [image_elem]
+                   ]
+
+    topRow = [[sg.Text('Choose a directory containing the REFERENCE images: ', font=("Helvetica", 18))],
+              [sg.InputText(basePath, key='_REF_DIR_', size=(50, 0.75), font=("Helvetica", 12)),
+               sg.FolderBrowse(initial_folder=basePath, font=("Helvetica", 16))],
+              [sg.ReadFormButton('Change Directory', font=("Helvetica", 18))]
               ]
 
-layout = [[sg.Column(topRow)], [sg.Column(leftColumn), sg.Column(rightColumn)]]
-
-button, values = imageBrowser.Layout(layout).Read()          # Shows imageBrowser on screen
-
-i=0
-keepGoing = True
-filename = img_fileNames[0]  # initialize to first file
-
-while keepGoing:
-    if verbose: print('top')
-
-    # Check for GUI buttons
-    if button is None:
-        if verbose: print("None\n")
-        break  # do nothing; keep going
-
-    elif button in ('Change Directory'):
-        print("new reference folder chosen: {}".format(values['_REF_DIR_']))
-        refDirectoryPath = values['_REF_DIR_']
-        img_files, img_fileNames = cf.get_img_files(refDirectoryPath, '.jpg')
-
-    elif button in ('Next', 'MouseWheel:Down', 'Down:40', 'Next:34'):  # and i < len(img_files)-1:
-        print('down')
-        i += 1
-        if i > len(img_files) - 1:  # roll over to start of list
-            i = 0
-
-        filename = img_fileNames[i]  # update filename
-
-    elif button in ('Prev', 'MouseWheel:Up', 'Up:38', 'Prior:33'):  # and i > 0:
-        print('up')
-        i -= 1
-        if i < 0:  # roll over to end of list
-            i = len(img_files) - 1
-
-        filename = img_fileNames[i]  # update filename
-
-    elif button in ('Color Image'):  # display the color image
-        if verbose:
-            print("Color Image")
-
-        displayImage = cf.postprocessed_from_raw(refDirectoryPath, filename, verbose=verbose)  # extract the RGB image
-        imgData, imgResizeLabel = cf.prep_img_for_display(displayImage,
-                                                          maxDisplayWidth=MAX_WINDOW_WIDTH,
-                                                          maxDisplayHeight=MAX_WINDOW_HEIGHT,
-                                                          verbose=verbose)  # Convert to GUI window format
-        image_elem.Update(data=imgData)  # update window with new image
-
-    elif button in ('Bayer Images 4up'):  # display the Bayer array images
-        if verbose:
-            print("Bayer Images 4up")
-
-        displayImage = cf.bayer4up_from_raw(refDirectoryPath, filename, verbose=verbose)  # extract the Bayer array images
-        imgData, imgResizeLabel = cf.prep_img_for_display(displayImage,
-                                                          maxDisplayWidth=MAX_WINDOW_WIDTH,
-                                                          maxDisplayHeight=MAX_WINDOW_HEIGHT,
-                                                          verbose=verbose)  # Convert to GUI window format
-
-        image_elem.Update(data=imgData)  # update window with new image
-
-    elif button in ('Zscore Images 4up'):  # display the Z-score image array
-        if verbose:
-            print("Zscore Images 4up")
-
-        displayImage = cf.zScore4up_from_raw(refDirectoryPath, filename, stDev=STDEV, verbose=verbose)  # extract the Z-score images
-        imgData, imgResizeLabel = cf.prep_img_for_display(displayImage,
-                                                          maxDisplayWidth=MAX_WINDOW_WIDTH,
-                                                          maxDisplayHeight=MAX_WINDOW_HEIGHT,
-                                                          verbose=verbose)  # Convert to GUI window format
-
-        image_elem.Update(data=imgData)  # update window with new image
-
-    elif button in ('Zscore > Limit 4up'):  # display the Z-score exceeds limit image array
-        if verbose:
-            print("Zscore > Limit 4up")
-
-        displayImage = cf.ZscoreExceedsZlimit4up_from_raw(refDirectoryPath, filename,
-                         stDev=STDEV, zLimit=Z_LIMIT, verbose=verbose)  # Extract where the z-score exceeds a limit
-        imgData, imgResizeLabel = cf.prep_img_for_display(displayImage,
-                                                          maxDisplayWidth=MAX_WINDOW_WIDTH,
-                                                          maxDisplayHeight=MAX_WINDOW_HEIGHT,
-                                                          verbose=verbose)  # Convert to GUI window format
-
-        image_elem.Update(data=imgData)  # update window with new image
-
-    elif button in ('QUIT'):  # display the color image
-        if verbose: print("Quit\n")
-        sys.exit()
-
-    elif button == 'Read selected image':
-        try:
-            filename = refDirectoryPath + '/' + values['listbox'][0]
-            i = img_fileNames.index(values['listbox'][0])  # Locate the selected filename in the list of fileNames
-            if verbose: print("filename = {}".format(filename))
-
-        except IndexError:  # Throws an error if nothing is selected
-            print('caught exception: IndexError - no image was selected ...')
-            filename = img_files[0]
-            i = 0  # Set to first element in listbox
-
-        if verbose:
-            print("Read selected image ({})  i set to {}.".format(filename, i))
-
-    filename_display_elem.Update(filename)  # update window with filename
-    resize_display_elem.Update(imgResizeLabel)  # update window with resize information
-    file_num_display_elem.Update('File {} of {}'.format(i+1, len(img_files)))  # update page display
-
-    file_listbox_elem.Update(values=img_fileNames, set_to_index=i)
-
-    # read the imageBrowser
-    button, values = imageBrowser.Read()
-
+    leftColumn = [[file_listbox_elem],
+                  [sg.ReadFormButton('Read selected image', font=("Helvetica", 18))]
+                  ]
+
+    layout = [[sg.Column(topRow)], [sg.Column(leftColumn), sg.Column(rightColumn)]]
 
-# Exit elegantly. (Without this, the Python object keeps running)
-sys.exit()
+    button, values = imageBrowser.Layout(layout).Read(timeout=RENDER_POLL_MS)  # Shows imageBrowser on screen
+
+
+    def render_settings(values):
+        # Postprocess preset and free-form parameters chosen in the window
+        renderParams = cf.parse_postprocess_params(values.get('_POSTPROCESS_'))
+        renderParams['preset'] = values.get('_PRESET_') or DEFAULT_PRESET
+        return renderParams
+
+
+    def render_view(imgDir, imgFname, view, preset, postprocessText):
+        # Display data (imgData, imgResizeLabel) of one view of a frame; run by the prefetch threads, or here on a miss.
+        # Kept in the on-disk result cache too, so a directory viewed before opens without decoding anything.
+        renderParams = cf.parse_postprocess_params(postprocessText)
+        stDev = crdir_noise.noise_model_for(os.path.join(imgDir, imgFname), default=STDEV)  # calibrated sigma, if any
+
+        cacheKey = view_cache_key(imgDir, imgFname, view, preset, postprocessText)
+        cached = resultCache.get(cacheKey)
+        if cached is not None:
+            return cached['imgData'].tobytes(), str(cached['imgResizeLabel'])
+
+        if view == 'Color Image':
+            displayImage = cf.postprocessed_from_raw(imgDir, imgFname, preset=preset, **renderParams)
+        elif view == 'Bayer Images 4up':
+            displayImage = cf.bayer4up_from_raw(imgDir, imgFname)
+        elif view == 'Zscore Images 4up':
+            displayImage = cf.zScore4up_from_raw(imgDir, imgFname, stDev=stDev)
+        elif view == 'Zscore > Limit 4up':
+            displayImage = cf.ZscoreExceedsZlimit4up_from_raw(imgDir, imgFname, stDev=stDev, zLimit=Z_LIMIT)
+        else:  # 'Repaired Image'
+            displayImage = cf.repaired_from_raw(imgDir, imgFname, stDev=stDev, zLimit=Z_LIMIT, preset=preset,
+                                                **renderParams)
+
+        imgData, imgResizeLabel = display.prep_img_for_display(displayImage, maxDisplayWidth=MAX_WINDOW_WIDTH,
+                                                               maxDisplayHeight=MAX_WINDOW_HEIGHT)  # GUI format
+        resultCache.put(cacheKey, {'imgData': np.frombuffer(imgData, dtype=np.uint8),
+                                   'imgResizeLabel': np.array(imgResizeLabel)})
+        return imgData, imgResizeLabel
+
+
+    # Rendered views are kept on disk (see crdir_diskcache), keyed by file content and every render setting
+    resultCache = disk_cache()
+
+
+    def view_cache_key(imgDir, imgFname, view, preset, postprocessText):
+        # Result cache key of a rendered view
+        imgPath = os.path.join(imgDir, imgFname)
+        return resultCache.key(imgPath, 'view', view=view, preset=preset,
+                               renderParams=sorted(cf.parse_postprocess_params(postprocessText).items()),
+                               stDev=crdir_noise.noise_model_for(imgPath, default=STDEV), zLimit=Z_LIMIT,
+                               maxDisplay=(MAX_WINDOW_WIDTH, MAX_WINDOW_HEIGHT))
+
+    # Views of the frames next to the current one are rendered in the background, so a page turn is a cache hit
+    prefetcher = Prefetcher(render_view, verbose=verbose)
+
+    # Views that are not ready are computed by a job, so the window stays responsive; only the latest one finishes
+    jobs = JobRunner(verbose=verbose)
+
+
+    def view_key(imgFname, view):
+        # Prefetcher key of a view of a frame, with the render settings chosen in the window
+        return (refDirectoryPath, imgFname, view, values.get('_PRESET_') or DEFAULT_PRESET,
+                values.get('_POSTPROCESS_') or '')
+
+
+    def show_view(imgFname):
+        # Show the current view of a frame: at once if it has been prefetched (or is in the result cache), else a
+        # preview (color image) or a 'computing' label until its job is done; then prefetch the same view of its
+        # neighbors.
+        # Returns (resize label, awaitingRender, viewJob)
+        jobs.cancel_all(tag='view')  # Whatever was being computed for the previous selection is stale now
+        awaitingRender, viewJob = False, None
+
+        key = view_key(imgFname, viewMode)
+        if key in prefetcher or view_cache_key(*key) in resultCache:  # Rendered already, in this session or before
+            imgData, imgResizeLabel = prefetcher.get(key)
+            image_elem.Update(data=imgData)  # update window with new image
+        elif viewMode == 'Color Image':
+            imgResizeLabel, awaitingRender = show_color_image(imgFname), True  # preview now, full render when ready
+        else:
+            viewJob = jobs.submit(prefetcher.get, view_key(imgFname, viewMode), tag='view')
+            imgResizeLabel = 'Computing {} of {} ...'.format(viewMode, os.path.basename(imgFname))
+
+        prefetcher.prefetch(view_key(img_fileNames[j], viewMode) for j in neighbor_indices(i, len(img_fileNames),
+                                                                                          PREFETCH_RADIUS))
+        return imgResizeLabel, awaitingRender, viewJob
+
+
+    def show_color_image(imgFname):
+        # Show the quick preview of a frame and start its full render with the chosen preset (swapped in by the event
+        # loop when ready); returns the resize label
+        displayImage, previewSource = progressive.request(refDirectoryPath, imgFname, **render_settings(values))
+        imgData, imgResizeLabel = display.prep_img_for_display(displayImage,
+                                                               maxDisplayWidth=MAX_WINDOW_WIDTH,
+                                                               maxDisplayHeight=MAX_WINDOW_HEIGHT,
+                                                               verbose=verbose)  # Convert to GUI window format
+        image_elem.Update(data=imgData)  # update window with the preview
+        return '{}   [{} preview; rendering ...]'.format(imgResizeLabel, previewSource)
+
+
+    i=0
+    keepGoing = True
+    filename = img_fileNames[0]  # initialize to first file
+    awaitingRender = True  # Is the color image on display a preview whose full render is on its way?
+    viewJob = None  # ID of the job computing the view to be shown, if any
+    viewMode = 'Color Image'  # View shown when moving to another frame
+
+    while keepGoing:
+        if verbose: print('top')
+
+        # Check for GUI buttons
+        if button is None:
+            if verbose: print("None\n")
+            break  # do nothing; keep going
+
+        elif button == TIMEOUT_KEY:  # Nothing happened: show the full render or the computed view if it is ready
+            if awaitingRender and progressive.poll() is not None:  # Full render done: make its display data
+                awaitingRender = False
+                viewJob = jobs.submit(prefetcher.get, view_key(filename, 'Color Image'), tag='view')  # memoized render
+            awaitingRender = awaitingRender and progressive.busy()
+
+            if viewJob is None or not jobs.done(viewJob):
+                button, values = imageBrowser.Read(timeout=RENDER_POLL_MS) if awaitingRender or viewJob is not None \
+                    else imageBrowser.Read()
+                continue
+
+            try:
+                imgData, imgResizeLabel = jobs.result(viewJob)
+                image_elem.Update(data=imgData)  # update window with the computed view
+            except (JobCancelled, KeyError):  # Superseded (and dropped) meanwhile
+                pass
+            except Exception as error:  # Keep browsing; say what went wrong
+                imgResizeLabel = 'Computing the view failed: {}'.format(error)
+            jobs.forget(viewJob)
+            viewJob = None
+
+        elif button in ('Change Directory'):
+            print("new reference folder chosen: {}".format(values['_REF_DIR_']))
+            refDirectoryPath = values['_REF_DIR_']
+            prefetcher.clear()
+            img_files, img_fileNames = cf.get_img_files(refDirectoryPath, '.jpg')
+
+        elif button in ('Next', 'MouseWheel:Down', 'Down:40', 'Next:34'):  # and i < len(img_files)-1:
+            print('down')
+            i += 1
+            if i > len(img_files) - 1:  # roll over to start of list
+                i = 0
+
+            filename = img_fileNames[i]  # update filename
+            imgResizeLabel, awaitingRender, viewJob = show_view(filename)
+
+        elif button in ('Prev', 'MouseWheel:Up', 'Up:38', 'Prior:33'):  # and i > 0:
+            print('up')
+            i -= 1
+            if i < 0:  # roll over to end of list
+                i = len(img_files) - 1
+
+            filename = img_fileNames[i]  # update filename
+            imgResizeLabel, awaitingRender, viewJob = show_view(filename)
+
+        elif button in VIEW_BUTTONS:  # display the color image, Bayer array images, Z-score images, ... of the frame
+            if verbose:
+                print(button)
+
+            viewMode = button
+            imgResizeLabel, awaitingRender, viewJob = show_view(filename)
+
+        elif button in ('QUIT'):  # display the color image
+            if verbose: print("Quit\n")
+            sys.exit()
+
+        elif button == 'Read selected image':
+            try:
+                filename = refDirectoryPath + '/' + values['listbox'][0]
+                i = img_fileNames.index(values['listbox'][0])  # Locate the selected filename in the list of fileNames
+                if verbose: print("filename = {}".format(filename))
+
+            except IndexError:  # Throws an error if nothing is selected
+                print('caught exception: IndexError - no image was selected ...')
+                filename = img_files[0]
+                i = 0  # Set to first element in listbox
+
+            if verbose:
+                print("Read selected image ({})  i set to {}.".format(filename, i))
+
+            imgResizeLabel, awaitingRender, viewJob = show_view(filename)
+
+        filename_display_elem.Update(filename)  # update window with filename
+        resize_display_elem.Update(imgResizeLabel)  # update window with resize information
+        file_num_display_elem.Update('File {} of {}'.format(i+1, len(img_files)))  # update page display
+
+        file_listbox_elem.Update(values=img_fileNames, set_to_index=i)
+
+        # read the imageBrowser (with a timeout while a full render or a view is on its way, to show it)
+        button, values = imageBrowser.Read(timeout=RENDER_POLL_MS) if awaitingRender or viewJob is not None \
+            else imageBrowser.Read()
+
+    return 0
+
+##############################################################################################################
+if __name__ == '__main__':
+    sys.exit(main())  # Exit elegantly. (Without this, the Python object keeps running)
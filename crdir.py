@@ -0,0 +1,302 @@
+# crdir.py
+# Command line entry point for the Cosmic Ray Damage Image Repair (CRDIR) project
+#
+# Usage:  python crdir.py batch <dir> [--out DIR] [--stdev 75] [--zlimit 3] [--workers N] [--chunksize 1]
+#                                     [--ext .nef] [--memory-budget-mb MB] [--noise-library DIR]
+#                                     [--defect-library DIR] [--cache DIR | --no-cache]
+#                                     [--instrument [--instrument-memory]] [--quiet]
+#         python crdir.py watch <dir> [--out DIR] [--stdev 75] [--zlimit 3] [--workers N] [--ext .nef]
+#                                     [--memory-budget-mb MB] [--noise-library DIR] [--defect-library DIR]
+#                                     [--cache DIR | --no-cache] [--settle 2] [--interval 1] [--poll]
+#                                     [--idle-exit SECONDS] [--quiet]
+#         python crdir.py ingest <dir> [--ext .nef] [--force] [--quiet]
+#         python crdir.py calibrate <dir of dark frames> [--library DIR] [--sigma-map] [--ext .nef]
+#                                     [--memory-budget-mb MB] [--quiet]
+#         python crdir.py defects <dir> [--library DIR] [--min-fraction 0.5] [--min-frames 5] [--out DIR]
+#                                     [--stdev 75] [--zlimit 3] [--workers N] [--ext .nef] [--noise-library DIR]
+#                                     [--quiet]
+#         python crdir.py temporal <dir> [--window 8] [--method welford|median] [--zlimit 5] [--stdev 75]
+#                                     [--min-frames 3] [--ext .nef] [--noise-library DIR] [--out DIR] [--quiet]
+#         python crdir.py events <hits.npz> [--radius 2] [--stdev 75] [--noise-library DIR [--img-dir DIR]]
+#                                     [--out events.npz]
+#         python crdir.py repair <batch output dir> [--format npy|tiff|npz] [--statistic median|mean] [--out DIR]
+
+import argparse
+import json
+import os
+import sys
+
+##############################################################################################################
+def batch_command(args):
+    import crdir_batch
+    import crdir_diskcache
+
+    memoryBudget = None if args.memory_budget_mb is None else int(args.memory_budget_mb * 2**20)
+    cacheDir = None if args.no_cache else (args.cache or crdir_diskcache.DEFAULT_CACHE_DIR)
+    instrumentation = 'memory' if args.instrument_memory else 'time' if args.instrument else None
+
+    runSummary = crdir_batch.run_batch(args.dir, outDir=args.out, stDev=args.stdev, zLimit=args.zlimit,
+                                       workers=args.workers, chunksize=args.chunksize, fileExtension=args.ext,
+                                       memoryBudget=memoryBudget, noiseLibrary=args.noise_library,
+                                       defectLibrary=args.defect_library, cacheDir=cacheDir,
+                                       instrumentation=instrumentation, verbose=not args.quiet)
+
+    return 1 if runSummary['failed'] else 0
+
+##############################################################################################################
+def watch_command(args):
+    import crdir_diskcache
+    import crdir_watch
+
+    memoryBudget = None if args.memory_budget_mb is None else int(args.memory_budget_mb * 2**20)
+    cacheDir = None if args.no_cache else (args.cache or crdir_diskcache.DEFAULT_CACHE_DIR)
+
+    runSummary = crdir_watch.watch(args.dir, outDir=args.out, stDev=args.stdev, zLimit=args.zlimit,
+                                   workers=args.workers, fileExtension=args.ext, memoryBudget=memoryBudget,
+                                   noiseLibrary=args.noise_library, defectLibrary=args.defect_library,
+                                   cacheDir=cacheDir, settleSeconds=args.settle, interval=args.interval,
+                                   usePolling=args.poll, idleExit=args.idle_exit, verbose=not args.quiet)
+
+    return 1 if runSummary['failed'] else 0
+
+##############################################################################################################
+def defects_command(args):
+    import crdir_batch
+    import crdir_defects
+
+    outDir = os.path.join(args.dir, 'crdir_defects') if args.out is None else args.out
+
+    crdir_batch.run_batch(args.dir, outDir=outDir, stDev=args.stdev, zLimit=args.zlimit, workers=args.workers,
+                          fileExtension=args.ext, noiseLibrary=args.noise_library, verbose=not args.quiet)
+    crdir_defects.learn_defects_from_batch(outDir, library=args.library, minFraction=args.min_fraction,
+                                           minFrames=args.min_frames, verbose=not args.quiet)
+
+    return 0
+
+##############################################################################################################
+def ingest_command(args):
+    import crdir_batch
+    import crdir_planestore
+
+    img_files, img_fileNames = crdir_batch.batch_img_files(args.dir, args.ext)
+    if not img_files:
+        print("No '{}' frames in {}".format(args.ext, args.dir))
+        return 1
+
+    nIngested = crdir_planestore.ingest(img_files, force=args.force, verbose=not args.quiet)
+
+    if not args.quiet:
+        print("{} of {} frames ingested into {}".format(nIngested, len(img_files),
+                                                       os.path.join(args.dir, crdir_planestore.PLANE_STORE_NAME)))
+
+    return 0
+
+##############################################################################################################
+def calibrate_command(args):
+    import crdir_batch
+    import crdir_noise
+
+    memoryBudget = None if args.memory_budget_mb is None else int(args.memory_budget_mb * 2**20)
+
+    img_files, img_fileNames = crdir_batch.batch_img_files(args.dir, args.ext)
+    if not img_files:
+        print("No '{}' frames in {}".format(args.ext, args.dir))
+        return 1
+
+    crdir_noise.calibrate(img_files, library=args.library, sigmaMap=args.sigma_map, memoryBudget=memoryBudget,
+                          verbose=not args.quiet)
+
+    return 0
+
+##############################################################################################################
+def temporal_command(args):
+    import crdir_batch
+    import crdir_noise
+    import crdir_temporal
+
+    img_files, img_fileNames = crdir_batch.batch_img_files(args.dir, args.ext)
+    if not img_files:
+        print("No '{}' frames in {}".format(args.ext, args.dir))
+        return 1
+
+    stDev = args.stdev
+    if args.noise_library is not None:
+        stDev = crdir_noise.noise_model_for(img_files[0], default=stDev, library=args.noise_library)
+
+    hitList = crdir_temporal.temporal_hits(img_files, window=args.window, method=args.method, zLimit=args.zlimit,
+                                           globalSigma=stDev, minFrames=args.min_frames, verbose=not args.quiet)
+
+    outDir = os.path.join(args.dir, 'crdir_temporal') if args.out is None else args.out
+    os.makedirs(outDir, exist_ok=True)
+    hitList.save(os.path.join(outDir, 'hits.npz'))
+
+    if not args.quiet:
+        print("{} temporal hits in {} frames saved to {}".format(len(hitList), len(img_files),
+                                                                 os.path.join(outDir, 'hits.npz')))
+
+    return 0
+
+##############################################################################################################
+def events_command(args):
+    import crdir_batch
+    import crdir_events
+    import crdir_hits
+
+    hitList = crdir_hits.HitList.load(args.hits)
+    imgDir = args.img_dir
+    if imgDir is None:  # The frames of a batch run, else next to the hit list
+        summaryPath = os.path.join(os.path.dirname(args.hits), 'summary.json')
+        imgDir = os.path.dirname(args.hits)
+        if os.path.exists(summaryPath):
+            with open(summaryPath) as jsonFile:
+                imgDir = json.load(jsonFile)['run']['imgDir']
+
+    events = crdir_events.find_events(hitList, radius=args.radius, globalSigma=crdir_batch.frame_sigmas(
+        imgDir, hitList, args.stdev, args.noise_library))
+
+    eventsPath = os.path.join(os.path.dirname(args.hits), 'events.npz') if args.out is None else args.out
+    events.save(eventsPath)
+
+    print("{} events saved to {}".format(len(events), eventsPath))
+
+    return 0
+
+##############################################################################################################
+def repair_command(args):
+    import crdir_repair
+
+    crdir_repair.repair_batch_output(args.dir, repairedDir=args.out, repairFormat=args.format,
+                                     statistic=args.statistic, verbose=not args.quiet)
+
+    return 0
+
+##############################################################################################################
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog='crdir', description="Cosmic Ray Damage Image Repair")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    batchParser = subparsers.add_parser('batch', help="detect hits in every raw frame of a directory")
+    batchParser.add_argument('dir', help="directory of raw (NEF) frames")
+    batchParser.add_argument('--out', default=None, help="output directory (default: <dir>/crdir_out)")
+    batchParser.add_argument('--stdev', type=float, default=75, help="assumed pixel standard deviation")
+    batchParser.add_argument('--zlimit', type=float, default=3, help="Z-score flagged as a hit")
+    batchParser.add_argument('--workers', type=int, default=None, help="worker processes (default: all cores)")
+    batchParser.add_argument('--chunksize', type=int, default=1, help="frames handed to a worker at a time")
+    batchParser.add_argument('--ext', default='.nef', help="raw file extension (either case matches)")
+    batchParser.add_argument('--memory-budget-mb', type=float, default=None,
+                             help="process planes in bands within this budget (default: whole frames)")
+    batchParser.add_argument('--noise-library', default=None,
+                             help="use calibrated noise models from this library, where there is one for the camera")
+    batchParser.add_argument('--defect-library', default=None,
+                             help="leave hits on the camera's known defects (see 'defects') out of the hit lists")
+    batchParser.add_argument('--cache', default=None,
+                             help="result cache directory (default: $CRDIR_CACHE_DIR or ~/.cache/crdir)")
+    batchParser.add_argument('--no-cache', action='store_true', help="neither read nor write the result cache")
+    batchParser.add_argument('--instrument', action='store_true',
+                             help="time every stage; writes instrument.json / .csv to the output directory")
+    batchParser.add_argument('--instrument-memory', action='store_true',
+                             help="--instrument, plus the peak memory of every stage (slower)")
+    batchParser.add_argument('--quiet', action='store_true', help="no progress report")
+    batchParser.set_defaults(func=batch_command)
+
+    watchParser = subparsers.add_parser('watch', help="detect hits in raw frames as they are written into a directory")
+    watchParser.add_argument('dir', help="directory the raw (NEF) frames are written to")
+    watchParser.add_argument('--out', default=None, help="output directory (default: <dir>/crdir_out)")
+    watchParser.add_argument('--stdev', type=float, default=75, help="assumed pixel standard deviation")
+    watchParser.add_argument('--zlimit', type=float, default=3, help="Z-score flagged as a hit")
+    watchParser.add_argument('--workers', type=int, default=None, help="worker processes (default: all cores)")
+    watchParser.add_argument('--ext', default='.nef', help="raw file extension (either case matches)")
+    watchParser.add_argument('--memory-budget-mb', type=float, default=None,
+                             help="process planes in bands within this budget (default: whole frames)")
+    watchParser.add_argument('--noise-library', default=None, help="use calibrated noise models from this library")
+    watchParser.add_argument('--defect-library', default=None, help="leave hits on known defects out of the hit lists")
+    watchParser.add_argument('--cache', default=None,
+                             help="result cache directory (default: $CRDIR_CACHE_DIR or ~/.cache/crdir)")
+    watchParser.add_argument('--no-cache', action='store_true', help="neither read nor write the result cache")
+    watchParser.add_argument('--settle', type=float, default=2,
+                             help="seconds a file must stay unchanged to count as written (when polling)")
+    watchParser.add_argument('--interval', type=float, default=1, help="seconds between directory scans")
+    watchParser.add_argument('--poll', action='store_true', help="rescan the directory instead of using inotify")
+    watchParser.add_argument('--idle-exit', type=float, default=None,
+                             help="stop after this many seconds without new frames (default: run until Ctrl-C)")
+    watchParser.add_argument('--quiet', action='store_true', help="no progress report")
+    watchParser.set_defaults(func=watch_command)
+
+    ingestParser = subparsers.add_parser('ingest', help="decode every raw frame of a directory once, into a "
+                                                        "memory-mapped store the other commands read instead "
+                                                        "(color renders, e.g. the GUI's RGB view, still decode "
+                                                        "the original file with LibRaw)")
+    ingestParser.add_argument('dir', help="directory of raw (NEF) frames")
+    ingestParser.add_argument('--ext', default='.nef', help="raw file extension (either case matches)")
+    ingestParser.add_argument('--force', action='store_true', help="re-ingest frames already in the store")
+    ingestParser.add_argument('--quiet', action='store_true', help="no progress report")
+    ingestParser.set_defaults(func=ingest_command)
+
+    calibrateParser = subparsers.add_parser('calibrate', help="build noise models from a directory of dark frames")
+    calibrateParser.add_argument('dir', help="directory of raw (NEF) dark or flat frames")
+    calibrateParser.add_argument('--library', default=None, help="noise library directory (default: ~/.crdir/noise)")
+    calibrateParser.add_argument('--sigma-map', action='store_true', help="also build per-pixel sigma maps")
+    calibrateParser.add_argument('--ext', default='.nef', help="raw file extension (either case matches)")
+    calibrateParser.add_argument('--memory-budget-mb', type=float, default=None,
+                                 help="memory budget for the per-band temporaries")
+    calibrateParser.add_argument('--quiet', action='store_true', help="no progress report")
+    calibrateParser.set_defaults(func=calibrate_command)
+
+    defectsParser = subparsers.add_parser('defects', help="learn (or extend) camera defect maps from a directory")
+    defectsParser.add_argument('dir', help="directory of raw (NEF) frames")
+    defectsParser.add_argument('--library', default=None, help="defect library directory (default: ~/.crdir/defects)")
+    defectsParser.add_argument('--min-fraction', type=float, default=0.5,
+                               help="fraction of frames a pixel must be flagged in to be a defect")
+    defectsParser.add_argument('--min-frames', type=int, default=5, help="frames needed before any defect is mapped")
+    defectsParser.add_argument('--out', default=None, help="detection output directory (default: <dir>/crdir_defects)")
+    defectsParser.add_argument('--stdev', type=float, default=75, help="assumed pixel standard deviation")
+    defectsParser.add_argument('--zlimit', type=float, default=3, help="Z-score flagged as a hit")
+    defectsParser.add_argument('--workers', type=int, default=None, help="worker processes (default: all cores)")
+    defectsParser.add_argument('--ext', default='.nef', help="raw file extension (either case matches)")
+    defectsParser.add_argument('--noise-library', default=None, help="use calibrated noise models from this library")
+    defectsParser.add_argument('--quiet', action='store_true', help="no progress report")
+    defectsParser.set_defaults(func=defects_command)
+
+    temporalParser = subparsers.add_parser('temporal', help="detect hits against the frames before them (bursts)")
+    temporalParser.add_argument('dir', help="directory of raw (NEF) frames of one scene, in file name order")
+    temporalParser.add_argument('--window', type=int, default=8, help="frames of history per pixel")
+    temporalParser.add_argument('--method', choices=('welford', 'median'), default='welford',
+                                help="running mean & variance, or rolling median & MAD")
+    temporalParser.add_argument('--zlimit', type=float, default=5, help="temporal Z-score flagged as a hit")
+    temporalParser.add_argument('--stdev', type=float, default=75, help="smallest pixel standard deviation")
+    temporalParser.add_argument('--min-frames', type=int, default=3, help="frames of history before flagging")
+    temporalParser.add_argument('--ext', default='.nef', help="raw file extension (either case matches)")
+    temporalParser.add_argument('--noise-library', default=None, help="use the camera's noise model as --stdev")
+    temporalParser.add_argument('--out', default=None, help="output directory (default: <dir>/crdir_temporal)")
+    temporalParser.add_argument('--quiet', action='store_true', help="no progress report")
+    temporalParser.set_defaults(func=temporal_command)
+
+    eventsParser = subparsers.add_parser('events', help="group the hits of a hit list into cosmic-ray events")
+    eventsParser.add_argument('hits', help="hit list (.npz) from batch or temporal")
+    eventsParser.add_argument('--radius', type=int, default=2, help="mosaic distance joining hits into one event")
+    eventsParser.add_argument('--stdev', type=float, default=75, help="pixel standard deviation (for the energy)")
+    eventsParser.add_argument('--noise-library', default=None,
+                              help="the noise models the hits were found with, where the library has one (as batch)")
+    eventsParser.add_argument('--img-dir', default=None,
+                              help="directory of the frames (default: the batch run's, or that of the hit list)")
+    eventsParser.add_argument('--out', default=None, help="output file (default: events.npz next to the hit list)")
+    eventsParser.set_defaults(func=events_command)
+
+    repairParser = subparsers.add_parser('repair', help="repair the hits found by a batch run and save the frames")
+    repairParser.add_argument('dir', help="batch output directory (with hits.npz and summary.json)")
+    repairParser.add_argument('--format', choices=('npy', 'tiff', 'npz'), default='npy',
+                              help="repaired mosaic format (tiff needs tifffile; npz is compressed)")
+    repairParser.add_argument('--statistic', choices=('median', 'mean'), default='median',
+                              help="estimate from the same-color neighbors that are not hits")
+    repairParser.add_argument('--out', default=None, help="output directory (default: <dir>/repaired)")
+    repairParser.add_argument('--quiet', action='store_true', help="no progress report")
+    repairParser.set_defaults(func=repair_command)
+
+    args = parser.parse_args(argv)
+
+    return args.func(args)
+
+##############################################################################################################
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,263 @@
+# crdir_batch.py
+# Headless multi-process batch detection for the Cosmic Ray Damage Image Repair (CRDIR) project
+#
+# Each frame is decoded (through the worker's raw frame cache), Z-scored and thresholded in a process pool;
+# per-frame hit lists (crdir_hits.HitList) go to <outDir>/<frame>.hits.npz, all of them together to
+# <outDir>/hits.npz, the hits grouped into events (crdir_events.EventList) to <outDir>/events.npz, and a summary
+# to <outDir>/summary.json / summary.csv.
+# Run it with:  python crdir.py batch <dir>  (see crdir.py)
+
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import crdir_defects
+import crdir_diskcache
+import crdir_events
+import crdir_filters as filters
+import crdir_funcs_v2 as cf
+import crdir_hits
+import crdir_instrument as instrument
+import crdir_noise
+import crdir_tiled as tiled
+from crdir_rawcache import rawCache
+
+DEFAULT_STDEV = 75   # Assumed constant standard deviation of pixels in image (as in CRDIR_GUI_32)
+DEFAULT_Z_LIMIT = 3  # Z-score flagged as bad pixel
+
+##############################################################################################################
+def batch_img_files(imgDir, fileExtension='.nef'):
+    # get_img_files for both cases of the extension (cameras write .NEF, copies are often .nef)
+
+    img_files, img_fileNames = cf.get_img_files(imgDir, fileExtension.lower())
+    if fileExtension.upper() != fileExtension.lower():
+        upper_files, upper_fileNames = cf.get_img_files(imgDir, fileExtension.upper())
+        img_files, img_fileNames = sorted(set(img_files + upper_files)), sorted(set(img_fileNames + upper_fileNames))
+
+    return img_files, img_fileNames
+
+##############################################################################################################
+def process_frame(imgPath, outDir, stDev=DEFAULT_STDEV, zLimit=DEFAULT_Z_LIMIT, memoryBudget=None,
+                  noiseLibrary=None, defectLibrary=None, cacheDir=None):
+    # Decode one frame, find where the Z-score of each Bayer plane exceeds zLimit, and save the hit lists.
+    # With a noiseLibrary (directory), the frame's calibrated crdir_noise.NoiseModel replaces stDev if there is one;
+    # with a defectLibrary, hits on the camera's known defects (crdir_defects) are counted but not saved.
+    # With a cacheDir (crdir_diskcache), the hits found are kept there under the file's content hash and the
+    # detection parameters, and a frame processed before with the same parameters is not decoded again.
+    # Runs in a pool worker; returns a summary dict for the frame (with 'error' set if it failed).
+
+    startTime = time.perf_counter()
+    frameSummary = {'file': os.path.basename(imgPath), 'error': ''}
+
+    try:
+        if noiseLibrary is not None:  # From the file header, so a cached frame needs no decode for it either
+            stDev = crdir_noise.noise_model_for(imgPath, default=stDev, library=noiseLibrary)
+        frameSummary['sigma'] = '{} ISO {}'.format(stDev.camera, stDev.iso) if hasattr(stDev, 'camera') else stDev
+
+        hitList = None
+        if cacheDir is not None:
+            diskCache = crdir_diskcache.disk_cache(cacheDir)
+            cacheKey = diskCache.key(imgPath, 'hits', stDev=stDev, zLimit=zLimit,
+                                     backend=filters.DEFAULT_NEIGHBOR_MEAN_BACKEND, mode=filters.DEFAULT_BORDER_MODE)
+            hitList, cached = diskCache.get_hit_list(cacheKey)
+            if hitList is not None:
+                height, width = (int(n) for n in cached['shape'])
+                hitList.frameNames = [frameSummary['file']]
+                frameSummary['cached'] = True
+
+        if hitList is None:
+            height, width, hitList = _find_frame_hits(imgPath, stDev, zLimit, memoryBudget, frameSummary['file'])
+            if cacheDir is not None:
+                diskCache.put_hit_list(cacheKey, hitList, shape=np.array([height, width]))
+
+        if defectLibrary is not None:
+            defectMap = crdir_defects.defect_map_for(imgPath, defectLibrary)
+            if defectMap is not None and defectMap.mask.shape[1:] == (height // 2, width // 2):
+                isDefect = defectMap.hit_is_defect(hitList)
+                frameSummary['defects'] = int(np.count_nonzero(isDefect))
+                hitList = hitList.select(~isDefect)
+
+        hitList.save(frame_hits_path(outDir, imgPath))
+
+        frameSummary.update({'width': width, 'height': height, 'megapixels': width * height / 1e6,
+                             'hits': len(hitList)})
+        frameSummary.update({'hits_' + channel: int(np.count_nonzero(hitList['channel'] == code))
+                             for channel, code in crdir_hits.CHANNEL_CODES.items()})
+
+    except Exception as err:  # One bad file must not stop the batch
+        rawCache.invalidate(imgPath)
+        frameSummary.update({'megapixels': 0.0, 'hits': 0, 'error': '{}: {}'.format(type(err).__name__, err)})
+
+    frameSummary['seconds'] = time.perf_counter() - startTime
+
+    return frameSummary
+
+def _find_frame_hits(imgPath, stDev, zLimit, memoryBudget, frameName):
+    # (height, width, HitList) of one frame, decoded through the worker's raw frame cache
+
+    with rawCache.frame(imgPath) as rawFrame:
+        frame = cf.CRDIRFrame(rawFrame.rawImage, rawFrame.products)
+        height, width = frame.image('RG1BG2').shape
+
+        if memoryBudget is None:  # Whole-frame path
+            hitList = crdir_hits.hits_from_frame(frame, stDev, zLimit, frameName=frameName)
+        else:  # Banded, bounded-memory path
+            channelHits = tiled.find_hits_tiled(rawFrame.rawImage, stDev, zLimit, memoryBudget=memoryBudget,
+                                                returnZscores=True)
+            hitList = crdir_hits.hits_from_planes(channelHits, frame.offsets(), frameName=frameName)
+
+    rawCache.invalidate(imgPath)  # A batch never comes back to a frame; free it for the next one
+
+    return height, width, hitList
+
+##############################################################################################################
+def frame_hits_path(outDir, imgPath):
+    # Where process_frame saves the HitList of a frame
+    return os.path.join(outDir, os.path.splitext(os.path.basename(imgPath))[0] + '.hits.npz')
+
+##############################################################################################################
+def merge_hit_lists(outDir, img_files):
+    # Combine the per-frame HitLists (memory-mapped) into one, saved as <outDir>/hits.npz
+
+    allHits = crdir_hits.HitList()
+    for imgPath in img_files:
+        if os.path.exists(frame_hits_path(outDir, imgPath)):
+            allHits.extend(crdir_hits.HitList.load(frame_hits_path(outDir, imgPath)))
+
+    allHits.save(os.path.join(outDir, 'hits.npz'))
+
+    return allHits
+
+##############################################################################################################
+def frame_sigmas(imgDir, hitList, stDev=DEFAULT_STDEV, noiseLibrary=None):
+    # What the Z-scores of each frame of hitList were computed with, for crdir_events.find_events: stDev, or with
+    # a noiseLibrary the frame's noise model where the library has one (as process_frame chose it)
+
+    if noiseLibrary is None:
+        return stDev
+
+    return [crdir_noise.noise_model_for(os.path.join(imgDir, frameName), default=stDev, library=noiseLibrary)
+            for frameName in hitList.frameNames]
+
+##############################################################################################################
+def _process_frame_task(task):
+    # Worker helper: unpack one (imgPath, outDir, stDev, zLimit, memoryBudget, noiseLibrary, defectLibrary,
+    # cacheDir, instrumentMemory) task; returns (frame summary, the frame's crdir_instrument records).
+    # instrumentMemory is None to run uninstrumented, else whether to track peak memory too.
+
+    instrumentMemory = task[-1]
+    if instrumentMemory is None:
+        return process_frame(*task[:-1]), []
+
+    instrument.enable(trackMemory=instrumentMemory)
+    instrument.take_records()  # Anything recorded by an earlier task of this worker has been returned already
+    with instrument.frame(os.path.basename(task[0])), instrument.timed('process_frame'):
+        frameSummary = process_frame(*task[:-1])
+
+    return frameSummary, instrument.take_records()
+
+def _process_frame_tasks(tasks):
+    # Worker helper: run a chunk of tasks (see _process_frame_task), returning their results in order
+    return [_process_frame_task(task) for task in tasks]
+
+##############################################################################################################
+def write_summary(outDir, frameSummaries, runSummary):
+    # summary.json (run totals + every frame) and summary.csv (one row per frame)
+
+    with open(os.path.join(outDir, 'summary.json'), 'w') as jsonFile:
+        json.dump({'run': runSummary, 'frames': frameSummaries}, jsonFile, indent=2)
+
+    fieldNames = []
+    for frameSummary in frameSummaries:
+        fieldNames += [key for key in frameSummary if key not in fieldNames]
+
+    with open(os.path.join(outDir, 'summary.csv'), 'w', newline='') as csvFile:
+        writer = csv.DictWriter(csvFile, fieldnames=fieldNames)
+        writer.writeheader()
+        writer.writerows(frameSummaries)
+
+##############################################################################################################
+def run_batch(imgDir, outDir=None, stDev=DEFAULT_STDEV, zLimit=DEFAULT_Z_LIMIT, workers=None, chunksize=1,
+              fileExtension='.nef', memoryBudget=None, noiseLibrary=None, defectLibrary=None, cacheDir=None,
+              instrumentation=None, verbose=True):
+    # Detect hits in every raw frame of imgDir with a pool of worker processes. Reports progress as frames
+    # finish and the overall throughput (frames/s, MP/s) at the end; returns the run summary dict.
+    # With a cacheDir (crdir_diskcache), re-running on frames already processed with the same parameters only
+    # reads their hits back from the cache. instrumentation 'time' or 'memory' records every stage in the workers
+    # (crdir_instrument; 'memory' adds peak memory, and overhead) to <outDir>/instrument.json & instrument.csv.
+
+    outDir = os.path.join(imgDir, 'crdir_out') if outDir is None else outDir
+    os.makedirs(outDir, exist_ok=True)
+    workers = os.cpu_count() if workers is None else workers
+
+    img_files, img_fileNames = batch_img_files(imgDir, fileExtension)
+    instrumentMemory = None if instrumentation is None else instrumentation == 'memory'
+    tasks = [(imgPath, outDir, stDev, zLimit, memoryBudget, noiseLibrary, defectLibrary, cacheDir, instrumentMemory)
+             for imgPath in img_files]
+
+    if verbose:
+        print("Processing {} '{}' frames in {} with {} workers (chunksize {}); output to {}"
+              .format(len(tasks), fileExtension, imgDir, workers, chunksize, outDir))
+
+    startTime = time.perf_counter()
+    results = [None] * len(tasks)  # (frame summary, records) of each task, in img_files order
+    nDone = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunkStarts = {executor.submit(_process_frame_tasks, tasks[start:start + chunksize]): start
+                       for start in range(0, len(tasks), chunksize)}
+
+        for future in as_completed(chunkStarts):  # Progress in the order frames finish, not in submission order
+            start = chunkStarts[future]
+            for offset, (frameSummary, frameRecords) in enumerate(future.result()):
+                results[start + offset] = (frameSummary, frameRecords)
+                nDone += 1
+
+                if verbose:
+                    status = frameSummary['error'] or '{:7d} hits{}'.format(
+                        frameSummary['hits'], ' (cached)' if frameSummary.get('cached') else '')
+                    print("[{:{width}d}/{}] {}: {} ({:0.2f} s)".format(nDone, len(tasks), frameSummary['file'],
+                                                                       status, frameSummary['seconds'],
+                                                                       width=len(str(len(tasks)))))
+
+    frameSummaries = [frameSummary for frameSummary, frameRecords in results]
+    stageRecords = [record for frameSummary, frameRecords in results for record in frameRecords]
+
+    allHits = merge_hit_lists(outDir, [imgPath for imgPath, frameSummary in zip(img_files, frameSummaries)
+                                       if not frameSummary['error']])
+    events = crdir_events.find_events(allHits, globalSigma=frame_sigmas(imgDir, allHits, stDev, noiseLibrary))
+    events.save(os.path.join(outDir, 'events.npz'))
+
+    elapsedTime = time.perf_counter() - startTime
+    megapixels = sum(frameSummary['megapixels'] for frameSummary in frameSummaries)
+
+    runSummary = {'imgDir': os.path.abspath(imgDir), 'stDev': stDev, 'zLimit': zLimit, 'workers': workers,
+                  'chunksize': chunksize, 'memoryBudget': memoryBudget, 'noiseLibrary': noiseLibrary,
+                  'defectLibrary': defectLibrary, 'cacheDir': cacheDir, 'instrumentation': instrumentation,
+                  'cached': sum(1 for frameSummary in frameSummaries if frameSummary.get('cached')),
+                  'frames': len(frameSummaries),
+                  'failed': sum(1 for frameSummary in frameSummaries if frameSummary['error']),
+                  'hits': sum(frameSummary['hits'] for frameSummary in frameSummaries),
+                  'events': len(events),
+                  'seconds': elapsedTime,
+                  'framesPerSecond': len(frameSummaries) / elapsedTime if elapsedTime > 0 else 0.0,
+                  'megapixelsPerSecond': megapixels / elapsedTime if elapsedTime > 0 else 0.0}
+
+    write_summary(outDir, frameSummaries, runSummary)
+    if instrumentation is not None:
+        instrument.save(os.path.join(outDir, 'instrument.json'), stageRecords)
+        instrument.save(os.path.join(outDir, 'instrument.csv'), stageRecords)
+
+    if verbose:
+        print("\n{} frames ({} failed), {} hits ({} events) in {:0.1f} s:  {:0.2f} frames/s,  {:0.1f} MP/s"
+              .format(runSummary['frames'], runSummary['failed'], runSummary['hits'], runSummary['events'],
+                      elapsedTime,
+                      runSummary['framesPerSecond'], runSummary['megapixelsPerSecond']))
+        if instrumentation is not None:
+            print("\nStages (inclusive times, all workers):\n  " + "\n  ".join(instrument.summary_lines(stageRecords)))
+
+    return runSummary
@@ -0,0 +1,446 @@
+# crdir_bench.py
+# Benchmarks for the Cosmic Ray Damage Image Repair (CRDIR) project support routines
+#
+# Usage:  python crdir_bench.py extract   [--width 6016 --height 4016 --repeat 5]
+#         python crdir_bench.py neighbors [--width 6016 --height 4016 --repeat 5]
+#         python crdir_bench.py median    [--width 6016 --height 4016 --repeat 3 --sizes 3 5 7 9]
+#         python crdir_bench.py display   [--width 6016 --height 4016 --repeat 3]
+#         python crdir_bench.py synthetic [--megapixels 12 24 45 60 --bits 14 --sigma 75 --hits 500 --tracks 50
+#                                          --zlimit 5 --repeat 1 --seed 0 --json results.json]
+#         python crdir_bench.py compare   <baseline.json> <results.json>
+#         python crdir_bench.py imports   [--modules crdir_funcs_v2 crdir_batch --repeat 5 --budget-ms 150]
+#
+# synthetic times every stage of the Z-score pipeline on generated Bayer mosaics (Gaussian noise around a pedestal)
+# with cosmic-ray hits and tracks injected at known positions, and scores the detection against them (recall:
+# injected pixels found; precision: pixels found that were injected). --json saves the results, and compare
+# prints the stage times of two such files side by side.
+# imports times `import <module>` in fresh interpreters (best of --repeat, less a bare `import numpy`) and checks
+# that the core modules leave the GUI / display / LibRaw modules unloaded; it exits 1 if a module is over
+# --budget-ms or pulls one of them in, so it can guard the import time in a build.
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+import crdir_display as display
+import crdir_filters as filters
+import crdir_funcs_v2 as cf
+
+##############################################################################################################
+class SyntheticRaw:
+    # Stand-in for a rawpy image (just the attributes the CRDIR routines use), holding a random Bayer mosaic
+
+    # (uniformly distributed values, or Gaussian noise of sigma around level if sigma is given)
+
+    def __init__(self, width=6016, height=4016, bits=14, pattern=((0, 1), (3, 2)), topMargin=0, leftMargin=0,
+                 seed=0, sigma=None, level=None):
+        rng = np.random.default_rng(seed)
+        shape = (height + topMargin, width + leftMargin)
+
+        if sigma is None:
+            self.raw_image = rng.integers(0, 2 ** bits, shape, dtype=np.uint16)
+        else:
+            level = 2 ** bits // 8 if level is None else level
+            noise = rng.standard_normal(shape, dtype=np.float32)
+            noise *= sigma
+            noise += level
+            self.raw_image = np.clip(np.rint(noise, out=noise), 0, 2 ** bits - 1).astype(np.uint16)
+        self.raw_pattern = np.array(pattern, dtype=np.uint8)
+        self.white_level = 2 ** bits - 1
+        self.sizes = SimpleNamespace(top_margin=topMargin, left_margin=leftMargin, height=height, width=width,
+                                     raw_height=height + topMargin, raw_width=width + leftMargin)
+
+    @property
+    def raw_image_visible(self):
+        return self.raw_image[self.sizes.top_margin:, self.sizes.left_margin:]
+
+    @property
+    def raw_colors(self):
+        h, w = self.raw_image.shape
+        return np.tile(self.raw_pattern, ((h + 1) // 2, (w + 1) // 2))[0:h, 0:w]
+
+##############################################################################################################
+def extract_with_masks(rawImage):
+    # The original extract_from_raw: four image-size boolean masks, four fancy-indexed copies
+
+    RG1BG2Image = rawImage.raw_image
+    BayerArray = rawImage.raw_colors
+
+    nColsReshape = RG1BG2Image.shape[1] // 2
+    Rimage  = np.reshape(RG1BG2Image[BayerArray == 0], (-1, nColsReshape))
+    G1image = np.reshape(RG1BG2Image[BayerArray == 1], (-1, nColsReshape))
+    Bimage  = np.reshape(RG1BG2Image[BayerArray == 2], (-1, nColsReshape))
+    G2image = np.reshape(RG1BG2Image[BayerArray == 3], (-1, nColsReshape))
+
+    return RG1BG2Image, Rimage, G1image, G2image, Bimage
+
+##############################################################################################################
+def time_call(func, *args, repeat=5, **kwargs):
+    # Best-of-repeat wall time (seconds) of func(*args, **kwargs), and its last result
+
+    bestTime = float('inf')
+    for _ in range(repeat):
+        startTime = time.perf_counter()
+        result = func(*args, **kwargs)
+        bestTime = min(bestTime, time.perf_counter() - startTime)
+
+    return bestTime, result
+
+##############################################################################################################
+def bench_extract(width=6016, height=4016, repeat=5):
+    # Compare the mask-based and the strided-view Bayer plane extraction on a full-size frame
+
+    rawImage = SyntheticRaw(width, height)
+    # rawpy builds raw_colors on every access, so the original also paid for that; don't count it here
+    maskedRawImage = SimpleNamespace(raw_image=rawImage.raw_image, raw_colors=rawImage.raw_colors)
+
+    maskTime, maskPlanes = time_call(extract_with_masks, maskedRawImage, repeat=repeat)
+    viewTime, viewPlanes = time_call(cf.extract_from_raw, rawImage, visibleOnly=False, repeat=repeat)
+    stackTime, _ = time_call(cf.extract_from_raw, rawImage, visibleOnly=False, stacked=True, repeat=repeat)
+
+    identical = all(np.array_equal(maskPlane, viewPlane) for maskPlane, viewPlane in zip(maskPlanes, viewPlanes))
+
+    print("extract_from_raw on a {}x{} ({:0.1f} MP) frame, best of {}:".format(width, height,
+                                                                             width * height / 1e6, repeat))
+    print("  boolean masks (original):  {:8.2f} ms".format(1000 * maskTime))
+    print("  strided views:             {:8.3f} ms   ({:0.0f}x faster)".format(1000 * viewTime,
+                                                                             maskTime / viewTime))
+    print("  stacked (4, H/2, W/2):     {:8.2f} ms   ({:0.1f}x faster)".format(1000 * stackTime,
+                                                                            maskTime / stackTime))
+    print("  planes identical: {}".format(identical))
+
+    return {'maskTime': maskTime, 'viewTime': viewTime, 'stackTime': stackTime, 'identical': identical}
+
+##############################################################################################################
+def bench_neighbors(width=6016, height=4016, repeat=5):
+    # Time each neighbor-mean backend on the four Bayer planes of a full-size frame (what one z-score pass costs)
+
+    RG1BG2Image, stackedPlanes = cf.extract_from_raw(SyntheticRaw(width, height), stacked=True)
+
+    print("8-neighbor mean of the four {}x{} Bayer planes of a {:0.1f} MP frame, best of {}:"
+          .format(stackedPlanes.shape[2], stackedPlanes.shape[1], width * height / 1e6, repeat))
+
+    results = {}
+    for backend in ['convolve', 'uniform', 'cumsum', 'boxsum']:
+        for dtype in [np.float64, np.float32, np.int32]:
+            backendTime, _ = time_call(lambda: [filters.neighbor_mean(plane, backend=backend, dtype=dtype)
+                                                for plane in stackedPlanes], repeat=repeat)
+            results['{}/{}'.format(backend, np.dtype(dtype).name)] = backendTime
+            print("  {:8s} {:8s} {:8.1f} ms   ({:0.1f}x the original)"
+                  .format(backend, np.dtype(dtype).name, 1000 * backendTime,
+                          results['convolve/float64'] / backendTime))
+
+    return results
+
+##############################################################################################################
+def bench_median(width=6016, height=4016, repeat=3, sizes=(3, 5, 7, 9)):
+    # Time the median backends against the original per-plane medfilt2d on the four Bayer planes of a frame
+
+    RG1BG2Image, stackedPlanes = cf.extract_from_raw(SyntheticRaw(width, height), stacked=True)
+
+    print("Median filter of the four {}x{} Bayer planes of a {:0.1f} MP frame, best of {}:"
+          .format(stackedPlanes.shape[2], stackedPlanes.shape[1], width * height / 1e6, repeat))
+
+    results = {}
+    for size in sizes:
+        medfiltTime, medfiltPlanes = time_call(filters.median_filter, stackedPlanes, size, 'medfilt2d', 'constant',
+                                               repeat=repeat)
+        results['medfilt2d/{}'.format(size)] = medfiltTime
+        print("  {}x{}  {:9s} {:9.1f} ms".format(size, size, 'medfilt2d', 1000 * medfiltTime))
+
+        for backend in ['network', 'partition', 'ndimage'] if size == 3 else ['partition', 'ndimage']:
+            backendTime, backendPlanes = time_call(filters.median_filter, stackedPlanes, size, backend,
+                                                   'constant', repeat=repeat)  # zero fill, like medfilt2d
+            results['{}/{}'.format(backend, size)] = backendTime
+            print("  {}x{}  {:9s} {:9.1f} ms   ({:0.1f}x faster, identical: {})"
+                  .format(size, size, backend, 1000 * backendTime, medfiltTime / backendTime,
+                          np.array_equal(backendPlanes, medfiltPlanes)))
+
+    return results
+
+##############################################################################################################
+def bench_display(width=6016, height=4016, repeat=3):
+    # Time prep_img_for_display on a full-size RGB render: area-averaged PPM (default) vs the same image as PNG
+
+    rgbImage = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+    print("prep_img_for_display of a {}x{} ({:0.1f} MP) RGB image, best of {}:".format(width, height,
+                                                                                     width * height / 1e6, repeat))
+
+    results = {}
+    ppmTime, (ppmData, imgResizeLabel) = time_call(display.prep_img_for_display, rgbImage, repeat=repeat)
+    results['ppm'] = ppmTime
+    print("  ppm (uncompressed):  {:8.1f} ms   {:8.0f} kB   {}".format(1000 * ppmTime, len(ppmData) / 1e3,
+                                                                       imgResizeLabel))
+
+    if display.load_fitz() is not None:
+        pngTime, (pngData, _) = time_call(display.prep_img_for_display, rgbImage, imageFormat='png', repeat=repeat)
+        results['png'] = pngTime
+        print("  png (fitz encode):   {:8.1f} ms   {:8.0f} kB   ({:0.1f}x the ppm time)"
+              .format(1000 * pngTime, len(pngData) / 1e3, pngTime / ppmTime))
+
+    return results
+
+##############################################################################################################
+def frame_size(megapixels, aspect=1.5):
+    # (width, height) of a 3:2 frame of about this many megapixels, both even (whole Bayer cells)
+    height = int(round((megapixels * 1e6 / aspect) ** 0.5 / 2)) * 2
+    return int(round(height * aspect / 2)) * 2, height
+
+def inject_hits(rawImage, nHits=500, nTracks=50, sigma=75, amplitude=(10, 100), trackLength=(5, 40), seed=0):
+    # Add cosmic-ray hits (single pixels) and tracks (straight lines of pixels at random angles) to the visible
+    # mosaic of rawImage, each pixel raised by a random amplitude (in units of sigma); returns the set of
+    # visible-mosaic linear indices hit (the ground truth)
+
+    rng = np.random.default_rng(seed + 1)
+    mosaic = rawImage.raw_image_visible
+    height, width = mosaic.shape
+
+    rows = [rng.integers(0, height, nHits)]
+    cols = [rng.integers(0, width, nHits)]
+    for _ in range(nTracks):
+        length = rng.integers(trackLength[0], trackLength[1] + 1)
+        angle = rng.uniform(0, np.pi)
+        steps = np.arange(length)
+        rows.append(np.clip(np.rint(rng.integers(0, height) + steps * np.sin(angle)), 0, height - 1).astype(int))
+        cols.append(np.clip(np.rint(rng.integers(0, width) + steps * np.cos(angle)), 0, width - 1).astype(int))
+
+    truth = np.unique(np.ravel_multi_index((np.concatenate(rows), np.concatenate(cols)), (height, width)))
+    truthRows, truthCols = np.unravel_index(truth, (height, width))
+    deposit = rng.uniform(amplitude[0], amplitude[1], len(truth)) * sigma
+    mosaic[truthRows, truthCols] = np.minimum(mosaic[truthRows, truthCols] + deposit, rawImage.white_level)
+
+    return truth
+
+def detection_scores(frame, globalSigma, zLimit, truth):
+    # Recall and precision of the pixels whose |Z-score| exceeds zLimit in the four Bayer planes of a CRDIRFrame,
+    # against the injected (visible-mosaic linear index) truth. Also the precision of the positive Z-scores alone:
+    # a hit raises the mean of its neighbors, so they get large negative Z-scores of their own.
+
+    height, width = frame.image('RG1BG2').shape
+    found, positive = [], []
+    for channel, (rowOffset, colOffset) in frame.offsets().items():
+        coords = frame.exceeds_Zlimit(channel, globalSigma, zLimit)
+        found.append(np.ravel_multi_index((2 * coords[:, 0] + rowOffset, 2 * coords[:, 1] + colOffset),
+                                          (height, width)))
+        positive.append(frame.Zscore_image(channel, globalSigma)[coords[:, 0], coords[:, 1]] > 0)
+    found, positive = np.concatenate(found), np.concatenate(positive)
+    truthRows, truthCols = np.unravel_index(truth, frame.rawImage.raw_image_visible.shape)
+    analysed = (truthRows < height) & (truthCols < width)  # An odd last row / column is not analysed
+    truth = np.ravel_multi_index((truthRows[analysed], truthCols[analysed]), (height, width))
+
+    isTrue = np.isin(found, truth)
+    truePositives = int(np.count_nonzero(isTrue))
+    nPositive = int(np.count_nonzero(positive))
+    return {'injected': int(len(truth)), 'detected': int(len(found)), 'truePositives': truePositives,
+            'recall': truePositives / len(truth) if len(truth) else 1.0,
+            'precision': truePositives / len(found) if len(found) else 1.0,
+            'detectedPositive': nPositive,
+            'precisionPositive': int(np.count_nonzero(isTrue & positive)) / nPositive if nPositive else 1.0}
+
+def bench_synthetic(megapixels=(12, 24, 45, 60), bits=14, sigma=75, nHits=500, nTracks=50, zLimit=5, repeat=1,
+                    seed=0, jsonPath=None):
+    # Time every stage of the Z-score pipeline on synthetic frames with injected hits, and score the detection
+
+    results = {'benchmark': 'synthetic', 'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+               'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                               'platform': platform.platform(), 'cpus': os.cpu_count()},
+               'config': {'bits': bits, 'sigma': sigma, 'hits': nHits, 'tracks': nTracks, 'zLimit': zLimit,
+                          'repeat': repeat, 'seed': seed},
+               'frames': []}
+
+    for frameMegapixels in megapixels:
+        width, height = frame_size(frameMegapixels)
+        rawImage = SyntheticRaw(width, height, bits=bits, sigma=sigma, seed=seed)
+        truth = inject_hits(rawImage, nHits=nHits, nTracks=nTracks, sigma=sigma, seed=seed)
+        frameMP = width * height / 1e6
+
+        print("Synthetic {}x{} ({:0.1f} MP, {}-bit, sigma {}) frame with {} hit pixels, best of {}:"
+              .format(width, height, frameMP, bits, sigma, len(truth), repeat))
+
+        stages = {}
+        def stage(name, func, *args, **kwargs):
+            seconds, result = time_call(func, *args, repeat=repeat, **kwargs)
+            stages[name] = {'seconds': seconds, 'megapixelsPerSecond': frameMP / seconds if seconds > 0 else 0.0}
+            print("  {:40s} {:9.1f} ms  {:8.1f} MP/s".format(name, 1000 * seconds, stages[name]['megapixelsPerSecond']))
+            return result
+
+        planes = stage('extract_from_raw', cf.extract_from_raw, rawImage)
+        stage('calculate_eight_neighbor_mean (x4)', lambda: [cf.calculate_eight_neighbor_mean(plane)
+                                                              for plane in planes[1:]])
+        stage('calculate_Zscore_images_from_raw', cf.calculate_Zscore_images_from_raw, rawImage, sigma)
+
+        frame = cf.CRDIRFrame(rawImage)
+        ZscoreImages = [frame.Zscore_image(channel, sigma) for channel in frame.CHANNELS]
+        stage('find_where_Zscore_exceeds_Z_limit (x4)', lambda: [cf.find_where_Zscore_exceeds_Z_limit(Zscore, zLimit)
+                                                                  for Zscore in ZscoreImages])
+
+        products = dict(frame.products)  # Each builder starts from the planes & Z-scores, not its own memo
+        bayer4up = stage('bayer4up', lambda: cf.CRDIRFrame(rawImage, dict(products)).bayer4up())
+        stage('Zscore4up', lambda: cf.CRDIRFrame(rawImage, dict(products)).Zscore4up(sigma))
+        stage('exceeds_Zlimit4up', lambda: cf.CRDIRFrame(rawImage, dict(products)).exceeds_Zlimit4up(sigma, zLimit))
+        stage('prep_img_for_display', display.prep_img_for_display, bayer4up)
+
+        detection = detection_scores(frame, sigma, zLimit, truth)
+        print("  detection at |Z| > {}: recall {:0.3f} ({}/{} injected pixels), precision {:0.3f} ({} detected; "
+              "{:0.3f} of the {} with Z > 0)".format(zLimit, detection['recall'], detection['truePositives'],
+                                                     detection['injected'], detection['precision'],
+                                                     detection['detected'], detection['precisionPositive'],
+                                                     detection['detectedPositive']))
+
+        results['frames'].append({'megapixels': frameMP, 'width': width, 'height': height, 'stages': stages,
+                                  'totalSeconds': sum(stageTimes['seconds'] for stageTimes in stages.values()),
+                                  'detection': detection})
+        del rawImage, planes, frame, ZscoreImages, products, bayer4up  # Before the next (bigger) frame
+
+    if jsonPath is not None:
+        with open(jsonPath, 'w') as jsonFile:
+            json.dump(results, jsonFile, indent=2)
+        print("Results saved to {}".format(jsonPath))
+
+    return results
+
+##############################################################################################################
+def bench_compare(baselinePath, resultsPath):
+    # Stage times of two bench_synthetic JSON files side by side, frame size by frame size
+
+    with open(baselinePath) as jsonFile:
+        baseline = json.load(jsonFile)
+    with open(resultsPath) as jsonFile:
+        results = json.load(jsonFile)
+
+    baselineFrames = {round(frame['megapixels'], 1): frame for frame in baseline['frames']}
+    for frame in results['frames']:
+        baselineFrame = baselineFrames.get(round(frame['megapixels'], 1))
+        if baselineFrame is None:
+            print("{:0.1f} MP: not in {}".format(frame['megapixels'], baselinePath))
+            continue
+
+        print("{:0.1f} MP frame: baseline {} vs {}".format(frame['megapixels'], baseline['timestamp'],
+                                                          results['timestamp']))
+        for name, stage in frame['stages'].items():
+            if name in baselineFrame['stages']:
+                baselineSeconds = baselineFrame['stages'][name]['seconds']
+                print("  {:40s} {:9.1f} ms -> {:9.1f} ms   ({:0.2f}x)".format(
+                    name, 1000 * baselineSeconds, 1000 * stage['seconds'],
+                    baselineSeconds / stage['seconds'] if stage['seconds'] > 0 else float('inf')))
+        for key in ('recall', 'precision', 'precisionPositive'):
+            print("  {:40s} {:9.3f}    -> {:9.3f}".format(key, baselineFrame['detection'][key],
+                                                          frame['detection'][key]))
+
+##############################################################################################################
+HEAVY_MODULES = ('fitz', 'pymupdf', 'rawpy', 'scipy', 'PyQt5', 'PySimpleGUIQt', 'PIL', 'matplotlib')
+
+def import_time(statement, repeat=5):
+    # Best wall time (seconds) of running statement in a fresh interpreter, and the HEAVY_MODULES it loaded
+
+    script = ("import sys, time; start = time.perf_counter(); {}; seconds = time.perf_counter() - start; "
+              "print(seconds); print(' '.join(name for name in {!r} if name in sys.modules))").format(
+        statement, HEAVY_MODULES)
+    times = []
+    for n in range(repeat):
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.splitlines()
+        times.append(float(output[0]))
+
+    return min(times), output[1].split() if len(output) > 1 else []
+
+def bench_imports(modules=('crdir_funcs_v2', 'crdir_batch'), repeat=5, budgetMs=150):
+    # Import time of each module over that of numpy (which they all need), and the heavy modules it loads;
+    # returns True if every module is within budgetMs and loads none of them
+
+    numpySeconds, numpyHeavy = import_time('import numpy', repeat)
+    print("{:24s} {:8.1f} ms   (baseline, subtracted below)".format('numpy', 1000 * numpySeconds))
+
+    passed = True
+    for module in modules:
+        seconds, heavyModules = import_time('import numpy; import {}'.format(module), repeat)
+        extraMs = 1000 * (seconds - numpySeconds)
+        withinBudget = extraMs <= budgetMs and not heavyModules
+        passed = passed and withinBudget
+        print("{:24s} {:8.1f} ms   {}{}".format(module, extraMs, 'ok' if withinBudget else 'OVER BUDGET',
+                                                 '   loads ' + ', '.join(heavyModules) if heavyModules else ''))
+
+    print("Budget {:0.0f} ms per module: {}".format(budgetMs, 'passed' if passed else 'FAILED'))
+    return passed
+
+##############################################################################################################
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Benchmarks for the CRDIR support routines")
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+
+    extractParser = subparsers.add_parser('extract', help="Bayer plane extraction (extract_from_raw)")
+    extractParser.add_argument('--width', type=int, default=6016)
+    extractParser.add_argument('--height', type=int, default=4016)
+    extractParser.add_argument('--repeat', type=int, default=5)
+
+    neighborsParser = subparsers.add_parser('neighbors', help="8-neighbor mean backends (crdir_filters)")
+    neighborsParser.add_argument('--width', type=int, default=6016)
+    neighborsParser.add_argument('--height', type=int, default=4016)
+    neighborsParser.add_argument('--repeat', type=int, default=5)
+
+    medianParser = subparsers.add_parser('median', help="median filter backends (crdir_filters)")
+    medianParser.add_argument('--width', type=int, default=6016)
+    medianParser.add_argument('--height', type=int, default=4016)
+    medianParser.add_argument('--repeat', type=int, default=3)
+    medianParser.add_argument('--sizes', type=int, nargs='+', default=[3, 5, 7, 9])
+
+    displayParser = subparsers.add_parser('display', help="display image preparation (prep_img_for_display)")
+    displayParser.add_argument('--width', type=int, default=6016)
+    displayParser.add_argument('--height', type=int, default=4016)
+    displayParser.add_argument('--repeat', type=int, default=3)
+
+    syntheticParser = subparsers.add_parser('synthetic', help="every pipeline stage on synthetic frames with "
+                                                              "injected hits; throughput, recall & precision")
+    syntheticParser.add_argument('--megapixels', type=float, nargs='+', default=[12, 24, 45, 60])
+    syntheticParser.add_argument('--bits', type=int, choices=(12, 14), default=14)
+    syntheticParser.add_argument('--sigma', type=float, default=75, help="pixel noise standard deviation")
+    syntheticParser.add_argument('--hits', type=int, default=500, help="single-pixel hits injected per frame")
+    syntheticParser.add_argument('--tracks', type=int, default=50, help="tracks injected per frame")
+    syntheticParser.add_argument('--zlimit', type=float, default=5)
+    syntheticParser.add_argument('--repeat', type=int, default=1)
+    syntheticParser.add_argument('--seed', type=int, default=0)
+    syntheticParser.add_argument('--json', default=None, help="save the results to this file")
+
+    compareParser = subparsers.add_parser('compare', help="compare two 'synthetic --json' result files")
+    compareParser.add_argument('baseline')
+    compareParser.add_argument('results')
+
+    importsParser = subparsers.add_parser('imports', help="import time of the core modules, against a budget")
+    importsParser.add_argument('--modules', nargs='+', default=['crdir_funcs_v2', 'crdir_batch'])
+    importsParser.add_argument('--repeat', type=int, default=5)
+    importsParser.add_argument('--budget-ms', type=float, default=150,
+                               help="allowed import time per module, over that of numpy")
+
+    args = parser.parse_args(argv)
+
+    if args.bench == 'extract':
+        bench_extract(args.width, args.height, args.repeat)
+    elif args.bench == 'neighbors':
+        bench_neighbors(args.width, args.height, args.repeat)
+    elif args.bench == 'median':
+        bench_median(args.width, args.height, args.repeat, args.sizes)
+    elif args.bench == 'display':
+        bench_display(args.width, args.height, args.repeat)
+    elif args.bench == 'synthetic':
+        bench_synthetic(args.megapixels, args.bits, args.sigma, args.hits, args.tracks, args.zlimit, args.repeat,
+                        args.seed, args.json)
+    elif args.bench == 'compare':
+        bench_compare(args.baseline, args.results)
+    elif args.bench == 'imports':
+        return 0 if bench_imports(args.modules, args.repeat, args.budget_ms) else 1
+
+    return 0
+
+##############################################################################################################
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,228 @@
+# crdir_defects.py
+# Persistent hot-pixel / defect maps for the Cosmic Ray Damage Image Repair (CRDIR) project
+#
+# A stuck or hot pixel exceeds the Z-score limit in nearly every frame; a cosmic-ray hit almost never lands on
+# the same pixel twice. A DefectAccumulator counts, per Bayer-plane pixel, how many frames flagged it above its
+# neighbors (positive Z-scores only: the neighbors of a hot pixel are flagged below theirs every time) (uint16,
+# one plane per channel code as in crdir_hits: 0 = R, 1 = G1, 2 = B, 3 = G2), and derives a DefectMap of the
+# pixels flagged in at least minFraction of the frames. Looking a hit up in the map is a single index into a
+# boolean array, so separating permanent defects from transient hits costs O(1) per hit.
+# A DefectLibrary keeps one accumulator (counts + the precomputed map) per camera body on disk:
+#   <library>/<camera>.defects.npz
+#
+# Usage:  python crdir.py defects <dir of frames> [--library DIR]        # learn (or extend) the maps
+#         python crdir.py batch <dir> --defect-library DIR                # report transient hits only
+
+import json
+import os
+import re
+
+import numpy as np
+
+import crdir_funcs_v2 as cf
+import crdir_hits
+import crdir_noise
+
+DEFAULT_DEFECT_LIBRARY = os.environ.get('CRDIR_DEFECT_LIBRARY',
+                                        os.path.join(os.path.expanduser('~'), '.crdir', 'defects'))
+
+DEFAULT_MIN_FRACTION = 0.5  # Flagged in at least half of the frames: a defect, not a cosmic ray
+DEFAULT_MIN_FRAMES = 5      # Too few frames to tell a defect from a coincidence: no defects yet
+
+##############################################################################################################
+class DefectMap:
+    # Boolean (4, H/2, W/2) map of the defective pixels of one camera, by channel code and plane position
+
+    def __init__(self, mask, camera='', frames=0):
+        self.mask = mask
+        self.camera = camera
+        self.frames = frames
+
+    def __len__(self):
+        return int(np.count_nonzero(self.mask))
+
+    def is_defect(self, channel, coords):
+        # Boolean per (row, col) in coords (N x 2, plane coordinates of channel): is it a known defect?
+        coords = np.asarray(coords).reshape(-1, 2)
+        return self.mask[_channel_code(channel), coords[:, 0], coords[:, 1]]
+
+    def split(self, channel, coords):
+        # (transient, defect) coordinates: the hits that are not / are known defects
+        coords = np.asarray(coords).reshape(-1, 2)
+        defect = self.is_defect(channel, coords)
+        return coords[~defect], coords[defect]
+
+    def hit_is_defect(self, hitList):
+        # Boolean per hit of a crdir_hits.HitList: is it a known defect?
+        return self.mask[hitList['channel'], hitList['row'], hitList['col']]
+
+    def coords(self, channel):
+        # N x 2 (row, col) plane coordinates of the defects of one channel
+        return np.argwhere(self.mask[_channel_code(channel)])
+
+    def __repr__(self):
+        return "DefectMap({!r}, {} defects from {} frames)".format(self.camera, len(self), self.frames)
+
+##############################################################################################################
+class DefectAccumulator:
+    # Per-pixel count of the frames in which each Bayer-plane pixel was flagged
+
+    def __init__(self, planeShape, camera=''):
+        self.counts = np.zeros((len(cf.BAYER_COLOR_NAMES),) + tuple(planeShape), dtype=np.uint16)
+        self.frames = 0
+        self.camera = camera
+
+    def add_frame(self, channelHits):
+        # Count one frame's hits: {channel: (N x 2 plane coordinates, Z-scores)}, e.g. from
+        # crdir_tiled.find_hits_tiled(..., returnZscores=True). Only positive Z-scores count: a hot pixel drags up
+        # the neighbor mean of the same-color pixels around it, which then fall below it by more than zLimit in
+        # every frame too, and must not be mapped as defects themselves. (Plain N x 2 coordinates are counted as
+        # they are, so they should be positive hits already.)
+
+        if self.frames == np.iinfo(self.counts.dtype).max:
+            raise OverflowError("DefectAccumulator holds at most {} frames".format(self.frames))
+
+        for channel, hits in channelHits.items():
+            if isinstance(hits, tuple):
+                coords, Zscores = hits
+                coords = np.asarray(coords).reshape(-1, 2)[np.asarray(Zscores) > 0]
+            else:
+                coords = np.asarray(hits).reshape(-1, 2)
+            self.counts[_channel_code(channel), coords[:, 0], coords[:, 1]] += 1  # Unique within a frame
+        self.frames += 1
+
+    def add_hit_list(self, hitList, frames=None):
+        # Count the frames of a crdir_hits.HitList (only those with the indices in frames, if given); only hits
+        # with a positive Z-score count (see add_frame)
+
+        frames = range(len(hitList.frameNames)) if frames is None else frames
+        keep = np.isin(hitList['frame'], np.asarray(frames, dtype=np.int64)) & (hitList['z'] > 0)
+        selected = hitList.select(keep) if not keep.all() else hitList
+
+        if self.frames + len(frames) > np.iinfo(self.counts.dtype).max:
+            raise OverflowError("DefectAccumulator holds at most {} frames".format(np.iinfo(self.counts.dtype).max))
+
+        np.add.at(self.counts, (selected['channel'], selected['row'], selected['col']), 1)
+        self.frames += len(frames)
+
+    def defect_map(self, minFraction=DEFAULT_MIN_FRACTION, minFrames=DEFAULT_MIN_FRAMES):
+        # The pixels flagged in at least minFraction of the frames (none until minFrames have been counted)
+
+        if self.frames < minFrames:
+            return DefectMap(np.zeros(self.counts.shape, dtype=bool), self.camera, self.frames)
+
+        return DefectMap(self.counts >= max(1, int(np.ceil(minFraction * self.frames))), self.camera, self.frames)
+
+##############################################################################################################
+class DefectLibrary:
+    # One DefectAccumulator per camera, with its precomputed DefectMap, in a directory (see the top of this file).
+    # Maps are loaded once per version of the file, so looking one up per frame is cheap.
+
+    def __init__(self, libraryDir=None):
+        self.libraryDir = DEFAULT_DEFECT_LIBRARY if libraryDir is None else libraryDir
+        self._maps = {}
+
+    def path(self, camera):
+        return os.path.join(self.libraryDir, re.sub(r'[^\w.-]+', '_', camera) + '.defects.npz')
+
+    def save(self, accumulator, minFraction=DEFAULT_MIN_FRACTION, minFrames=DEFAULT_MIN_FRAMES):
+        # Store the counts and the map derived from them (bit-packed); the file is replaced atomically
+
+        os.makedirs(self.libraryDir, exist_ok=True)
+        defectMap = accumulator.defect_map(minFraction, minFrames)
+
+        tmpPath = self.path(accumulator.camera) + '.tmp.npz'
+        np.savez_compressed(tmpPath, counts=accumulator.counts, frames=accumulator.frames,
+                            camera=accumulator.camera, mask=np.packbits(defectMap.mask, axis=None),
+                            minFraction=minFraction, minFrames=minFrames)
+        os.replace(tmpPath, self.path(accumulator.camera))
+
+    def accumulator(self, camera, planeShape=None):
+        # The camera's accumulator to add frames to (a new one of planeShape if there is none yet)
+
+        if not os.path.exists(self.path(camera)):
+            return None if planeShape is None else DefectAccumulator(planeShape, camera)
+
+        with np.load(self.path(camera)) as npzFile:
+            accumulator = DefectAccumulator(npzFile['counts'].shape[1:], camera)
+            accumulator.counts = npzFile['counts']
+            accumulator.frames = int(npzFile['frames'])
+
+        return accumulator
+
+    def defect_map(self, camera):
+        # The camera's precomputed DefectMap, or None
+
+        try:
+            stamp = os.stat(self.path(camera)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+        if camera not in self._maps or self._maps[camera][0] != stamp:
+            with np.load(self.path(camera)) as npzFile:
+                shape = npzFile['counts'].shape
+                mask = np.unpackbits(npzFile['mask'], count=int(np.prod(shape))).reshape(shape).astype(bool)
+                self._maps[camera] = (stamp, DefectMap(mask, camera, int(npzFile['frames'])))
+
+        return self._maps[camera][1]
+
+defectLibraries = {}  # libraryDir -> DefectLibrary, shared by the lookups of this process
+
+##############################################################################################################
+def _channel_code(channel):
+    return crdir_hits.CHANNEL_CODES[channel] if isinstance(channel, str) else channel
+
+##############################################################################################################
+def defect_map_for(rawImgPath, library=None):
+    # The DefectMap of the camera body (make, model & serial) that took a raw frame, or None
+
+    if library is None or isinstance(library, str):
+        libraryDir = DEFAULT_DEFECT_LIBRARY if library is None else library
+        library = defectLibraries.setdefault(libraryDir, DefectLibrary(libraryDir))
+
+    return library.defect_map(crdir_noise.camera_id(crdir_noise.camera_metadata(rawImgPath)))
+
+##############################################################################################################
+def learn_defects(hitList, imgDir, planeShapes, library=None, minFraction=DEFAULT_MIN_FRACTION,
+                  minFrames=DEFAULT_MIN_FRAMES, verbose=False):
+    # Add the frames of a HitList (e.g. the hits.npz of a batch run over imgDir, with planeShapes
+    # {frameName: plane shape}) to their cameras' accumulators in the library and re-derive the maps
+
+    library = DefectLibrary(library) if library is None or isinstance(library, str) else library
+
+    cameraFrames = {}
+    for frame, frameName in enumerate(hitList.frameNames):
+        camera = crdir_noise.camera_id(crdir_noise.camera_metadata(os.path.join(imgDir, frameName)))
+        cameraFrames.setdefault(camera, []).append(frame)
+
+    defectMaps = []
+    for camera, frames in sorted(cameraFrames.items()):
+        planeShape = planeShapes[hitList.frameNames[frames[0]]]
+        accumulator = library.accumulator(camera, planeShape)
+        if accumulator.counts.shape[1:] != tuple(planeShape):
+            raise ValueError("{}: frames are {}, the defect map is {}".format(camera, planeShape,
+                                                                             accumulator.counts.shape[1:]))
+
+        accumulator.add_hit_list(hitList, frames)
+        library.save(accumulator, minFraction, minFrames)
+        defectMaps.append(library.defect_map(camera))
+
+        if verbose:
+            print("{}: {} frames added, {}".format(camera, len(frames), defectMaps[-1]))
+
+    return defectMaps
+
+##############################################################################################################
+def learn_defects_from_batch(outDir, library=None, minFraction=DEFAULT_MIN_FRACTION, minFrames=DEFAULT_MIN_FRAMES,
+                             verbose=False):
+    # learn_defects from the output of crdir_batch.run_batch (hits.npz and summary.json in outDir)
+
+    with open(os.path.join(outDir, 'summary.json')) as jsonFile:
+        summary = json.load(jsonFile)
+
+    planeShapes = {frameSummary['file']: (frameSummary['height'] // 2, frameSummary['width'] // 2)
+                   for frameSummary in summary['frames'] if not frameSummary['error']}
+
+    return learn_defects(crdir_hits.HitList.load(os.path.join(outDir, 'hits.npz')), summary['run']['imgDir'],
+                         planeShapes, library=library, minFraction=minFraction, minFrames=minFrames,
+                         verbose=verbose)
@@ -0,0 +1,222 @@
+# crdir_diskcache.py
+# Persistent cache of analysis results for the Cosmic Ray Damage Image Repair (CRDIR) project
+#
+# Results (hit lists, Z-score products, rendered views, ...) are stored as .npz files of named arrays, keyed by
+# the content hash of the raw file plus the product name and every parameter the result depends on (sigma or
+# noise model, Z limit, neighbor-mean backend, border mode, ...). Changing a parameter or the file gives a new
+# key, so nothing stale is ever returned; old entries simply stop being used and age out.
+#   <cache>/<key[:2]>/<key>.npz       one entry, written to a temporary file and renamed into place (atomic, so
+#                                     pool workers and several GUI sessions can share a cache)
+#   <cache>/hashes/<path key>         content hash of a raw file, by path + modification time + size, so an
+#                                     unchanged file is hashed once, not every time it is opened
+# The cache is held under maxBytes by deleting the least recently used entries and hash index files (reading
+# one touches its modification time). Default location: $CRDIR_CACHE_DIR, else $XDG_CACHE_HOME/crdir, else ~/.cache/crdir;
+# directory_cache(imgDir) keeps the cache next to the images instead.
+
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+from crdir_planestore import write_atomic
+from crdir_rawcache import frame_key
+
+CACHE_VERSION = 1  # Bump when a cached product's computation changes, to retire every old entry
+
+DEFAULT_CACHE_DIR = os.environ.get('CRDIR_CACHE_DIR', os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'crdir'))
+DEFAULT_CACHE_MAX_BYTES = 2 * 1024 ** 3  # 2 GB
+DIRECTORY_CACHE_NAME = '.crdir_cache'
+
+HASH_CHUNK_BYTES = 1024 * 1024
+MAX_CONTENT_HASHES = 4096  # Content hashes of files remembered per DiskCache
+
+##############################################################################################################
+def file_hash(path):
+    # BLAKE2b (128-bit) hex digest of a file's content
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as hashFile:
+        for chunk in iter(lambda: hashFile.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _text_key(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=20).hexdigest()
+
+##############################################################################################################
+def param_token(value):
+    # Stable, hashable stand-in for a parameter value in a cache key. A crdir_noise.NoiseModel is identified by
+    # its camera, ISO, channel sigmas and calibration frames; numbers by their value; anything else by repr().
+
+    if hasattr(value, 'channel_sigma'):
+        return ('NoiseModel', value.camera, value.iso, sorted((channel, round(float(sigma), 6))
+                                                              for channel, sigma in value.channelSigma.items()),
+                value.frames, value.sigma_maps_hash())
+    if isinstance(value, (bool, int, float, np.integer, np.floating)):
+        return float(value) if not isinstance(value, bool) else value
+    if isinstance(value, (tuple, list)):
+        return tuple(param_token(item) for item in value)
+    return repr(value)
+
+##############################################################################################################
+class DiskCache:
+    # Content-addressed result cache in a directory (see the top of this file)
+
+    def __init__(self, cacheDir=None, maxBytes=DEFAULT_CACHE_MAX_BYTES, verbose=False):
+        self.cacheDir = DEFAULT_CACHE_DIR if cacheDir is None else cacheDir
+        self.maxBytes = maxBytes
+        self.verbose = verbose
+
+        self._lock = threading.Lock()
+        self._bytes = None  # Running estimate of the cache size (None: not scanned yet)
+        self._contentHashes = {}  # frame_key (path, mtime_ns, size) -> content hash, for this instance
+
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def path(self, key):
+        return os.path.join(self.cacheDir, key[0:2], key + '.npz')
+
+    def content_hash(self, rawImgPath):
+        # Content hash of a file, from the hash index if the file has not changed since it was last hashed
+        key = frame_key(rawImgPath)
+        contentHash = self._contentHashes.get(key)
+        if contentHash is not None:
+            return contentHash
+
+        indexPath = os.path.join(self.cacheDir, 'hashes', _text_key(repr(key)))
+        try:
+            with open(indexPath) as indexFile:
+                contentHash = indexFile.read().strip()
+            os.utime(indexPath)  # Recently used
+        except OSError:
+            contentHash = file_hash(key[0])
+            write_atomic(indexPath, lambda tmpFile: tmpFile.write(contentHash.encode('ascii')))
+
+        with self._lock:
+            if len(self._contentHashes) >= MAX_CONTENT_HASHES:  # Forget the oldest
+                del self._contentHashes[next(iter(self._contentHashes))]
+            self._contentHashes[key] = contentHash
+        return contentHash
+
+    def key(self, rawImgPath, product, **params):
+        # Cache key of a product of a raw file computed with params
+        return _text_key(repr((CACHE_VERSION, self.content_hash(rawImgPath), product,
+                               sorted((name, param_token(value)) for name, value in params.items()))))
+
+    def get(self, key):
+        # {name: array} stored under key, or None
+
+        try:
+            with np.load(self.path(key)) as npzFile:
+                arrays = {name: npzFile[name] for name in npzFile.files}
+        except (OSError, ValueError, KeyError):  # Missing, or removed / truncated by another process meanwhile
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(self.path(key))  # Recently used
+        except OSError:
+            pass
+        self.hits += 1
+        return arrays
+
+    def put(self, key, arrays):
+        # Store {name: array} under key (atomically replacing any entry), then keep the cache within maxBytes
+
+        entryPath = self.path(key)
+        try:
+            replacedBytes = os.path.getsize(entryPath)
+        except OSError:
+            replacedBytes = 0
+        write_atomic(entryPath, lambda tmpFile: np.savez(tmpFile, **arrays))
+
+        with self._lock:
+            if self._bytes is not None:
+                self._bytes += os.path.getsize(entryPath) - replacedBytes
+            if self._bytes is None or self._bytes > self.maxBytes:
+                self.trim()
+
+    def get_or_compute(self, rawImgPath, product, compute, **params):
+        # The stored {name: array} for a product of a raw file, or compute() (returning such a dict), stored
+
+        key = self.key(rawImgPath, product, **params)
+        arrays = self.get(key)
+        if arrays is None:
+            arrays = compute()
+            self.put(key, arrays)
+        elif self.verbose:
+            print("DiskCache: {} of {} from the cache".format(product, os.path.basename(rawImgPath)))
+        return arrays
+
+    def get_hit_list(self, key):
+        # A crdir_hits.HitList stored with put_hit_list (plus any extra arrays stored with it), or (None, None)
+        import crdir_hits
+
+        arrays = self.get(key)
+        if arrays is None:
+            return None, None
+        return crdir_hits.HitList.from_arrays(arrays), arrays
+
+    def put_hit_list(self, key, hitList, **extraArrays):
+        self.put(key, dict(hitList.arrays(), **extraArrays))
+
+    def entries(self):
+        # [(modification time, bytes, path)] of every entry and hash index file
+        hashesDir = os.path.join(self.cacheDir, 'hashes')
+        entries = []
+        for dirPath, dirNames, fileNames in os.walk(self.cacheDir):
+            for fileName in fileNames:
+                if (fileName.endswith('.npz') or dirPath == hashesDir) and '.tmp' not in fileName:
+                    try:
+                        fileStat = os.stat(os.path.join(dirPath, fileName))
+                    except OSError:
+                        continue
+                    entries.append((fileStat.st_mtime_ns, fileStat.st_size, os.path.join(dirPath, fileName)))
+        return entries
+
+    def nbytes(self):
+        return sum(size for mtime, size, entryPath in self.entries())
+
+    def trim(self, maxBytes=None):
+        # Delete least recently used entries (and hash index files: a deleted one only means hashing that file
+        # again) until the cache is within maxBytes (default self.maxBytes)
+
+        maxBytes = self.maxBytes if maxBytes is None else maxBytes
+        entries = sorted(self.entries())
+        totalBytes = sum(size for mtime, size, entryPath in entries)
+
+        for mtime, size, entryPath in entries:
+            if totalBytes <= maxBytes:
+                break
+            try:
+                os.remove(entryPath)
+            except OSError:
+                continue
+            totalBytes -= size
+            if self.verbose:
+                print("DiskCache: evicted {}".format(os.path.basename(entryPath)))
+
+        self._bytes = totalBytes
+        return totalBytes
+
+    def clear(self):
+        self.trim(maxBytes=0)
+
+##############################################################################################################
+diskCaches = {}  # cacheDir -> DiskCache, shared by the lookups of this process
+
+def disk_cache(cacheDir=None):
+    # The process's DiskCache for cacheDir (default DEFAULT_CACHE_DIR); a DiskCache is passed through
+    if isinstance(cacheDir, DiskCache):
+        return cacheDir
+    cacheDir = DEFAULT_CACHE_DIR if cacheDir is None else cacheDir
+    return diskCaches.setdefault(cacheDir, DiskCache(cacheDir))
+
+def directory_cache(imgDir):
+    # DiskCache kept next to the images, in <imgDir>/.crdir_cache
+    return disk_cache(os.path.join(imgDir, DIRECTORY_CACHE_NAME))
@@ -0,0 +1,135 @@
+# crdir_display.py
+# Display preparation for the Cosmic Ray Damage Image Repair (CRDIR) project
+#
+# Turns the images the detection core (crdir_funcs_v2) makes into data a GUI window can show: shrunk to fit by
+# area averaging, centered on a background, as uncompressed PPM or (with fitz) PNG. Kept out of the core so
+# batch workers never load it; fitz (PyMuPDF, ~0.4 s to import) is only imported when a PNG or a JPEG preview is
+# first decoded. crdir_funcs_v2 still answers cf.prep_img_for_display & co. by loading this module on first use.
+
+import numpy as np
+
+import crdir_instrument as instrument
+from crdir_funcs_v2 import calling_func, this_func
+
+_fitz = False  # The fitz module once load_fitz() has tried to import it (None if it is not installed)
+
+##############################################################################################################
+def load_fitz():
+    # The fitz (PyMuPDF) module, imported on first use; None if it is not installed
+    global _fitz
+
+    if _fitz is False:
+        try:
+            import fitz  # Optional: install "PyMuPDF" for fitz functionality (PNG display data, fitz_format)
+        except ImportError:
+            fitz = None
+        _fitz = fitz
+
+    return _fitz
+
+##############################################################################################################
+def fitz_format(imgIn):
+# Convert image to a fitz formated image for display:
+
+    fitz = load_fitz()
+    if fitz is None:
+        raise ImportError("fitz_format needs fitz: install PyMuPDF")
+
+    rawPixels = bytearray(np.ascontiguousarray(imgIn).tobytes())  # get plain pixel data from numpy array
+    h, w = imgIn.shape[0:2]  # So it should work with monochrome and RGB images ...
+    fitzImg = fitz.Pixmap(fitz.csRGB, w, h, rawPixels, 0)  # No alpha channel
+
+    return fitzImg
+
+##############################################################################################################
+@instrument.stage
+def area_downsample(imgIn, outHeight, outWidth):
+    # Shrink an image (H x W or H x W x C) to exactly outHeight x outWidth by area averaging: every output pixel
+    # is the mean of the input area it covers, including the fractional input pixels at its edges. Rows are
+    # done first, while the rows of the input are contiguous; returns float32.
+
+    return _area_resample(_area_resample(imgIn, outHeight, axis=0), outWidth, axis=1)
+
+def _area_resample(img, n, axis):
+    # Area-average resampling of one axis to n samples: each output sample is the sum of the whole input samples
+    # it covers (summed as vectors across the other axes; in uint16 for 8-bit images) plus its fractional edge
+    # samples, times n / length
+
+    length = img.shape[axis]
+    if length == n:
+        return img
+
+    src = np.moveaxis(img, axis, 0)
+    out = np.empty((n,) + src.shape[1:], dtype=np.float32)
+    sumType = np.uint16 if src.dtype == np.uint8 and length / n < 256 else np.float32
+    edges = np.arange(n + 1) * (length / n)
+
+    for i in range(n):
+        start, end = edges[i], min(edges[i + 1], length)
+        first, last = int(start), int(np.ceil(end)) - 1  # First & last input samples, partly covered
+        if first == last:  # Upsampling: inside one input sample
+            out[i] = src[first]
+            continue
+        out[i] = src[first + 1:last].sum(axis=0, dtype=sumType)
+        out[i] += np.float32(first + 1 - start) * src[first]
+        out[i] += np.float32(end - last) * src[last]
+
+    out *= np.float32(n / length)
+    return np.moveaxis(out, 0, axis)
+
+##############################################################################################################
+def ppm_format(imgIn):
+    # Uncompressed binary PPM (P6) of an 8-bit RGB image: a short header and the pixels as they are, which Qt
+    # (PySimpleGUIQt's Image element) loads without decoding
+
+    h, w = imgIn.shape[0:2]
+    return b'P6\n%d %d\n255\n' % (w, h) + np.ascontiguousarray(imgIn, dtype=np.uint8).tobytes()
+
+##############################################################################################################
+@instrument.stage
+def prep_img_for_display(imgIn, maxDisplayWidth=1024, maxDisplayHeight=768, imageFormat='ppm', verbose=False):
+
+    # Take as input an RGB (or grayscale) image, return display data for the GUI: the image shrunk to fit (by
+    # area averaging to the exact size that fits, not only by powers of 2), centered on a background of
+    # maxDisplayWidth x maxDisplayHeight, as uncompressed PPM (imageFormat='ppm', default) or PNG ('png',
+    # which needs fitz)
+
+    if verbose: print("type(imgIn) = {}".format(type(imgIn)))
+
+    h, w = imgIn.shape[0:2]
+    imgResizeRatio = max(h / maxDisplayHeight, w / maxDisplayWidth)
+    imgResizeLabel = ''  # Initialize to blank
+    imgOut = imgIn
+
+    if imgResizeRatio > 1.0:  # If image is too large to display without resizing: Resize the image to fit in the display
+        outHeight = min(maxDisplayHeight, max(1, int(round(h / imgResizeRatio))))
+        outWidth = min(maxDisplayWidth, max(1, int(round(w / imgResizeRatio))))
+        imgOut = area_downsample(imgIn, outHeight, outWidth)
+        imgResizeLabel = 'Resized from {}x{} to {}x{}   (1/{:0.2f})'.format(w, h, outWidth, outHeight, imgResizeRatio)
+
+    if imgIn.dtype == np.uint16:  # 16-bit render (e.g. the 'final' postprocess preset)
+        imgOut = imgOut * np.float32(255 / 65535)
+    imgOut = np.clip(np.rint(imgOut), 0, 255).astype(np.uint8) if imgOut.dtype != np.uint8 else imgOut
+    if imgOut.ndim == 2:
+        imgOut = np.dstack([imgOut] * 3)  # Grayscale to RGB
+
+    if verbose:
+        print('In |{}|,  called by |{}|'.format(this_func(), calling_func()))
+        print('img.height={} MAX_WINDOW_HEIGHT= {}'.format(imgOut.shape[0], maxDisplayHeight))
+        print('img.width={}  MAX_WINDOW_WIDTH = {}'.format(imgOut.shape[1], maxDisplayWidth))
+        print('imgResizeRatio = {}'.format(imgResizeRatio))
+        print('imgResizeLabel = {}'.format(imgResizeLabel))
+
+    # Center the image on the background
+    displayImage = np.full((maxDisplayHeight, maxDisplayWidth, 3), 225, dtype=np.uint8)  # Background color
+    y, x = (maxDisplayHeight - imgOut.shape[0]) // 2, (maxDisplayWidth - imgOut.shape[1]) // 2
+    displayImage[y:y + imgOut.shape[0], x:x + imgOut.shape[1]] = imgOut[:, :, 0:3]
+
+    if imageFormat == 'png':
+        pixMap = fitz_format(displayImage)
+        # Convert to data string in png format (getImageData was renamed tobytes in newer PyMuPDF)
+        imgData = pixMap.tobytes("png") if hasattr(pixMap, 'tobytes') else pixMap.getImageData("png")
+    else:
+        imgData = ppm_format(displayImage)
+
+    return imgData, imgResizeLabel
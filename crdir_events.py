@@ -0,0 +1,176 @@
+# crdir_events.py
+# Cosmic-ray event clustering for the Cosmic Ray Damage Image Repair (CRDIR) project
+#
+# One cosmic-ray track that crosses adjacent sensor pixels is flagged as several unrelated hits in the R, G1, G2
+# and B planes. find_events() groups the hits of a crdir_hits.HitList into events: the connected components of
+# a sparse graph joining hits of the same frame that lie within `radius` pixels of each other in the original
+# mosaic (radius 2, the default, joins hits that are mosaic neighbors or neighbors in their own Bayer plane).
+# Neighbors are found by binary search on sorted pixel keys, so the cost scales with the number of hits only.
+# An EventList holds one record per event, in columns:
+#   frame                          uint32   index into frameNames
+#   rowMin, rowMax, colMin, colMax uint16   bounding box in the mosaic (inclusive)
+#   nPixels                        uint32   number of hits
+#   peakZ                          float32  largest Z-score (by magnitude), at (peakRow, peakCol) in the mosaic
+#   energy                         float32  sum over the positive hits of Z-score x sigma (DN above the local
+#                                           mean; the negative-Z halo around a strong hit adds nothing)
+#   channels                       uint8    bit mask of the Bayer channels hit (1 << channel code)
+# plus hitEvents, the event index of each hit of the HitList, for per-event repair.
+
+import json
+
+import numpy as np
+
+import crdir_hits
+
+EVENT_COLUMNS = (('frame', np.uint32), ('rowMin', np.uint16), ('rowMax', np.uint16), ('colMin', np.uint16),
+                 ('colMax', np.uint16), ('nPixels', np.uint32), ('peakZ', np.float32), ('peakRow', np.uint16),
+                 ('peakCol', np.uint16), ('energy', np.float32), ('channels', np.uint8))
+
+DEFAULT_EVENT_RADIUS = 2
+
+##############################################################################################################
+class EventList:
+    # Columnar list of events (see the top of this file for the columns)
+
+    def __init__(self, columns=None, hitEvents=None, frameNames=None):
+        self.columns = {name: np.zeros(0, dtype=dtype) for name, dtype in EVENT_COLUMNS} if columns is None \
+            else columns
+        self.hitEvents = np.zeros(0, dtype=np.uint32) if hitEvents is None else hitEvents
+        self.frameNames = [] if frameNames is None else list(frameNames)
+
+    def __len__(self):
+        return len(self.columns['frame'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns.values())
+
+    def hits_of(self, hitList, event):
+        # The hits of one event, as a HitList
+        return hitList.select(self.hitEvents == event)
+
+    def save(self, eventsPath, compress=False):
+        members = dict(self.columns)
+        members['hitEvents'] = self.hitEvents
+        members['frameNames'] = np.array(json.dumps(self.frameNames))
+
+        (np.savez_compressed if compress else np.savez)(eventsPath, **members)
+
+    @classmethod
+    def load(cls, eventsPath):
+        with np.load(eventsPath) as npzFile:
+            return cls({name: npzFile[name] for name, dtype in EVENT_COLUMNS}, npzFile['hitEvents'],
+                       json.loads(str(npzFile['frameNames'])))
+
+##############################################################################################################
+def hit_sigmas(hitList, globalSigma=1.0):
+    # The sigma each hit's Z-score was computed with: a constant, or from a crdir_noise.NoiseModel (by channel,
+    # or per pixel from its sigma maps), or a list of either, one per frame of the HitList (frames processed with
+    # different noise models, as in a batch run with a noise library)
+
+    if isinstance(globalSigma, (list, tuple)):
+        if len(globalSigma) != len(hitList.frameNames):
+            raise ValueError("{} sigmas for the {} frames of the hit list".format(len(globalSigma),
+                                                                                len(hitList.frameNames)))
+        sigmas = np.empty(len(hitList), dtype=np.float32)
+        for frame, frameSigma in enumerate(globalSigma):
+            hits = hitList['frame'] == frame
+            if np.any(hits):
+                sigmas[hits] = hit_sigmas(hitList.select(hits), frameSigma)
+        return sigmas
+
+    if not hasattr(globalSigma, 'channel_sigma'):
+        return np.full(len(hitList), globalSigma, dtype=np.float32)
+
+    sigmas = np.empty(len(hitList), dtype=np.float32)
+    for channel, code in crdir_hits.CHANNEL_CODES.items():
+        hits = hitList['channel'] == code
+        channelSigma = globalSigma.channel_sigma(channel)
+        sigmas[hits] = channelSigma[hitList['row'][hits], hitList['col'][hits]] if np.ndim(channelSigma) == 2 \
+            else channelSigma
+
+    return sigmas
+
+##############################################################################################################
+def label_hits(hitList, radius=DEFAULT_EVENT_RADIUS):
+    # (nEvents, event index of each hit): connected components of the hits of each frame, joining hits whose
+    # mosaic positions are at most radius rows and columns apart
+
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    nHits = len(hitList)
+    if nHits == 0:
+        return 0, np.zeros(0, dtype=np.uint32)
+
+    # One sortable key per hit: frame, then mosaic row, then column (columns padded so offsets cannot wrap)
+    width = int(hitList['mosaicCol'].max()) + 2 * radius + 1
+    height = int(hitList['mosaicRow'].max()) + 2 * radius + 1
+    keys = (hitList['frame'].astype(np.int64) * height + hitList['mosaicRow'] + radius) * width \
+        + hitList['mosaicCol'] + radius
+    order = np.argsort(keys, kind='stable')
+    sortedKeys = keys[order]
+
+    # Half of the (2 radius + 1)^2 neighborhood is enough: every edge is found from one of its ends
+    offsets = [(dr, dc) for dr in range(0, radius + 1) for dc in range(-radius, radius + 1) if (dr, dc) > (0, 0)]
+
+    fromHits, toHits = [np.arange(nHits)], [np.arange(nHits)]  # Self loops: isolated hits are events too
+    for dr, dc in offsets:
+        targets = keys + dr * width + dc
+        found = np.minimum(np.searchsorted(sortedKeys, targets), nHits - 1)
+        isEdge = sortedKeys[found] == targets
+        fromHits.append(np.flatnonzero(isEdge))
+        toHits.append(order[found[isEdge]])
+
+    fromHits, toHits = np.concatenate(fromHits), np.concatenate(toHits)
+    graph = coo_matrix((np.ones(len(fromHits), dtype=np.int8), (fromHits, toHits)), shape=(nHits, nHits))
+    nEvents, labels = connected_components(graph, directed=False)
+
+    # Number the events in order of their first hit (frame, row, col) so the output does not depend on scipy
+    firstHit = np.full(nEvents, nHits, dtype=np.int64)
+    np.minimum.at(firstHit, labels[order], np.arange(nHits))
+    renumber = np.empty(nEvents, dtype=np.uint32)
+    renumber[np.argsort(firstHit)] = np.arange(nEvents, dtype=np.uint32)
+
+    return nEvents, renumber[labels]
+
+##############################################################################################################
+def find_events(hitList, radius=DEFAULT_EVENT_RADIUS, globalSigma=1.0):
+    # Group the hits of a HitList into events and summarize each one (see the top of this file); globalSigma is
+    # what the Z-scores were computed with (see hit_sigmas)
+
+    nEvents, hitEvents = label_hits(hitList, radius)
+    if nEvents == 0:
+        return EventList(frameNames=hitList.frameNames)
+
+    order = np.argsort(hitEvents, kind='stable')
+    starts = np.flatnonzero(np.r_[True, np.diff(hitEvents[order]) != 0])  # First hit of each event in order
+
+    def per_event(ufunc, name):
+        return ufunc.reduceat(hitList[name][order], starts)
+
+    z = hitList['z'][order]
+    absZ = np.abs(z)
+    peakHits = order[starts + _argmax_per_group(absZ, starts)]
+
+    columns = {'frame': hitList['frame'][order[starts]],
+               'rowMin': per_event(np.minimum, 'mosaicRow'), 'rowMax': per_event(np.maximum, 'mosaicRow'),
+               'colMin': per_event(np.minimum, 'mosaicCol'), 'colMax': per_event(np.maximum, 'mosaicCol'),
+               'nPixels': np.diff(np.r_[starts, len(order)]),
+               'peakZ': hitList['z'][peakHits],
+               'peakRow': hitList['mosaicRow'][peakHits], 'peakCol': hitList['mosaicCol'][peakHits],
+               'energy': np.add.reduceat(np.where(z > 0, z, 0) * hit_sigmas(hitList, globalSigma)[order], starts),
+               'channels': np.bitwise_or.reduceat(np.left_shift(1, hitList['channel'][order]).astype(np.uint8),
+                                                  starts)}
+
+    return EventList({name: columns[name].astype(dtype, copy=False) for name, dtype in EVENT_COLUMNS}, hitEvents,
+                     hitList.frameNames)
+
+def _argmax_per_group(values, starts):
+    # Offset within each group (values split at starts) of the group's largest value
+
+    groups = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(values)]))
+    byValue = np.lexsort((-values, groups))  # Each group's largest value first
+    return byValue[starts] - starts
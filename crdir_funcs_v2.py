@@ -3,64 +3,125 @@
 
 # Support routines for Cosmic Ray Damage Image Repair (CRDIR) project
 import os
+import sys
 import numpy as np
-import inspect
-import fitz  # Install "PyMuPDF", to get fitz functionality!
-import rawpy
-from scipy import signal
+
+import crdir_filters as filters
+import crdir_instrument as instrument
+from crdir_jobs import raise_if_cancelled
+from crdir_rawcache import rawCache
+
+# Display preparation moved to crdir_display, which is only imported (with fitz) when one of these is first used
+DISPLAY_NAMES = ('fitz_format', 'area_downsample', 'ppm_format', 'prep_img_for_display')
+
+def __getattr__(name):
+    # cf.prep_img_for_display etc. (see DISPLAY_NAMES), and cf.fitz (the module, or None if not installed)
+    if name in DISPLAY_NAMES or name == 'fitz':
+        import crdir_display
+        return crdir_display.load_fitz() if name == 'fitz' else getattr(crdir_display, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 ##############################################################################################################
 def this_func():
-    # return the name of the current function
-    return inspect.stack()[1][3]
+    # return the name of the current function (one frame lookup, not a walk of the whole stack)
+    return sys._getframe(1).f_code.co_name
 
 ##############################################################################################################
 def calling_func():
-    # return the name of the calling function
-    return inspect.stack()[2][3]
+    # return the name of the calling function (past any crdir_instrument stage wrapper)
+    frame = sys._getframe(2)
+    while frame.f_back is not None and frame.f_globals.get('__name__') == instrument.__name__:
+        frame = frame.f_back
+    return frame.f_code.co_name
+
+##############################################################################################################
+
+BAYER_COLOR_NAMES = ('R', 'G1', 'B', 'G2')  # rawpy color index -> name: 0 = R, 1 = G1, 2 = B, 3 = G2
+
+##############################################################################################################
+
+def bayer_pattern(rawImage, visibleOnly=True):
+    # Return the 2x2 CFA pattern (rawpy color indices, 0 = R, 1 = G1, 2 = B, 3 = G2) at the top-left corner of
+    # the raw image (visibleOnly=False) or of its visible area, i.e. without the masked sensor borders
+    # (visibleOnly=True). Read once from rawpy's raw_pattern, so no image-size color array is ever built.
+    # Works for RGGB, BGGR, GRBG & GBRG sensors; returns None for non-Bayer (X-Trans, Foveon, ...) images.
+
+    rawPattern = rawImage.raw_pattern  # pattern relative to the full raw image (including margins)
+
+    if rawPattern is None or rawPattern.shape[0] % 2 or rawPattern.shape[1] % 2:
+        return None
+
+    pattern = np.array(rawPattern[0:2, 0:2])
+    if not np.array_equal(np.tile(pattern, (rawPattern.shape[0] // 2, rawPattern.shape[1] // 2)), rawPattern):
+        return None  # Not 2x2 periodic
+
+    if visibleOnly:  # Shift the pattern to the first visible pixel
+        topMargin, leftMargin = rawImage.sizes.top_margin, rawImage.sizes.left_margin
+        pattern = np.roll(pattern, (-(topMargin % 2), -(leftMargin % 2)), axis=(0, 1))
+
+    if sorted(pattern.ravel()) == [0, 1, 1, 2]:  # Both greens reported as 1: the one on the R row is G1
+        greens = np.argwhere(pattern == 1)
+        redRow = np.argwhere(pattern == 0)[0][0]
+        g2Row, g2Col = greens[0] if greens[0][0] != redRow else greens[1]
+        pattern[g2Row, g2Col] = 3
+
+    if sorted(pattern.ravel()) != [0, 1, 2, 3]:
+        return None
+
+    return pattern
 
 ##############################################################################################################
-def fitz_format(imgIn):
-# Convert image to a fitz formated image for display:
 
-    rawPixels = bytearray(imgIn.tostring())  # get plain pixel data from numpy array
-    h, w = imgIn.shape[0:2]  # So it should work with monochrome and RGB images ...
-    fitzImg = fitz.Pixmap(fitz.csRGB, w, h, rawPixels)
+def bayer_offsets(pattern):
+    # Return {'R': (row, col), 'G1': ..., 'G2': ..., 'B': ...}: where each color sits in the 2x2 pattern,
+    # i.e. plane[r, c] of that color is mosaic[2*r + row, 2*c + col]
 
-    return fitzImg
+    return {BAYER_COLOR_NAMES[pattern[row, col]]: (int(row), int(col)) for row in range(2) for col in range(2)}
 
 ##############################################################################################################
 
-def extract_from_raw(rawImage, verbose=False):
+@instrument.stage
+def extract_from_raw(rawImage, visibleOnly=True, stacked=False, verbose=False):
+
+    # Split the raw (RG1BG2) mosaic into its R, G1, G2, & B planes (1/4 size each) without masks or copies:
+    # the 2x2 CFA pattern is read once, and each plane is a strided view (RG1BG2Image[0::2, 0::2] etc.) of the
+    # mosaic. With visibleOnly, the masked sensor borders are dropped and the pattern is aligned to the visible
+    # area; an odd last row / column is dropped so the four planes are the same size.
+    # With stacked=True, return (RG1BG2Image, planes) where planes is one (4, H/2, W/2) R, G1, G2, B array
+    # (this one is a copy, but contiguous, for batched processing of all four planes).
+    # NOTE: the views are only valid while the rawpy image they came from is open!
+
+    pattern = bayer_pattern(rawImage, visibleOnly=visibleOnly)
 
-    RG1BG2Image = rawImage.raw_image   # image-size array (before demosaicing)
-    BayerArray = rawImage.raw_colors  # image-size array with 0 = R, 1 = G1, 2 = B, 3 = G2
+    if pattern is None:
+        print('\n ************* In |{}|, called by |{}|: ************* '.format(this_func(), calling_func()))
+        print("Error: {} requires a Bayer (2x2 CFA) raw image, but raw_pattern = \n{}"
+              .format(this_func(), rawImage.raw_pattern))
+
+        return None
 
-    Rimage  = RG1BG2Image[BayerArray == 0]  # extract the R  pixels from the RG1BG2 image (1/4 size)
-    G1image = RG1BG2Image[BayerArray == 1]  # extract the G1 pixels from the RG1BG2 image (1/4 size)
-    Bimage  = RG1BG2Image[BayerArray == 2]  # extract the B  pixels from the RG1BG2 image (1/4 size)
-    G2image = RG1BG2Image[BayerArray == 3]  # extract the G2 pixels from the RG1BG2 image (1/4 size)
+    RG1BG2Image = rawImage.raw_image_visible if visibleOnly else rawImage.raw_image  # (before demosaicing)
 
     h, w = RG1BG2Image.shape[0:2]  # get height and width of original image
+    RG1BG2Image = RG1BG2Image[0:h - h % 2, 0:w - w % 2]  # view; whole 2x2 cells only
 
-    nColsReshape, nRowsReshape = int(w / 2), int(h / 2)
-    Rimage  = np.reshape(Rimage,  (-1, nColsReshape))
-    G1image = np.reshape(G1image, (-1, nColsReshape))
-    G2image = np.reshape(G2image, (-1, nColsReshape))
-    Bimage  = np.reshape(Bimage,  (-1, nColsReshape))
+    offsets = bayer_offsets(pattern)
+    Rimage  = RG1BG2Image[offsets['R'][0]::2,  offsets['R'][1]::2]   # the R  pixels from the RG1BG2 image (1/4 size)
+    G1image = RG1BG2Image[offsets['G1'][0]::2, offsets['G1'][1]::2]  # the G1 pixels from the RG1BG2 image (1/4 size)
+    G2image = RG1BG2Image[offsets['G2'][0]::2, offsets['G2'][1]::2]  # the G2 pixels from the RG1BG2 image (1/4 size)
+    Bimage  = RG1BG2Image[offsets['B'][0]::2,  offsets['B'][1]::2]   # the B  pixels from the RG1BG2 image (1/4 size)
 
     if verbose:
         print('\n ************* In |{}|, called by |{}|: ************* '.format(this_func(), calling_func()))
-        print('BayerArray.shape = {}'.format(BayerArray.shape))
+        print('Bayer pattern = {} {}'.format(''.join(BAYER_COLOR_NAMES[c] for c in pattern.ravel()), offsets))
         print('RGBGimage.shape = {}'.format(RG1BG2Image.shape))
         print('type(Rimage) = {}'.format(type(Rimage)))
 
-        print('Rimage.shape  AFTER reshaping = {}'.format(Rimage.shape))
-        print('G1image.shape AFTER reshaping = {}'.format(G1image.shape))
-        print('G2image.shape AFTER reshaping = {}'.format(G2image.shape))
-        print('Bimage.shape  AFTER reshaping = {}'.format(Bimage.shape))
+        print('Rimage.shape  = {}'.format(Rimage.shape))
+        print('G1image.shape = {}'.format(G1image.shape))
+        print('G2image.shape = {}'.format(G2image.shape))
+        print('Bimage.shape  = {}'.format(Bimage.shape))
 
-        print("BayerArray[0:12,0:12] = \n{}".format(BayerArray[0:12,0:12]))
         print("RGBGimage[0:12,0:12] = \n{}".format(RG1BG2Image[0:12,0:12]))
 
         print("Rimage[0:6,0:6]  = \n{}".format(Rimage[0:6,0:6]))
@@ -71,14 +132,23 @@ def extract_from_raw(rawImage, verbose=False):
     if verbose:
             print('\n ************* Returning to |{}| from |{}|. ************* \n'.format(calling_func(), this_func()))
 
+    if stacked:
+        return RG1BG2Image, np.stack([Rimage, G1image, G2image, Bimage])
+
     return RG1BG2Image, Rimage, G1image, G2image, Bimage
 
 ##############################################################################################################
 
-def calculate_eight_neighbor_mean(grayscaleImg, verbose=False):
+@instrument.stage
+def calculate_eight_neighbor_mean(grayscaleImg, backend=None, mode=None, dtype=np.float32, verbose=False):
 
-    # Return an image in which each pixel value is the mean of the 'surrounding' eight pixels. Treat the borders as '0'
-    # and return an image the same size as the original (mode='same'). [Calculated via convolution with 'ring' kernel]
+    # Return an image in which each pixel value is the mean of the 'surrounding' eight pixels, the same size as
+    # the original. Calculated by the crdir_filters neighbor-mean engine:
+    #   backend = 'boxsum' (default; integer box sum minus center), 'cumsum', 'uniform' (scipy.ndimage), or
+    #             'convolve' (the original float64 convolution with a 'ring' kernel)
+    #   mode    = border handling: 'reflect' (default), 'nearest', 'mirror', 'wrap', or 'constant' (treat the
+    #             borders as '0', as the original did - which makes every edge pixel look like a hit)
+    #   dtype   = np.float32 (default), np.float64, or np.int32
 
     imgDim = len(grayscaleImg.shape)  # Dimensionality of image; want 2D (grayscale), not 3D (color)
 
@@ -88,11 +158,7 @@ def calculate_eight_neighbor_mean(grayscaleImg, verbose=False):
 
         return None
 
-    eightNeighborKernel = np.array([[1, 1, 1],
-                                    [1, 0, 1],
-                                    [1, 1, 1]]) / 8
-
-    EightNeighborMeanImg = signal.convolve2d(grayscaleImg, eightNeighborKernel, mode='same')
+    EightNeighborMeanImg = filters.neighbor_mean(grayscaleImg, size=3, backend=backend, mode=mode, dtype=dtype)
 
     if verbose:
         print('\n ************* In |{}|, called by |{}|: ************* '.format(this_func(), calling_func()))
@@ -105,10 +171,12 @@ def calculate_eight_neighbor_mean(grayscaleImg, verbose=False):
 
 ##############################################################################################################
 
-def calculate_median_image(grayscaleImg, medianFilterSize=3, verbose=False):
+@instrument.stage
+def calculate_median_image(grayscaleImg, medianFilterSize=3, backend=None, mode=None, verbose=False):
 
     # Return an image in which each pixel value is the median of the 'surrounding' pixels based on a filter size
-    # of medianFilterSize (default = 3x3).
+    # of medianFilterSize (default = 3x3). Integer (uint16) raw planes stay integer. backend / mode: see
+    # crdir_filters.median_filter ('network' for 3x3, else 'partition'; 'medfilt2d' is the original method).
 
     imgDim = len(grayscaleImg.shape)  # Dimensionality of image; want 2D (grayscale), not 3D (color)
 
@@ -118,54 +186,77 @@ def calculate_median_image(grayscaleImg, medianFilterSize=3, verbose=False):
 
         return None
 
-    kernel_size = medianFilterSize
-
-    medianFilteredImg = signal.medfilt2d(grayscaleImg, kernel_size = medianFilterSize)
+    medianFilteredImg = filters.median_filter(grayscaleImg, size=medianFilterSize, backend=backend, mode=mode)
 
     if verbose:
         print('\n ************* In |{}|, called by |{}|: ************* '.format(this_func(), calling_func()))
-        print("medianFilterSize[0:9,0:9] = \n{}".format(medianFilterSize[0:9,0:9]))
+        print("medianFilteredImg[0:9,0:9] = \n{}".format(medianFilteredImg[0:9,0:9]))
 
     if verbose:
             print('\n ************* Returning to |{}| from |{}|. ************* \n'.format(calling_func(), this_func()))
 
     return medianFilteredImg
 
+##############################################################################################################
+
+@instrument.stage
+def calculate_median_images(stackedPlanes, medianFilterSize=3, backend=None, mode=None, verbose=False):
+
+    # Median filter a (4, H/2, W/2) stack of Bayer planes (see extract_from_raw(..., stacked=True)) in one
+    # batched call; same filter sizes, backends and border modes as calculate_median_image.
+
+    if stackedPlanes.ndim != 3:
+        print('\n ************* In |{}|, called by |{}|: ************* '.format(this_func(), calling_func()))
+        print("Error: {} requires a stack of planes (3D), but received a {}D image"
+              .format(this_func(), stackedPlanes.ndim))
+
+        return None
+
+    medianFilteredPlanes = filters.median_filter(stackedPlanes, size=medianFilterSize, backend=backend, mode=mode)
+
+    if verbose:
+        print('\n ************* In |{}|, called by |{}|: ************* '.format(this_func(), calling_func()))
+        print("medianFilteredPlanes[:, 0:6, 0:6] = \n{}".format(medianFilteredPlanes[:, 0:6, 0:6]))
+
+    return medianFilteredPlanes
 
 ##############################################################################################################
 
-def calculate_eight_neighbor_mean_images_from_raw(rawImage, verbose=False):
+@instrument.stage
+def calculate_eight_neighbor_mean_images_from_raw(rawImage, backend=None, mode=None, verbose=False):
     # Extract RG1G2B, R, G1, G2, & B from raw image, and calculate 8-neighbor mean images for each
+    # (rawImage may also be a CRDIRFrame, in which case anything it has already computed is reused)
 
-    RG1BG2image, Rimage, G1image, G2image, Bimage = extract_from_raw(rawImage, verbose=verbose)
+    frame = as_CRDIRFrame(rawImage, backend=backend, mode=mode, verbose=verbose)
 
-    RG1BG2meanImage = calculate_eight_neighbor_mean(RG1BG2image, verbose=verbose)
+    RG1BG2meanImage = frame.mean_image('RG1BG2')
 
-    RmeanImage  = calculate_eight_neighbor_mean(Rimage,  verbose=verbose)
-    G1meanImage = calculate_eight_neighbor_mean(G1image, verbose=verbose)
-    G2meanImage = calculate_eight_neighbor_mean(G2image, verbose=verbose)
-    BmeanImage  = calculate_eight_neighbor_mean(Bimage,  verbose=verbose)
+    RmeanImage  = frame.mean_image('R')
+    G1meanImage = frame.mean_image('G1')
+    G2meanImage = frame.mean_image('G2')
+    BmeanImage  = frame.mean_image('B')
 
     return RG1BG2meanImage, RmeanImage, G1meanImage, G2meanImage, BmeanImage
 
 ##############################################################################################################
 
-def calculate_Zscore_images_from_raw(rawImage, globalSigma, verbose=False):
+@instrument.stage
+def calculate_Zscore_images_from_raw(rawImage, globalSigma, backend=None, mode=None, verbose=False):
     # Extract RG1G2B, R, G1, G2, & B from raw image,
-    # calculate 8-neighbor mean images for each,
+    # calculate 8-neighbor mean images for each (backend / mode: see calculate_eight_neighbor_mean),
     # and calculate Z-scores based on those values and the passed global sigma value
+    # (or a crdir_noise.NoiseModel, e.g. from crdir_noise.noise_model_for(rawImgPath), for calibrated per-channel
+    # or per-pixel sigmas)
+    # (rawImage may also be a CRDIRFrame, in which case anything it has already computed is reused)
 
-    RG1BG2image, Rimage, G1image, G2image, Bimage = extract_from_raw(rawImage, verbose=verbose)
+    frame = as_CRDIRFrame(rawImage, backend=backend, mode=mode, verbose=verbose)
 
-    RG1BG2meanImage, RmeanImage, G1meanImage, G2meanImage, BmeanImage = \
-        calculate_eight_neighbor_mean_images_from_raw(rawImage, verbose=False)
+    RG1BG2_ZscoreImage = frame.Zscore_image('RG1BG2', globalSigma)  # how many StDevs is pixel away from its 8 nearest neighbors?
 
-    RG1BG2_ZscoreImage = (RG1BG2image - RG1BG2meanImage) / globalSigma  # how many StDevs is pixel away from its 8 nearest neighbors?
-
-    R_ZscoreImage  = (Rimage  - RmeanImage)  / globalSigma  # how many StDevs is pixel from its neighbors?
-    G1_ZscoreImage = (G1image - G1meanImage) / globalSigma  # how many StDevs is pixel from its neighbors?
-    G2_ZscoreImage = (G2image - G2meanImage) / globalSigma  # how many StDevs is pixel from its neighbors?
-    B_ZscoreImage  = (Bimage  - BmeanImage)  / globalSigma  # how many StDevs is pixel from its neighbors?
+    R_ZscoreImage  = frame.Zscore_image('R',  globalSigma)  # how many StDevs is pixel from its neighbors?
+    G1_ZscoreImage = frame.Zscore_image('G1', globalSigma)  # how many StDevs is pixel from its neighbors?
+    G2_ZscoreImage = frame.Zscore_image('G2', globalSigma)  # how many StDevs is pixel from its neighbors?
+    B_ZscoreImage  = frame.Zscore_image('B',  globalSigma)  # how many StDevs is pixel from its neighbors?
 
     if verbose:
         print("RG1BG2_ZscoreImage[0:9,0:9]  = \n{}".format(RG1BG2_ZscoreImage[0:9, 0:9]))
@@ -181,6 +272,7 @@ def calculate_Zscore_images_from_raw(rawImage, globalSigma, verbose=False):
 ##############################################################################################################
 
 
+@instrument.stage
 def find_where_Zscore_exceeds_Z_limit(ZscoreImage, ZscoreLimit, label='', verbose=False):
     # Check each pixel in Zscore image to see where it exceeds the Zscore limit passed as parameter
 
@@ -198,22 +290,279 @@ def find_where_Zscore_exceeds_Z_limit(ZscoreImage, ZscoreLimit, label='', verbos
 
 ##############################################################################################################
 
-def postprocessed_from_raw(imgDir, rawImgFname, verbose=False):
+@instrument.stage
+def calculate_local_statistic_at(grayscaleImg, exceedsZlimitArray, statistic='median', size=3, mode=None,
+                                 verbose=False):
+    # Calculate a neighborhood statistic ('median', 'mean', 'trimmed_mean', 'min', 'max', 'std' or 'mad' of the
+    # surrounding size x size - 1 pixels) only at the pixels listed in exceedsZlimitArray (as returned by
+    # find_where_Zscore_exceeds_Z_limit). The cost scales with the number of hits, not with the sensor size.
+
+    localStatistic = filters.local_statistic_at(grayscaleImg, exceedsZlimitArray, statistic=statistic, size=size,
+                                                mode=mode)
+
+    if verbose:
+        print("local {} at {} pixels [0:9] = {}".format(statistic, len(localStatistic), localStatistic[0:9]))
+
+    return localStatistic
+
+##############################################################################################################
+
+@instrument.stage
+def confirm_Zscore_exceeds_Z_limit(grayscaleImg, exceedsZlimitArray, globalSigma, ZscoreLimit, statistic='median',
+                                   size=3, mode=None, label='', verbose=False):
+    # Re-test the candidate pixels from find_where_Zscore_exceeds_Z_limit against a robust local estimate (by
+    # default the median of the 8 neighbors, which a neighboring hit cannot drag along the way it does the mean)
+    # and return only the candidates that still exceed the Zscore limit. Evaluated at the candidates only.
+    # globalSigma may also be a per-pixel sigma map of grayscaleImg's shape (see crdir_noise).
+
+    if len(exceedsZlimitArray) == 0:
+        return exceedsZlimitArray
+
+    localStatistic = filters.local_statistic_at(grayscaleImg, exceedsZlimitArray, statistic=statistic, size=size,
+                                                mode=mode)
+    pixelValues = grayscaleImg[exceedsZlimitArray[:, 0], exceedsZlimitArray[:, 1]]
+    if np.ndim(globalSigma) == 2:
+        globalSigma = globalSigma[exceedsZlimitArray[:, 0], exceedsZlimitArray[:, 1]]
+    confirmedArray = exceedsZlimitArray[np.abs(pixelValues - localStatistic) / globalSigma > ZscoreLimit]
+
+    if verbose:
+        print("{}: {} of {} candidates confirmed against the local {}"
+              .format(label, len(confirmedArray), len(exceedsZlimitArray), statistic))
+
+    return confirmedArray
+
+##############################################################################################################
+
+class CRDIRFrame:
+    # Lazily evaluated analysis of one raw frame.
+    # Bayer planes, 8-neighbor mean images, Z-score images, Z-limit masks and the 4up display images are each
+    # computed at most once, on first request, and memoized in self.products. Channels are 'R', 'G1', 'G2', 'B',
+    # or 'RG1BG2' for the full (un-split) mosaic; the full-mosaic products are only built if someone asks for them.
+    # Pass the products dict of a crdir_rawcache.RawFrame so the memoized results live (and are evicted) with the
+    # decoded frame, and switching views on the same frame costs almost nothing.
+    # backend / mode select the neighbor-mean backend and border mode (see calculate_eight_neighbor_mean); frames
+    # with different settings can safely share one products dict.
+
+    CHANNELS = ('R', 'G1', 'G2', 'B')
+
+    def __init__(self, rawImage, products=None, backend=None, mode=None, verbose=False):
+        self.rawImage = rawImage
+        self.products = {} if products is None else products
+        self.backend = filters.DEFAULT_NEIGHBOR_MEAN_BACKEND if backend is None else backend
+        self.mode = filters.DEFAULT_BORDER_MODE if mode is None else mode
+        self.verbose = verbose
+
+    def _memo(self, key, compute):
+        try:
+            return self.products[key]
+        except KeyError:
+            raise_if_cancelled()  # A cancelled GUI job (crdir_jobs) stops before its next product
+            with instrument.timed('CRDIRFrame.' + key[0]) as timer:
+                product = timer.result(compute())
+            self.products[key] = product
+            return product
+
+    def images(self):
+        # (RG1BG2image, Rimage, G1image, G2image, Bimage), exactly as returned by extract_from_raw
+        return self._memo(('images',), lambda: extract_from_raw(self.rawImage, verbose=self.verbose))
+
+    def offsets(self):
+        # {channel: (row, col)} of each color in the 2x2 Bayer cell of the extracted mosaic (see bayer_offsets)
+        return self._memo(('offsets',), lambda: bayer_offsets(bayer_pattern(self.rawImage)))
+
+    def image(self, channel):
+        # The full RG1BG2 mosaic, or one of the R, G1, G2, B Bayer planes
+        return self.images()[(('RG1BG2',) + self.CHANNELS).index(channel)]
+
+    def mean_image(self, channel):
+        return self._memo(('mean', channel, self.backend, self.mode),
+                          lambda: calculate_eight_neighbor_mean(self.image(channel), backend=self.backend,
+                                                                mode=self.mode, verbose=self.verbose))
+
+    def sigma_image(self, channel, globalSigma):
+        # globalSigma as it applies to a channel: a constant is used as is; a crdir_noise.NoiseModel gives the
+        # channel's own sigma (or per-pixel sigma map), and for the full mosaic each pixel gets its color's sigma
+        if not hasattr(globalSigma, 'channel_sigma'):
+            return globalSigma
+        if channel != 'RG1BG2':
+            return globalSigma.channel_sigma(channel)
+
+        def mosaic_sigma():
+            sigmaImage = np.empty(self.image('RG1BG2').shape, dtype=np.float32)
+            for bayerChannel, (row, col) in self.offsets().items():
+                sigmaImage[row::2, col::2] = globalSigma.channel_sigma(bayerChannel)
+            return sigmaImage
+
+        return self._memo(('sigma', channel, globalSigma), mosaic_sigma)
+
+    def Zscore_image(self, channel, globalSigma):
+        # How many StDevs is each pixel from its 8 nearest (same-color) neighbors?
+        return self._memo(('Zscore', channel, globalSigma, self.backend, self.mode),
+                          lambda: (self.image(channel) - self.mean_image(channel))
+                          / self.sigma_image(channel, globalSigma))
+
+    def exceeds_Zlimit_mask(self, channel, globalSigma, zLimit):
+        # uint8 image that is 255 ('white') everywhere the Z-score exceeds the limit, and 0 elsewhere
+        return self._memo(('mask', channel, globalSigma, zLimit, self.backend, self.mode),
+                          lambda: np.where(self.Zscore_image(channel, globalSigma) > zLimit,
+                                           np.uint8(255), np.uint8(0)))
+
+    def exceeds_Zlimit(self, channel, globalSigma, zLimit):
+        # Coordinates where |Z-score| exceeds the limit (see find_where_Zscore_exceeds_Z_limit)
+        return self._memo(('exceeds', channel, globalSigma, zLimit, self.backend, self.mode),
+                          lambda: find_where_Zscore_exceeds_Z_limit(self.Zscore_image(channel, globalSigma), zLimit,
+                                                                    'RAW' if channel == 'RG1BG2' else channel,
+                                                                    verbose=self.verbose))
+
+    def confirmed_exceeds_Zlimit(self, channel, globalSigma, zLimit, statistic='median'):
+        # The exceeds_Zlimit coordinates that still exceed the limit against a robust local statistic
+        # (see confirm_Zscore_exceeds_Z_limit); only the candidate pixels are looked at
+        return self._memo(('confirmed', channel, globalSigma, zLimit, statistic, self.backend, self.mode),
+                          lambda: confirm_Zscore_exceeds_Z_limit(self.image(channel),
+                                                                 self.exceeds_Zlimit(channel, globalSigma, zLimit),
+                                                                 self.sigma_image(channel, globalSigma), zLimit, statistic=statistic,
+                                                                 mode=self.mode, label=channel,
+                                                                 verbose=self.verbose))
+
+    def bayer4up(self):
+        # 3-color 2x2 R G1 / G2 B image of the Bayer planes
+        return self._memo(('bayer4up',),
+                          lambda: four_up_RGB([self.image(channel) for channel in self.CHANNELS]))
+
+    def Zscore4up(self, globalSigma):
+        # 3-color 2x2 R G1 / G2 B image of the Z-score images
+        return self._memo(('Zscore4up', globalSigma, self.backend, self.mode),
+                          lambda: four_up_RGB([self.Zscore_image(channel, globalSigma)
+                                               for channel in self.CHANNELS]))
+
+    def exceeds_Zlimit4up(self, globalSigma, zLimit):
+        # 3-color 2x2 R G1 / G2 B image of the Z-score > limit masks
+        return self._memo(('exceeds4up', globalSigma, zLimit, self.backend, self.mode),
+                          lambda: four_up_RGB([self.exceeds_Zlimit_mask(channel, globalSigma, zLimit)
+                                               for channel in self.CHANNELS]))
+
+##############################################################################################################
+
+def as_CRDIRFrame(rawImage, backend=None, mode=None, verbose=False):
+    # Return rawImage if it already is a CRDIRFrame (with these neighbor-mean settings), otherwise wrap it in one
+
+    if isinstance(rawImage, CRDIRFrame):
+        if backend in (None, rawImage.backend) and mode in (None, rawImage.mode):
+            return rawImage
+
+        return CRDIRFrame(rawImage.rawImage, rawImage.products, backend=backend, mode=mode, verbose=verbose)
+
+    return CRDIRFrame(rawImage, backend=backend, mode=mode, verbose=verbose)
+
+##############################################################################################################
+
+@instrument.stage
+def four_up_RGB(channelImages):
+    # Tile four channel images as 2x2 R G1 / G2 B and make a 3-color (uint8) version for display
+
+    fourUp = np.vstack([np.hstack(channelImages[0:2]), np.hstack(channelImages[2:4])]).astype(np.uint8)
+
+    return np.dstack([fourUp, fourUp, fourUp])
+
+##############################################################################################################
+
+# Named rawpy postprocess settings. 'default' is rawpy's own (AHD demosaic, 8 bits, auto-bright, full size);
+# 'preview' bins each 2x2 Bayer cell instead of demosaicing (a quarter of the pixels, several times faster);
+# 'final' is a full-quality 16-bit render in the camera's white balance. Demosaic algorithms are given by name
+# (rawpy.DemosaicAlgorithm) so this module does not need rawpy to import.
+POSTPROCESS_PRESETS = {
+    'default': {},
+    'preview': {'demosaic_algorithm': 'LINEAR', 'half_size': True, 'no_auto_bright': True},
+    'final':   {'demosaic_algorithm': 'AHD', 'output_bps': 16, 'use_camera_wb': True},
+}
+
+renderTimings = {}  # preset -> {'renders': n, 'seconds': total, 'last': seconds} of the postprocess calls made
+
+def postprocess_params(preset='default', **postprocessParams):
+    # rawpy postprocess keyword arguments of a preset, overridden / extended by postprocessParams
+
+    try:
+        params = dict(POSTPROCESS_PRESETS[preset])
+    except KeyError:
+        raise ValueError("Unknown postprocess preset '{}'; use one of {}".format(preset, list(POSTPROCESS_PRESETS)))
+    params.update(postprocessParams)
+
+    if isinstance(params.get('demosaic_algorithm'), str):
+        import rawpy
+        params['demosaic_algorithm'] = rawpy.DemosaicAlgorithm[params['demosaic_algorithm'].upper()]
+
+    return params
+
+def parse_postprocess_params(text):
+    # {name: value} from free-form text such as "bright=1.5, gamma=(2.2, 4.5) use_auto_wb=True"; values are
+    # Python literals, anything else is kept as a string (e.g. demosaic_algorithm=DHT)
+
+    import ast
+    import re
+
+    params = {}
+    for name, value in re.findall(r'(\w+)\s*=\s*(\([^)]*\)|\[[^\]]*\]|[^\s,]+)', text or ''):
+        try:
+            params[name] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            params[name] = value
+
+    return params
+
+def render_timing_summary():
+    # One line per preset: renders made and their mean / last wall time
+    return ['{:10s} {:4d} renders   mean {:6.2f} s   last {:6.2f} s'.format(preset, timing['renders'],
+                                                                            timing['seconds'] / timing['renders'],
+                                                                            timing['last'])
+            for preset, timing in sorted(renderTimings.items())]
+
+def _timed_postprocess(rawImage, preset, params, render=None):
+    # render() (default rawImage.postprocess(**params)), with its wall time added to renderTimings[preset]
+
+    import time
+
+    startTime = time.perf_counter()
+    postprocessedImage = rawImage.postprocess(**params) if render is None else render()
+    seconds = time.perf_counter() - startTime
+
+    timing = renderTimings.setdefault(preset, {'renders': 0, 'seconds': 0.0, 'last': 0.0})
+    timing['renders'] += 1
+    timing['seconds'] += seconds
+    timing['last'] = seconds
+
+    return postprocessedImage
+
+def _params_key(params):
+    # Hashable, order-independent form of postprocess keyword arguments (for the memo keys)
+    return repr(sorted(params.items()))
+
+##############################################################################################################
+
+@instrument.stage
+def postprocessed_from_raw(imgDir, rawImgFname, verbose=False, cache=None, preset='default', **postprocessParams):
+    # RGB render of a raw frame with a postprocess preset (see POSTPROCESS_PRESETS), its settings overridden by
+    # postprocessParams. Each preset / parameter set is rendered once per frame and memoized with the frame.
 
     if rawImgFname.lower().endswith('.nef'):  # If this is a raw image
 
         if verbose:
-            print("In {}, called from {}:  imgDir = {}, rawImgFname = {}"
-                  .format(this_func(), calling_func(), imgDir, rawImgFname))
+            print("In {}, called from {}:  imgDir = {}, rawImgFname = {}, preset = {}"
+                  .format(this_func(), calling_func(), imgDir, rawImgFname, preset))
 
-        # Extract rawImage
-        rawImage = rawpy.imread(os.path.join(imgDir, rawImgFname))
-        postprocessedImage = rawImage.postprocess()  # extract the RGB image
+        params = postprocess_params(preset, **postprocessParams)
+        presetName = preset if not postprocessParams else preset + '+'  # Timed separately from the plain preset
+
+        # Extract rawImage (decoded once and shared with the other views through the raw frame cache)
+        with (rawCache if cache is None else cache).frame(os.path.join(imgDir, rawImgFname)) as rawFrame:
+            postprocessedImage = CRDIRFrame(rawFrame.rawImage, rawFrame.products)._memo(
+                ('postprocessed', _params_key(params)),
+                lambda: _timed_postprocess(rawFrame.rawImage, presetName, params))  # extract the RGB image
 
         if verbose:
             print("postprocessedImage.shape = {}".format(postprocessedImage.shape))
             print("type(postprocessedImage) = {}".format(type(postprocessedImage)))
             print("type(postprocessedImage[0]) = {}".format(type(postprocessedImage[0, 0, 0])))
+            print("\n".join(render_timing_summary()))
 
         return postprocessedImage
     else:
@@ -222,17 +571,76 @@ def postprocessed_from_raw(imgDir, rawImgFname, verbose=False):
 
 ##############################################################################################################
 
-def bayer4up_from_raw(imgDir, rawImgFname, verbose=False):
+@instrument.stage
+def thumbnail_from_raw(imgDir, rawImgFname, verbose=False):
+    # RGB image of the preview embedded in a raw file (rawpy extract_thumb: the JPEG preview or the thumbnail,
+    # whichever is bigger), or None if the file has none or it cannot be decoded here (JPEG needs fitz).
+    # Only the file's headers and the embedded image are read; the raw data is not decoded.
 
-    if rawImgFname.lower().endswith('.nef'):  # If this is a raw image
+    import rawpy
+    from crdir_display import load_fitz
+
+    try:
+        with rawpy.imread(os.path.join(imgDir, rawImgFname)) as rawImage:
+            thumbnail = rawImage.extract_thumb()
+    except (rawpy.LibRawError, OSError) as error:
+        if verbose:
+            print("No usable thumbnail in {}: {}".format(rawImgFname, error))
+        return None
+
+    if thumbnail.format == rawpy.ThumbFormat.BITMAP:
+        return thumbnail.data
+    fitz = load_fitz()
+    if fitz is None:
+        return None
 
-        # Extract R, G1, B, & G2 channels from raw image
-        rawImage = rawpy.imread(os.path.join(imgDir, rawImgFname))
-        RG1BG2image, Rimage, G1image, G2image, Bimage = extract_from_raw(rawImage, verbose=verbose)
+    try:
+        pixMap = fitz.Pixmap(thumbnail.data)  # Decode the JPEG
+    except RuntimeError:
+        return None
+    if pixMap.colorspace is None or pixMap.colorspace.n != 3:
+        pixMap = fitz.Pixmap(fitz.csRGB, pixMap)
+    if pixMap.alpha:
+        pixMap = fitz.Pixmap(pixMap, 0)
 
-        # Create 4up Bayer images
-        bayer4up = np.vstack([np.hstack([Rimage, G1image]), np.hstack([G2image, Bimage])])  # make 2x2 R G1 / G2 B
-        bayer4upRGB = np.dstack([bayer4up, bayer4up, bayer4up]).astype(np.uint8)  # make a 3-color version
+    return np.frombuffer(pixMap.samples, dtype=np.uint8).reshape(pixMap.height, pixMap.width, pixMap.n)
+
+##############################################################################################################
+
+@instrument.stage
+def preview_from_raw(imgDir, rawImgFname, verbose=False):
+    # Quick stand-in for postprocessed_from_raw while the full render is made: the embedded thumbnail if there is
+    # a usable one, else the 'preview' preset render (2x2 Bayer cells binned instead of demosaiced) of the frame.
+    # Returns (RGB image, source), source being 'thumbnail' or 'half size'.
+    # The half-size render opens the file on a handle of its own rather than through the raw frame cache: the
+    # cached frame is locked for as long as a full render of it runs (see crdir_progressive), and the preview
+    # must not wait for that.
+
+    from crdir_planestore import open_raw
+
+    if not rawImgFname.lower().endswith('.nef'):
+        print("preview_from_raw requires a raw image - received {}".format(rawImgFname))
+        return None, None
+
+    thumbnailImage = thumbnail_from_raw(imgDir, rawImgFname, verbose=verbose)
+    if thumbnailImage is not None:
+        return thumbnailImage, 'thumbnail'
+
+    with open_raw(os.path.join(imgDir, rawImgFname)) as rawImage:
+        previewImage = _timed_postprocess(rawImage, 'preview', postprocess_params('preview'))
+
+    return previewImage, 'half size'
+
+##############################################################################################################
+
+@instrument.stage
+def bayer4up_from_raw(imgDir, rawImgFname, verbose=False, cache=None):
+
+    if rawImgFname.lower().endswith('.nef'):  # If this is a raw image
+
+        # Extract R, G1, B, & G2 channels from raw image and create 4up Bayer images (2x2 R G1 / G2 B, 3-color)
+        with (rawCache if cache is None else cache).frame(os.path.join(imgDir, rawImgFname)) as rawFrame:
+            bayer4upRGB = CRDIRFrame(rawFrame.rawImage, rawFrame.products, verbose=verbose).bayer4up()
 
         if verbose:
             print("bayer4upRGB.shape = {}".format(bayer4upRGB.shape))
@@ -246,21 +654,14 @@ def bayer4up_from_raw(imgDir, rawImgFname, verbose=False):
 
 ##############################################################################################################
 
-def zScore4up_from_raw(imgDir, rawImgFname, stDev, verbose=False):
+@instrument.stage
+def zScore4up_from_raw(imgDir, rawImgFname, stDev, verbose=False, cache=None):
 
     if rawImgFname.lower().endswith('.nef'):  # If this is a raw image
 
-        # Extract R, G1, B, & G2 channels from raw image
-        rawImage = rawpy.imread(os.path.join(imgDir, rawImgFname))
-
-        # Create z-score images
-        RG1BG2_ZscoreImage, R_ZscoreImage, G1_ZscoreImage, G2_ZscoreImage, B_ZscoreImage = \
-            calculate_Zscore_images_from_raw(rawImage, stDev, verbose=False)
-
-        # Create z-Score 4-up images
-        Zscore4up = np.vstack([np.hstack([R_ZscoreImage, G1_ZscoreImage]),
-                               np.hstack([G2_ZscoreImage, B_ZscoreImage])])  # make 2x2 R G1 / G2 B
-        Zscore4upRGB = np.dstack([Zscore4up, Zscore4up, Zscore4up]).astype(np.uint8)  # make a 3-color version
+        # Extract R, G1, B, & G2 channels from raw image, create z-score images and the z-Score 4-up image
+        with (rawCache if cache is None else cache).frame(os.path.join(imgDir, rawImgFname)) as rawFrame:
+            Zscore4upRGB = CRDIRFrame(rawFrame.rawImage, rawFrame.products).Zscore4up(stDev)
 
         if verbose:
             print("np.max(Zscore4upRGB) = {}".format(np.max(Zscore4upRGB)))
@@ -272,62 +673,24 @@ def zScore4up_from_raw(imgDir, rawImgFname, stDev, verbose=False):
 
 ##############################################################################################################
 
-def ZscoreExceedsZlimit4up_from_raw(imgDir, rawImgFname, stDev, zLimit, verbose=False):
+@instrument.stage
+def ZscoreExceedsZlimit4up_from_raw(imgDir, rawImgFname, stDev, zLimit, verbose=False, cache=None):
 
     if rawImgFname.lower().endswith('.nef'):  # If this is a raw image
 
-        # Extract R, G1, B, & G2 channels from raw image
-        rawImage = rawpy.imread(os.path.join(imgDir, rawImgFname))
+        # Extract R, G1, B, & G2 channels from raw image, create z-score images and the z-score over limit images
+        with (rawCache if cache is None else cache).frame(os.path.join(imgDir, rawImgFname)) as rawFrame:
+            frame = CRDIRFrame(rawFrame.rawImage, rawFrame.products, verbose=verbose)
 
-        # Create z-score images
-        RG1BG2_ZscoreImage, R_ZscoreImage, G1_ZscoreImage, G2_ZscoreImage, B_ZscoreImage = \
-            calculate_Zscore_images_from_raw(rawImage, stDev, verbose=False)
+            if verbose:  # The coordinate lists are only reported (by exceeds_Zlimit), so only find them when asked to
+                for channel in ('RG1BG2',) + frame.CHANNELS:
+                    frame.exceeds_Zlimit(channel, stDev, zLimit)
 
-        # Create z-score over limit images
-        RawImageExceedsZlimit = find_where_Zscore_exceeds_Z_limit(RG1BG2_ZscoreImage, zLimit, 'RAW',
-                                                                     verbose=verbose)
+                for channel in frame.CHANNELS:
+                    print("np.sum({}_ZscoreExceedsZlimitMask) = {}"
+                          .format(channel, np.sum(frame.exceeds_Zlimit_mask(channel, stDev, zLimit), dtype=np.int64)))
 
-        RimageExceedsZlimit  = find_where_Zscore_exceeds_Z_limit(R_ZscoreImage,  zLimit, 'R',  verbose=verbose)
-        G1imageExceedsZlimit = find_where_Zscore_exceeds_Z_limit(G1_ZscoreImage, zLimit, 'G1', verbose=verbose)
-        G2imageExceedsZlimit = find_where_Zscore_exceeds_Z_limit(G2_ZscoreImage, zLimit, 'G2', verbose=verbose)
-        BimageExceedsZlimit  = find_where_Zscore_exceeds_Z_limit(B_ZscoreImage,  zLimit, 'B',  verbose=verbose)
-
-        R_ZscoreExceedsZlimitMask  = np.zeros_like(R_ZscoreImage)  # make 'black' image the size of R_Zscore image
-        G1_ZscoreExceedsZlimitMask = np.zeros_like(G1_ZscoreImage) # make 'black' image the size of G1_Zscore image
-        B_ZscoreExceedsZlimitMask  = np.zeros_like(B_ZscoreImage)  # make 'black' image the size of B_Zscore image
-        G2_ZscoreExceedsZlimitMask = np.zeros_like(G2_ZscoreImage) # make 'black' image the size of G2_Zscore image
-
-        if verbose:
-            print("Before: np.sum(R_ZscoreExceedsZlimitMask)  = {}".format(np.sum(R_ZscoreExceedsZlimitMask)))
-            print("Before: np.sum(G1_ZscoreExceedsZlimitMask) = {}".format(np.sum(G1_ZscoreExceedsZlimitMask)))
-            print("Before: np.sum(B_ZscoreExceedsZlimitMask)  = {}".format(np.sum(B_ZscoreExceedsZlimitMask)))
-            print("Before: np.sum(G2_ZscoreExceedsZlimitMask) = {}".format(np.sum(G2_ZscoreExceedsZlimitMask)))
-
-        R_ZscoreExceedsZlimitMask = np.where(R_ZscoreImage > zLimit,  # Everywhere the Z-score exceeds the limit;
-                                             255,  # Set to 'white'
-                                             R_ZscoreExceedsZlimitMask)  # Else, keep the 0s
-        G1_ZscoreExceedsZlimitMask = np.where(G1_ZscoreImage > zLimit,  # Everywhere the Z-score exceeds the limit;
-                                             255,  # Set to 'white'
-                                             G2_ZscoreExceedsZlimitMask)  # Else, keep the 0s
-        B_ZscoreExceedsZlimitMask = np.where(B_ZscoreImage > zLimit,  # Everywhere the Z-score exceeds the limit;
-                                             255,  # Set to 'white'
-                                             B_ZscoreExceedsZlimitMask)  # Else, keep the 0s
-        G2_ZscoreExceedsZlimitMask = np.where(G2_ZscoreImage > zLimit,  # Everywhere the Z-score exceeds the limit;
-                                             255,  # Set to 'white'
-                                             G2_ZscoreExceedsZlimitMask)  # Else, keep the 0s
-
-        if verbose:
-            print("After: np.sum(R_ZscoreExceedsZlimitMask)  = {}".format(np.sum(R_ZscoreExceedsZlimitMask)))
-            print("After: np.sum(G1_ZscoreExceedsZlimitMask) = {}".format(np.sum(G1_ZscoreExceedsZlimitMask)))
-            print("After: np.sum(B_ZscoreExceedsZlimitMask)  = {}".format(np.sum(B_ZscoreExceedsZlimitMask)))
-            print("After: np.sum(G2_ZscoreExceedsZlimitMask) = {}".format(np.sum(G2_ZscoreExceedsZlimitMask)))
-            print("After: np.max(G2_ZscoreExceedsZlimitMask) = {}".format(np.max(G2_ZscoreExceedsZlimitMask)))
-
-        ZscoreExceedsZlimit4up = np.vstack([np.hstack([R_ZscoreExceedsZlimitMask, G1_ZscoreExceedsZlimitMask]),
-                                            np.hstack([G2_ZscoreExceedsZlimitMask, B_ZscoreExceedsZlimitMask])])  # make 2x2 R G1 / G2 B
-
-        ZscoreExceedsZlimit4upRGB = np.dstack(
-            [ZscoreExceedsZlimit4up, ZscoreExceedsZlimit4up, ZscoreExceedsZlimit4up]).astype(np.uint8)  # 3-color
+            ZscoreExceedsZlimit4upRGB = frame.exceeds_Zlimit4up(stDev, zLimit)  # 2x2 R G1 / G2 B, 3-color
 
         if verbose:
             print("type(ZscoreExceedsZlimit4upRGB) = {}".format(type(ZscoreExceedsZlimit4upRGB)))
@@ -339,43 +702,44 @@ def ZscoreExceedsZlimit4up_from_raw(imgDir, rawImgFname, stDev, zLimit, verbose=
         print("ZscoreExceedsZlimit4up_from_raw requires a raw image - received {}".format(rawImgFname))
         return None  # If no valid raw image received
 
-###################################################################################################################
-def prep_img_for_display(imgIn, maxDisplayWidth=1024, maxDisplayHeight=768, verbose=False):
-
-    # Take as input an RGB image, return a png formatted string for use in GUI
+##############################################################################################################
 
-    if verbose: print("type(imgIn) = {}".format(type(imgIn)))
+@instrument.stage
+def repaired_from_raw(imgDir, rawImgFname, stDev, zLimit, verbose=False, cache=None, preset='default',
+                      **postprocessParams):
+    # RGB image of the frame with every pixel whose Z-score exceeds zLimit repaired from its same-color
+    # neighbors (see crdir_repair), rendered from the already decoded frame with a postprocess preset (as in
+    # postprocessed_from_raw)
 
-    imgOut = fitz_format(imgIn)
+    import crdir_repair
 
-    pixMap = fitz.Pixmap(imgOut.colorspace, (0, 0, maxDisplayWidth, maxDisplayHeight), imgOut.alpha)  # background
-    pixMap.clearWith(225)  # Set to color
+    if rawImgFname.lower().endswith('.nef'):  # If this is a raw image
 
-    imgResizeRatio = max(imgOut.height / maxDisplayHeight, imgOut.width / maxDisplayWidth)
-    shrinkN = 0  # Initialize
-    imgResizeLabel = ''  # Initialize to blank
+        params = postprocess_params(preset, **postprocessParams)
+        presetName = preset if not postprocessParams else preset + '+'
 
-    if imgResizeRatio > 1.0:  # If image is too large to display without resizing: Resize the image to fit in the display
-        shrinkN = int(np.ceil(np.log2(imgResizeRatio)))  # 2^n power by which image will be resized by shrink()
-        imgResizeLabel = 'Resized from {}x{} by factor of {}   (2^{})'.format(imgOut.width, imgOut.height,
-                                                                              2 ** shrinkN, shrinkN)
-        imgOut.shrink(shrinkN)
+        with (rawCache if cache is None else cache).frame(os.path.join(imgDir, rawImgFname)) as rawFrame:
+            frame = CRDIRFrame(rawFrame.rawImage, rawFrame.products, verbose=verbose)
 
-    if verbose:
-        print('In |{}|,  called by |{}|'.format(this_func(), calling_func()))
-        print('img.height={} MAX_WINDOW_HEIGHT= {}'.format(imgOut.height, maxDisplayHeight))
-        print('img.width={}  MAX_WINDOW_WIDTH = {}'.format(imgOut.width, maxDisplayWidth))
-        print('imgResizeRatio = {}'.format(imgResizeRatio))
-        print('shrinkN = {}'.format(shrinkN))
-        print('imgResizeLabel = {}'.format(imgResizeLabel))
+            def render():
+                hits = {}
+                for channel in frame.CHANNELS:  # Z-scores too: only the positive hits are repaired
+                    coords = frame.exceeds_Zlimit(channel, stDev, zLimit)
+                    hits[channel] = (coords, frame.Zscore_image(channel, stDev)[coords[:, 0], coords[:, 1]])
+                repairedMosaic = crdir_repair.repair_frame(frame.rawImage, hits)
+                return _timed_postprocess(frame.rawImage, presetName, params, lambda: crdir_repair.render_repaired(
+                    frame.rawImage, repairedMosaic, hits, **params))
 
-    # Set the x,y location of img based on width (to keep it centered)
-    imgOut.x, imgOut.y = int((maxDisplayWidth - imgOut.width) / 2), int((maxDisplayHeight - imgOut.height) / 2)
-    pixMap.copyPixmap(imgOut, imgOut.irect)  # Copy the image onto the background
+            repairedImage = frame._memo(('repaired', stDev, zLimit, frame.backend, frame.mode, _params_key(params)),
+                                        render)
 
-    imgData = pixMap.getImageData("png")  # Convert to data string in png format
+        if verbose:
+            print("repairedImage.shape = {}".format(repairedImage.shape))
 
-    return imgData, imgResizeLabel
+        return repairedImage
+    else:
+        print("repaired_from_raw requires a raw image - received {}".format(rawImgFname))
+        return None  # If no valid raw image received
 
 ###################################################################################################################
 def get_img_files(refDirectoryPath, fileExtension='.jpg', verbose=False):
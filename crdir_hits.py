@@ -0,0 +1,215 @@
+# crdir_hits.py
+# Compact columnar hit lists for the Cosmic Ray Damage Image Repair (CRDIR) project
+#
+# A HitList holds one record per flagged pixel in preallocated, growable column arrays:
+#   row, col              uint16   position in the Bayer plane
+#   channel               uint8    rawpy color index: 0 = R, 1 = G1, 2 = B, 3 = G2 (see cf.BAYER_COLOR_NAMES)
+#   z                     float32  the pixel's Z-score
+#   mosaicRow, mosaicCol  uint16   position in the original (RG1BG2) mosaic
+#   frame                 uint32   index into frameNames
+# 17 bytes per hit (vs. 16 bytes for an int64 argwhere row with no z value, channel or frame).
+#
+# save() writes all columns to one .npz file: stored (the default), so load() can memory-map every column
+# straight from the file, or compressed (compress=True), which load() reads into memory.
+
+import json
+import struct
+import zipfile
+
+import numpy as np
+
+import crdir_funcs_v2 as cf
+
+HIT_COLUMNS = (('row', np.uint16), ('col', np.uint16), ('channel', np.uint8), ('z', np.float32),
+               ('mosaicRow', np.uint16), ('mosaicCol', np.uint16), ('frame', np.uint32))
+
+CHANNEL_CODES = {name: code for code, name in enumerate(cf.BAYER_COLOR_NAMES)}  # 'R' -> 0, 'G1' -> 1, ...
+
+##############################################################################################################
+class HitList:
+    # Growable columnar list of hits across channels and frames (see the top of this file for the columns)
+
+    def __init__(self, capacity=4096, frameNames=None):
+        self.columns = {name: np.empty(capacity, dtype=dtype) for name, dtype in HIT_COLUMNS}
+        self.count = 0
+        self.frameNames = [] if frameNames is None else list(frameNames)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, name):
+        # The filled part of a column (a view)
+        return self.columns[name][0:self.count]
+
+    @property
+    def capacity(self):
+        return len(self.columns['row'])
+
+    def nbytes(self):
+        return sum(self[name].nbytes for name, dtype in HIT_COLUMNS)
+
+    def _reserve(self, nMore):
+        # Make room for nMore hits, at least doubling the capacity when the columns have to grow
+
+        if self.count + nMore <= self.capacity:
+            return
+
+        newCapacity = max(2 * self.capacity, self.count + nMore, 1024)
+        for name, dtype in HIT_COLUMNS:
+            newColumn = np.empty(newCapacity, dtype=dtype)
+            newColumn[0:self.count] = self.columns[name][0:self.count]
+            self.columns[name] = newColumn
+
+    def add_frame(self, frameName):
+        # Register a frame; returns its index for the 'frame' column
+        self.frameNames.append(frameName)
+        return len(self.frameNames) - 1
+
+    def append(self, channel, coords, Zscores, offsets=(0, 0), frame=0):
+        # Append the N x 2 (row, col) plane coordinates of one channel ('R', 'G1', 'G2', 'B', or a color code)
+        # with their Z-scores; offsets is that channel's (row, col) in the 2x2 Bayer cell (see cf.bayer_offsets),
+        # used to fill in the mosaic coordinates.
+
+        coords = np.asarray(coords).reshape(-1, 2)
+        nHits = len(coords)
+        if nHits == 0:
+            return
+
+        if coords.max() * 2 + 1 > np.iinfo(np.uint16).max:
+            raise ValueError("Hit coordinates beyond {} do not fit the uint16 columns".format(np.iinfo(np.uint16).max))
+
+        self._reserve(nHits)
+        filled = slice(self.count, self.count + nHits)
+
+        self.columns['row'][filled] = coords[:, 0]
+        self.columns['col'][filled] = coords[:, 1]
+        self.columns['channel'][filled] = CHANNEL_CODES[channel] if isinstance(channel, str) else channel
+        self.columns['z'][filled] = Zscores
+        self.columns['mosaicRow'][filled] = 2 * coords[:, 0] + offsets[0]
+        self.columns['mosaicCol'][filled] = 2 * coords[:, 1] + offsets[1]
+        self.columns['frame'][filled] = frame
+
+        self.count += nHits
+
+    def extend(self, other):
+        # Append all hits of another HitList, renumbering its frames after ours
+
+        frameOffset = len(self.frameNames)
+        self.frameNames += other.frameNames
+
+        self._reserve(len(other))
+        filled = slice(self.count, self.count + len(other))
+        for name, dtype in HIT_COLUMNS:
+            self.columns[name][filled] = other[name]
+        self.columns['frame'][filled] += frameOffset
+
+        self.count += len(other)
+
+    def select(self, keep):
+        # New HitList with only the hits where the boolean array (or index array) keep selects them
+
+        selected = HitList(capacity=0, frameNames=self.frameNames)
+        selected.columns = {name: np.ascontiguousarray(self[name][keep]) for name, dtype in HIT_COLUMNS}
+        selected.count = len(selected.columns['row'])
+
+        return selected
+
+    def coords(self, channel, frame=None):
+        # N x 2 (row, col) plane coordinates of one channel (and frame), like find_where_Zscore_exceeds_Z_limit
+        keep = self['channel'] == (CHANNEL_CODES[channel] if isinstance(channel, str) else channel)
+        if frame is not None:
+            keep &= self['frame'] == frame
+
+        return np.stack([self['row'][keep], self['col'][keep]], axis=1).astype(np.intp)
+
+    def arrays(self):
+        # {member name: array}: one per column, plus the frame names as a JSON string array
+        members = {name: self[name] for name, dtype in HIT_COLUMNS}
+        members['frameNames'] = np.array(json.dumps(self.frameNames))
+        return members
+
+    @classmethod
+    def from_arrays(cls, members):
+        # HitList from a dict like the one arrays() returns (extra members are ignored)
+
+        hitList = cls(capacity=0, frameNames=json.loads(str(members['frameNames'])))
+        hitList.columns = {name: np.asarray(members[name], dtype=dtype) for name, dtype in HIT_COLUMNS}
+        hitList.count = len(hitList.columns['row'])
+
+        return hitList
+
+    def save(self, hitsPath, compress=False):
+        # One column per .npz member, plus the frame names. Stored (not compressed) files can be memory-mapped.
+        (np.savez_compressed if compress else np.savez)(hitsPath, **self.arrays())
+
+    @classmethod
+    def load(cls, hitsPath, mmapMode='r'):
+        # Load a saved HitList. Columns of stored files are memory-mapped (mmapMode=None reads them in);
+        # compressed members are always read into memory. Appending to a loaded list copies it first.
+
+        hitList = cls(capacity=0)
+
+        with zipfile.ZipFile(hitsPath) as zipFile, np.load(hitsPath) as npzFile:
+            hitList.frameNames = json.loads(str(npzFile['frameNames']))
+
+            for name, dtype in HIT_COLUMNS:
+                zipInfo = zipFile.getinfo(name + '.npy')
+                if mmapMode is not None and zipInfo.compress_type == zipfile.ZIP_STORED:
+                    hitList.columns[name] = _mmap_npz_member(hitsPath, zipInfo, mmapMode)
+                else:
+                    hitList.columns[name] = npzFile[name]
+
+        hitList.count = len(hitList.columns['row'])
+
+        return hitList
+
+##############################################################################################################
+def _mmap_npz_member(npzPath, zipInfo, mmapMode='r'):
+    # Memory-map a stored (uncompressed) .npy member of a .npz file in place
+
+    with open(npzPath, 'rb') as npzFile:
+        npzFile.seek(zipInfo.header_offset)
+        localHeader = npzFile.read(30)  # Fixed part of the zip local file header
+        nameLength, extraLength = struct.unpack('<HH', localHeader[26:30])
+        npzFile.seek(zipInfo.header_offset + 30 + nameLength + extraLength)
+
+        version = np.lib.format.read_magic(npzFile)
+        if version == (1, 0):
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(npzFile)
+        else:
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(npzFile)
+        dataOffset = npzFile.tell()
+
+    if shape[0] == 0:
+        return np.empty(shape, dtype=dtype)
+
+    return np.memmap(npzPath, dtype=dtype, mode=mmapMode, shape=shape, offset=dataOffset)
+
+##############################################################################################################
+def hits_from_frame(frame, globalSigma, zLimit, hitList=None, frameName='', channels=cf.CRDIRFrame.CHANNELS):
+    # Add the hits of a CRDIRFrame (where |Z-score| exceeds zLimit, per Bayer plane) to hitList, or a new
+    # HitList, as one frame; returns the HitList
+
+    hitList = HitList() if hitList is None else hitList
+    frameIndex = hitList.add_frame(frameName)
+    offsets = frame.offsets()
+
+    for channel in channels:
+        coords = frame.exceeds_Zlimit(channel, globalSigma, zLimit)
+        Zscores = frame.Zscore_image(channel, globalSigma)[coords[:, 0], coords[:, 1]]
+        hitList.append(channel, coords, Zscores, offsets[channel], frameIndex)
+
+    return hitList
+
+##############################################################################################################
+def hits_from_planes(channelHits, offsets, hitList=None, frameName=''):
+    # Add {channel: (coords, Zscores)} (e.g. from crdir_tiled.find_hits_tiled(..., returnZscores=True)) to
+    # hitList, or a new HitList, as one frame; returns the HitList
+
+    hitList = HitList() if hitList is None else hitList
+    frameIndex = hitList.add_frame(frameName)
+
+    for channel, (coords, Zscores) in channelHits.items():
+        hitList.append(channel, coords, Zscores, offsets[channel], frameIndex)
+
+    return hitList
@@ -0,0 +1,251 @@
+# crdir_instrument.py
+# Per-stage timing and memory instrumentation for the Cosmic Ray Damage Image Repair (CRDIR) project
+#
+# The pipeline stages (the crdir_funcs_v2 functions marked @stage, and every product CRDIRFrame computes) record
+# one StageRecord per call while instrumentation is enabled:
+#   stage, frame          stage name, and the frame being processed (set with `with frame(name):`)
+#   wall, cpu             wall time and this thread's CPU time (seconds)
+#   peakBytes             peak memory allocated during the call, over what was allocated when it started
+#                         (tracemalloc, which numpy reports its arrays to; only with enable(trackMemory=True),
+#                         since tracing every allocation slows everything down; process-wide, so only exact
+#                         while one thread is working)
+#   inBytes, outBytes     bytes of the ndarrays passed in / returned (tuples and lists of arrays are summed)
+#   shape                 shape of the returned array (of the first one, for a tuple or list)
+# Stages nest (a Z-score product computes a mean image, which calls calculate_eight_neighbor_mean), and every
+# record is inclusive of the stages inside it. Records are kept per process; summary() aggregates them per stage
+# (over the run, or per frame), and save() writes them as JSON (records + summaries) or CSV (one row per record).
+# Disabled (the default), a decorated call costs one global lookup before calling straight through.
+#
+# Usage:  crdir_instrument.enable(trackMemory=True)       (or set CRDIR_INSTRUMENT=1, or CRDIR_INSTRUMENT=memory)
+#         with crdir_instrument.frame('DSC_0001.NEF'): ...
+#         crdir_instrument.save('instrument.json')
+#         python crdir.py batch <dir> --instrument [--instrument-memory]
+
+import csv
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+_enabled = False
+_trackMemory = False
+
+_lock = threading.Lock()
+_records = []
+_local = threading.local()  # frame: current frame name; stack: open Timers of this thread
+
+STAGE_FIELDS = ('stage', 'frame', 'wall', 'cpu', 'peakBytes', 'inBytes', 'outBytes', 'shape')
+
+##############################################################################################################
+def enable(trackMemory=False):
+    # Start recording (with peak memory if trackMemory)
+    global _enabled, _trackMemory
+
+    _trackMemory = trackMemory
+    if trackMemory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _enabled = True
+
+def disable():
+    global _enabled, _trackMemory
+
+    _enabled = False
+    if _trackMemory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _trackMemory = False
+
+def enabled():
+    return _enabled
+
+if os.environ.get('CRDIR_INSTRUMENT'):
+    enable(trackMemory=os.environ['CRDIR_INSTRUMENT'].lower() == 'memory')
+
+##############################################################################################################
+def nbytes(value):
+    # Bytes of an ndarray, or of the ndarrays in a tuple / list (0 for anything else)
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(item.nbytes for item in value if isinstance(item, np.ndarray))
+    return 0
+
+def _shape(value):
+    if isinstance(value, (tuple, list)):
+        value = next((item for item in value if isinstance(item, np.ndarray)), None)
+    return list(value.shape) if isinstance(value, np.ndarray) else None
+
+##############################################################################################################
+class Timer:
+    # Context manager recording one StageRecord for the code it wraps (a no-op while disabled). Call
+    # result(value) inside the block to record the size of what it made.
+
+    def __init__(self, name, inBytes=0):
+        self.name = name
+        self.inBytes = inBytes
+        self.outValue = None
+        self.active = False
+
+    def result(self, value):
+        self.outValue = value
+        return value
+
+    def __enter__(self):
+        self.active = _enabled
+        if not self.active:
+            return self
+
+        self.stack = _local.__dict__.setdefault('stack', [])
+        self.memoryBase = None
+        if _trackMemory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if self.stack:  # The peak so far belongs to the enclosing stage
+                self.stack[-1].peakSeen = max(self.stack[-1].peakSeen, peak)
+            tracemalloc.reset_peak()
+            self.memoryBase = current
+        self.peakSeen = 0
+        self.stack.append(self)
+
+        self.cpuStart = time.thread_time()
+        self.wallStart = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if not self.active:
+            return False
+
+        wall = time.perf_counter() - self.wallStart
+        cpu = time.thread_time() - self.cpuStart
+
+        self.stack.pop()
+        peakBytes = None
+        if self.memoryBase is not None and tracemalloc.is_tracing():
+            peak = max(self.peakSeen, tracemalloc.get_traced_memory()[1])
+            peakBytes = max(0, peak - self.memoryBase)
+            if self.stack:
+                self.stack[-1].peakSeen = max(self.stack[-1].peakSeen, peak)
+
+        record = {'stage': self.name, 'frame': getattr(_local, 'frame', ''), 'wall': wall, 'cpu': cpu,
+                  'peakBytes': peakBytes, 'inBytes': self.inBytes, 'outBytes': nbytes(self.outValue),
+                  'shape': _shape(self.outValue)}
+        with _lock:
+            _records.append(record)
+
+        return False
+
+def timed(name, inBytes=0):
+    # `with timed('stage name') as timer: ... timer.result(array)`
+    return Timer(name, inBytes)
+
+def stage(func=None, name=None):
+    # Decorator recording a StageRecord per call of func (named after it unless name is given); `@stage` or
+    # `@stage(name='...')`
+
+    if func is None:
+        return functools.partial(stage, name=name)
+
+    stageName = func.__name__ if name is None else name
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return func(*args, **kwargs)
+
+        with Timer(stageName, nbytes(args) + nbytes(list(kwargs.values()))) as timer:
+            return timer.result(func(*args, **kwargs))
+
+    return wrapper
+
+##############################################################################################################
+class frame:
+    # `with frame(name):` attributes the stages run in this thread meanwhile to a frame
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'frame', '')
+        _local.frame = self.name
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        _local.frame = self.previous
+        return False
+
+##############################################################################################################
+def records():
+    with _lock:
+        return list(_records)
+
+def take_records():
+    # The records so far, which are then forgotten (e.g. to send a pool worker's records to its parent)
+    with _lock:
+        taken = list(_records)
+        _records.clear()
+    return taken
+
+def add_records(newRecords):
+    with _lock:
+        _records.extend(newRecords)
+
+def reset():
+    with _lock:
+        _records.clear()
+
+##############################################################################################################
+def summary(stageRecords=None, byFrame=False):
+    # {stage: {'calls', 'wall', 'cpu', 'meanWall', 'maxWall', 'peakBytes', 'outBytes'}} totals over the records
+    # (default: all of them), or {frame: {stage: ...}} with byFrame
+
+    stageRecords = records() if stageRecords is None else stageRecords
+
+    if byFrame:
+        frames = {}
+        for record in stageRecords:
+            frames.setdefault(record['frame'], []).append(record)
+        return {frameName: summary(frameRecords) for frameName, frameRecords in frames.items()}
+
+    stages = {}
+    for record in stageRecords:
+        totals = stages.setdefault(record['stage'], {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'maxWall': 0.0,
+                                                     'peakBytes': None, 'outBytes': 0})
+        totals['calls'] += 1
+        totals['wall'] += record['wall']
+        totals['cpu'] += record['cpu']
+        totals['maxWall'] = max(totals['maxWall'], record['wall'])
+        totals['outBytes'] += record['outBytes']
+        if record['peakBytes'] is not None:
+            totals['peakBytes'] = max(totals['peakBytes'] or 0, record['peakBytes'])
+
+    for totals in stages.values():
+        totals['meanWall'] = totals['wall'] / totals['calls']
+
+    return stages
+
+def summary_lines(stageRecords=None):
+    # One line per stage, slowest (in all) first
+    lines = []
+    for name, totals in sorted(summary(stageRecords).items(), key=lambda item: -item[1]['wall']):
+        peak = '' if totals['peakBytes'] is None else '   peak {:8.1f} MB'.format(totals['peakBytes'] / 2**20)
+        lines.append('{:40s} {:6d} calls   {:9.3f} s wall   {:9.3f} s cpu   mean {:8.2f} ms{}'.format(
+            name, totals['calls'], totals['wall'], totals['cpu'], 1000 * totals['meanWall'], peak))
+    return lines
+
+def save(path, stageRecords=None):
+    # Write the records as CSV (path ending in .csv: one row per record) or JSON (records, and summaries per run
+    # and per frame)
+
+    stageRecords = records() if stageRecords is None else stageRecords
+
+    if path.lower().endswith('.csv'):
+        with open(path, 'w', newline='') as csvFile:
+            writer = csv.DictWriter(csvFile, fieldnames=STAGE_FIELDS)
+            writer.writeheader()
+            writer.writerows(dict(record, shape='x'.join(map(str, record['shape'] or []))) for record in stageRecords)
+    else:
+        with open(path, 'w') as jsonFile:
+            json.dump({'run': summary(stageRecords), 'frames': summary(stageRecords, byFrame=True),
+                       'records': stageRecords}, jsonFile, indent=2)
@@ -0,0 +1,174 @@
+# crdir_jobs.py
+# Cancellable background jobs for the Cosmic Ray Damage Image Repair (CRDIR) project
+#
+# The GUI hands slow work (decoding, Z-scoring, rendering a view) to a JobRunner and keeps reading events; each
+# job gets an integer ID the event loop polls for. Submitting a job with a tag cancels the older jobs with the
+# same tag, so when the user scrolls past frames only the latest request runs to the end:
+#   - a job that has not started yet is dropped from the queue;
+#   - a running job is told to stop, and stops at its next cancellation point: raise_if_cancelled(), which
+#     CRDIRFrame calls before computing each memoized product (Bayer planes, mean, Z-score, ... images).
+# A single rawpy call (e.g. postprocess) cannot be interrupted; its result is discarded instead.
+
+import itertools
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+DEFAULT_JOB_WORKERS = 1  # The GUI only ever wants the latest view; one worker keeps the frame lock uncontended
+
+_local = threading.local()  # The job running in this thread, if any
+
+##############################################################################################################
+class JobCancelled(Exception):
+    # Raised at a cancellation point of a job that has been cancelled
+    pass
+
+def current_job():
+    # The Job running in this thread, or None outside a JobRunner
+    return getattr(_local, 'job', None)
+
+def raise_if_cancelled():
+    # Cancellation point: raise JobCancelled if this thread is running a job that has been cancelled (costs a
+    # thread-local lookup, so it may be called often)
+
+    job = getattr(_local, 'job', None)
+    if job is not None and job.cancelEvent.is_set():
+        raise JobCancelled("Job {} ({}) cancelled".format(job.id, job.tag))
+
+##############################################################################################################
+class Job:
+    # One submitted call: ID, tag, timings and the Future of its result
+
+    def __init__(self, jobId, tag, func, args, kwargs):
+        self.id = jobId
+        self.tag = tag
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelEvent = threading.Event()
+        self.future = None
+        self.submitTime = time.perf_counter()
+        self.startTime = None
+        self.endTime = None
+
+    def status(self):
+        # 'queued', 'running', 'done', 'failed' or 'cancelled'
+        if self.future.cancelled() or (self.cancelEvent.is_set() and self.future.done()):
+            return 'cancelled'
+        if not self.future.done():
+            return 'running' if self.startTime is not None else 'queued'
+        return 'failed' if self.future.exception() is not None else 'done'
+
+    def seconds(self):
+        # Run time so far (or in all, once finished)
+        if self.startTime is None:
+            return 0.0
+        return (self.endTime or time.perf_counter()) - self.startTime
+
+    def __repr__(self):
+        return "Job({}, {!r}, {})".format(self.id, self.tag, self.status())
+
+##############################################################################################################
+class JobRunner:
+    # Thread pool running Jobs, with IDs and cancellation (see the top of this file)
+
+    def __init__(self, workers=DEFAULT_JOB_WORKERS, verbose=False):
+        self.verbose = verbose
+
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='crdir-job')
+        self._lock = threading.Lock()
+        self._jobs = {}  # jobId -> Job, until forgotten (see forget)
+        self._ids = itertools.count(1)
+
+    def submit(self, func, *args, tag=None, **kwargs):
+        # Run func(*args, **kwargs) in the background; returns the job ID. Older jobs with the same tag (if not
+        # None) are cancelled.
+
+        with self._lock:
+            job = Job(next(self._ids), tag, func, args, kwargs)
+            if tag is not None:
+                for otherJob in list(self._jobs.values()):
+                    if otherJob.tag == tag:
+                        self._cancel(otherJob)
+            self._jobs[job.id] = job
+            job.future = self._pool.submit(self._run, job)
+
+        if self.verbose:
+            print("JobRunner: submitted {}".format(job))
+        return job.id
+
+    def cancel(self, jobId):
+        # Cancel one job; True unless it had already finished
+        with self._lock:
+            job = self._jobs.get(jobId)
+            return job is not None and self._cancel(job)
+
+    def cancel_all(self, tag=None):
+        # Cancel every job (with tag, if given)
+        with self._lock:
+            for job in list(self._jobs.values()):
+                if tag is None or job.tag == tag:
+                    self._cancel(job)
+
+    def job(self, jobId):
+        with self._lock:
+            return self._jobs.get(jobId)
+
+    def status(self, jobId):
+        job = self.job(jobId)
+        return 'unknown' if job is None else job.status()
+
+    def done(self, jobId):
+        # Has the job finished (in any way), or been dropped after it was cancelled?
+        return self.status(jobId) not in ('queued', 'running')
+
+    def result(self, jobId, timeout=None):
+        # The job's return value (waiting up to timeout seconds); raises its exception, or JobCancelled
+
+        job = self.job(jobId)
+        if job is None:
+            raise KeyError("No job {}".format(jobId))
+        try:
+            result = job.future.result(timeout)
+        except CancelledError:
+            raise JobCancelled("Job {} ({}) cancelled".format(job.id, job.tag))
+        if job.cancelEvent.is_set():
+            raise JobCancelled("Job {} ({}) cancelled".format(job.id, job.tag))
+        return result
+
+    def forget(self, jobId):
+        # Drop a finished job (and the reference to its result)
+        with self._lock:
+            job = self._jobs.get(jobId)
+            if job is not None and job.future.done():
+                del self._jobs[jobId]
+
+    def shutdown(self):
+        self.cancel_all()
+        self._pool.shutdown(wait=False)
+
+    def _cancel(self, job):
+        # (with self._lock held)
+        if job.future is None or job.future.done():
+            return False
+        job.cancelEvent.set()
+        if job.future.cancel():  # Only succeeds if it has not started; a running job is dropped when it stops
+            del self._jobs[job.id]
+        return True
+
+    def _run(self, job):
+        job.startTime = time.perf_counter()
+        _local.job = job
+        try:
+            raise_if_cancelled()
+            return job.func(*job.args, **job.kwargs)
+        except JobCancelled:
+            if self.verbose:
+                print("JobRunner: {} stopped after {:0.2f} s".format(job, time.perf_counter() - job.startTime))
+            raise
+        finally:
+            _local.job = None
+            job.endTime = time.perf_counter()
+            with self._lock:  # Finished jobs that were superseded are of no further interest
+                if job.cancelEvent.is_set():
+                    self._jobs.pop(job.id, None)
@@ -0,0 +1,430 @@
+# crdir_noise.py
+# Per-sensor noise models for the Cosmic Ray Damage Image Repair (CRDIR) project
+#
+# A Z-score divides each pixel's difference from its neighbor mean by a sigma. Rather than one assumed constant
+# for every camera, channel and ISO, calibrate() streams a set of dark (or flat) frames once and measures the
+# spread of exactly that difference, per Bayer channel and optionally per pixel, with running (Welford / Chan)
+# statistics over bands of bounded memory. The NoiseModels are kept in a NoiseLibrary directory on disk:
+#   library.json                      {camera: {iso: {'R': sigma, 'G1': ..., 'frames': n, 'sigmaMap': file}}}
+#   <camera>_ISO<iso>.sigma.npz       optional per-pixel sigma maps (float32, one per channel)
+# and looked up by camera (make, model & serial number, read from the raw file's TIFF / EXIF tags) and ISO.
+#
+# Usage:  python crdir.py calibrate <dir of dark frames> [--sigma-map] [--library DIR]
+#         model = crdir_noise.noise_model_for(rawImgPath, default=75)  # then use model wherever a sigma goes
+
+import functools
+import hashlib
+import json
+import os
+import re
+import struct
+
+import numpy as np
+
+import crdir_funcs_v2 as cf
+import crdir_tiled as tiled
+from crdir_planestore import open_raw
+from crdir_rawcache import frame_key
+
+try:
+    import exifread  # Optional: reads the EXIF of raw formats that are not TIFF based
+except ImportError:
+    exifread = None
+
+DEFAULT_NOISE_LIBRARY = os.environ.get('CRDIR_NOISE_LIBRARY',
+                                       os.path.join(os.path.expanduser('~'), '.crdir', 'noise'))
+
+CLIP_SIGMA = 5  # Residuals beyond this many (robust) sigmas are hits or defects, not noise, and are left out
+
+# TIFF tags read for the camera metadata (IFD0 and the EXIF IFD)
+TIFF_TAGS = {0x010f: 'make', 0x0110: 'model', 0x8769: 'exifIFD', 0x8827: 'iso', 0xa431: 'serial',
+             0xc62f: 'serial'}  # 0xc62f: DNG CameraSerialNumber
+TIFF_TYPES = {1: 'B', 2: 's', 3: 'H', 4: 'I', 7: 'B', 9: 'i'}  # Type code -> struct format (rationals not needed)
+
+##############################################################################################################
+def _read_ifd(tiffFile, byteOrder, ifdOffset):
+    # {name: value} of the TIFF_TAGS in one image file directory
+
+    tiffFile.seek(ifdOffset)
+    nEntries, = struct.unpack(byteOrder + 'H', tiffFile.read(2))
+    entries = tiffFile.read(12 * nEntries)
+
+    tags = {}
+    for entry in range(nEntries):
+        tag, tagType, count = struct.unpack(byteOrder + 'HHI', entries[12 * entry:12 * entry + 8])
+        if tag not in TIFF_TAGS or tagType not in TIFF_TYPES:
+            continue
+
+        valueFormat = '{}{}{}'.format(byteOrder, count, TIFF_TYPES[tagType])
+        valueBytes = entries[12 * entry + 8:12 * entry + 12]
+        if struct.calcsize(valueFormat) > 4:  # Value stored elsewhere; these 4 bytes are its offset
+            position = tiffFile.tell()
+            tiffFile.seek(struct.unpack(byteOrder + 'I', valueBytes)[0])
+            valueBytes = tiffFile.read(struct.calcsize(valueFormat))
+            tiffFile.seek(position)
+
+        value = struct.unpack(valueFormat, valueBytes[0:struct.calcsize(valueFormat)])
+        tags[TIFF_TAGS[tag]] = value[0].split(b'\0')[0].decode('ascii', 'replace').strip() if tagType == 2 \
+            else value[0]
+
+    return tags
+
+##############################################################################################################
+def read_tiff_metadata(rawImgPath):
+    # make, model, serial & iso from the TIFF / EXIF tags of a TIFF-based raw file (NEF, DNG, ...);
+    # raises ValueError if the file is not TIFF based
+
+    with open(rawImgPath, 'rb') as tiffFile:
+        header = tiffFile.read(8)
+        if header[0:4] not in (b'II*\0', b'MM\0*'):
+            raise ValueError("{} is not a TIFF-based raw file".format(rawImgPath))
+
+        byteOrder = '<' if header[0:2] == b'II' else '>'
+        tags = _read_ifd(tiffFile, byteOrder, struct.unpack(byteOrder + 'I', header[4:8])[0])
+        if 'exifIFD' in tags:
+            tags.update(_read_ifd(tiffFile, byteOrder, tags.pop('exifIFD')))
+
+    return tags
+
+##############################################################################################################
+def read_exifread_metadata(rawImgPath):
+    # make, model, serial & iso with exifread (if it is installed)
+
+    if exifread is None:
+        return {}
+
+    with open(rawImgPath, 'rb') as rawFile:
+        exifTags = exifread.process_file(rawFile, details=False)
+
+    names = {'Image Make': 'make', 'Image Model': 'model', 'EXIF BodySerialNumber': 'serial',
+             'MakerNote SerialNumber': 'serial', 'EXIF ISOSpeedRatings': 'iso'}
+    tags = {name: str(exifTags[exifName]).strip() for exifName, name in names.items() if exifName in exifTags}
+    if 'iso' in tags:
+        tags['iso'] = int(tags['iso'].split(',')[0].strip('[] '))
+
+    return tags
+
+##############################################################################################################
+@functools.lru_cache(maxsize=256)
+def _camera_metadata(key):
+    # camera_metadata for one frame_key (the files are only read once per version of a file)
+
+    metadata = {'make': None, 'model': None, 'serial': None, 'iso': None}
+
+    try:
+        metadata.update(read_tiff_metadata(key[0]))
+    except (OSError, ValueError, struct.error):
+        try:
+            metadata.update(read_exifread_metadata(key[0]))
+        except (OSError, ValueError):
+            pass
+
+    return metadata
+
+def camera_metadata(rawImgPath, rawImage=None):
+    # {'make', 'model', 'serial', 'iso'} of a raw file (None where unknown). Only the file header is read;
+    # if the tags have no ISO, rawImage (an open rawpy handle, if given) is asked for it.
+
+    metadata = dict(_camera_metadata(frame_key(rawImgPath)))
+
+    if metadata['iso'] is None and rawImage is not None:
+        metadata['iso'] = getattr(getattr(rawImage, 'other', None), 'iso_speed', None) or None
+
+    if metadata['iso'] is not None:
+        metadata['iso'] = int(round(float(metadata['iso'])))
+
+    return metadata
+
+##############################################################################################################
+def camera_id(metadata, withSerial=True):
+    # Library key for a camera: 'make model', plus ' #serial' to tell bodies of the same model apart
+
+    camera = ' '.join(word for word in (metadata.get('make'), metadata.get('model')) if word) or 'unknown camera'
+    if withSerial and metadata.get('serial'):
+        camera += ' #{}'.format(metadata['serial'])
+
+    return camera
+
+##############################################################################################################
+class RunningStats:
+    # Count, mean and sum of squared deviations of a stream of values, merged a batch at a time
+    # (Chan et al.'s parallel form of Welford's algorithm)
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.M2 = 0.0
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return
+
+        n, mean = len(values), values.mean()
+        M2 = np.square(values - mean).sum()
+
+        delta = mean - self.mean
+        total = self.n + n
+        self.mean += delta * n / total
+        self.M2 += M2 + delta * delta * self.n * n / total
+        self.n = total
+
+    @property
+    def variance(self):
+        return self.M2 / (self.n - 1) if self.n > 1 else 0.0
+
+    @property
+    def std(self):
+        return float(np.sqrt(self.variance))
+
+##############################################################################################################
+class RunningStatsMap:
+    # Per-pixel running mean and variance across frames (Welford), updated one band of rows at a time;
+    # pixels where keep is False in a frame are left out of that frame
+
+    def __init__(self, shape):
+        self.n = np.zeros(shape, dtype=np.uint16)
+        self.mean = np.zeros(shape, dtype=np.float32)
+        self.M2 = np.zeros(shape, dtype=np.float32)
+
+    def add_band(self, firstRow, values, keep):
+        rows = slice(firstRow, firstRow + len(values))
+        n, mean, M2 = self.n[rows], self.mean[rows], self.M2[rows]  # Views: updated in place
+
+        n += keep
+        delta = np.where(keep, values - mean, 0)
+        mean += delta / np.maximum(n, 1)
+        M2 += delta * (values - mean)
+
+    def std(self, fallback=0.0):
+        # Per-pixel standard deviation; fallback where a pixel was kept in fewer than 2 frames
+        return np.where(self.n >= 2, np.sqrt(self.M2 / np.maximum(self.n.astype(np.float32) - 1, 1)),
+                        np.float32(fallback)).astype(np.float32)
+
+##############################################################################################################
+class NoiseModel:
+    # Sigma of (pixel - neighbor mean) for one camera at one ISO: per channel, and optionally per pixel.
+    # Pass a NoiseModel wherever a global sigma goes (CRDIRFrame, calculate_Zscore_images_from_raw, the
+    # *_from_raw view functions, crdir_tiled); each channel is then divided by its own sigma (map).
+
+    def __init__(self, camera, iso, channelSigma, frames=0, sigmaMaps=None):
+        self.camera = camera
+        self.iso = iso
+        self.channelSigma = dict(channelSigma)  # {'R': sigma, 'G1': ..., 'G2': ..., 'B': ...}
+        self.frames = frames
+        self.sigmaMaps = sigmaMaps  # {'R': H/2 x W/2 float32 sigma map, ...} or None
+        self._sigmaMapsHash = None
+
+    def sigma_maps_hash(self):
+        # Hex digest of the sigma maps' content (None without sigma maps); computed once per model
+        if self.sigmaMaps is not None and self._sigmaMapsHash is None:
+            digest = hashlib.blake2b(digest_size=16)
+            for channel in sorted(self.sigmaMaps):
+                sigmaMap = np.ascontiguousarray(self.sigmaMaps[channel])
+                digest.update('{} {} {}'.format(channel, sigmaMap.dtype, sigmaMap.shape).encode('ascii'))
+                digest.update(sigmaMap.data)
+            self._sigmaMapsHash = digest.hexdigest()
+        return self._sigmaMapsHash
+
+    def channel_sigma(self, channel):
+        # The channel's sigma map if the model has one, otherwise its (scalar) sigma
+        if self.sigmaMaps is not None and channel in self.sigmaMaps:
+            return self.sigmaMaps[channel]
+        return self.channelSigma[channel]
+
+    def __repr__(self):
+        return "NoiseModel({!r}, ISO {}, {}{})".format(
+            self.camera, self.iso, ', '.join('{} {:0.1f}'.format(channel, sigma)
+                                             for channel, sigma in self.channelSigma.items()),
+            ', sigma maps' if self.sigmaMaps is not None else '')
+
+##############################################################################################################
+class NoiseLibrary:
+    # NoiseModels on disk (see the top of this file), by camera and ISO. The index is re-read only when
+    # library.json changes, and each model (with its sigma maps) is loaded once, so lookups are cheap.
+
+    def __init__(self, libraryDir=None):
+        self.libraryDir = DEFAULT_NOISE_LIBRARY if libraryDir is None else libraryDir
+        self.indexPath = os.path.join(self.libraryDir, 'library.json')
+        self._index = {}
+        self._indexStamp = None
+        self._models = {}
+
+    def index(self):
+        # {camera: {iso (str): entry}}, as in library.json
+
+        try:
+            stamp = os.stat(self.indexPath).st_mtime_ns
+        except FileNotFoundError:
+            return {}
+
+        if stamp != self._indexStamp:
+            with open(self.indexPath) as indexFile:
+                self._index = json.load(indexFile)
+            self._indexStamp = stamp
+            self._models = {}
+
+        return self._index
+
+    def save(self, model):
+        # Add (or replace) a model; the index is rewritten atomically
+
+        os.makedirs(self.libraryDir, exist_ok=True)
+        index = dict(self.index())
+
+        entry = {channel: float(sigma) for channel, sigma in model.channelSigma.items()}
+        entry.update({'frames': model.frames, 'sigmaMap': None})
+
+        if model.sigmaMaps is not None:
+            entry['sigmaMap'] = '{}_ISO{}.sigma.npz'.format(re.sub(r'[^\w.-]+', '_', model.camera), model.iso)
+            np.savez(os.path.join(self.libraryDir, entry['sigmaMap']), **model.sigmaMaps)
+
+        index.setdefault(model.camera, {})[str(model.iso)] = entry
+
+        tmpPath = self.indexPath + '.tmp'
+        with open(tmpPath, 'w') as indexFile:
+            json.dump(index, indexFile, indent=2, sort_keys=True)
+        os.replace(tmpPath, self.indexPath)
+
+    def load(self, camera, iso, sigmaMap=True):
+        # The model calibrated for exactly this camera and ISO (or None)
+
+        entry = self.index().get(camera, {}).get(str(iso))
+        if entry is None:
+            return None
+
+        key = (camera, str(iso), sigmaMap)
+        if key not in self._models:
+            sigmaMaps = None
+            if sigmaMap and entry.get('sigmaMap'):
+                with np.load(os.path.join(self.libraryDir, entry['sigmaMap'])) as npzFile:
+                    sigmaMaps = {channel: npzFile[channel] for channel in npzFile.files}
+
+            self._models[key] = NoiseModel(camera, int(iso),
+                                           {channel: entry[channel] for channel in cf.CRDIRFrame.CHANNELS},
+                                           frames=entry['frames'], sigmaMaps=sigmaMaps)
+
+        return self._models[key]
+
+    def lookup(self, metadata, sigmaMap=True):
+        # Best model for a camera_metadata dict: this body if it was calibrated, otherwise another body of the
+        # same make & model; the calibrated ISO nearest (in stops) to the frame's ISO. None if there is none, or
+        # if the frame's ISO is unknown (noise depends on it too much to guess one).
+
+        if not metadata.get('iso'):
+            return None
+
+        index = self.index()
+        sameModel = [camera for camera in sorted(index)
+                     if camera.split(' #')[0] == camera_id(metadata, withSerial=False)]
+
+        for camera in [camera_id(metadata)] + sameModel:
+            isos = [int(iso) for iso in index.get(camera, {})]
+            if not isos:
+                continue
+
+            iso = min(isos, key=lambda iso: abs(np.log2(iso / metadata['iso'])))
+
+            # Per-pixel maps belong to one sensor, so another body only lends its per-channel sigmas
+            return self.load(camera, iso, sigmaMap=sigmaMap and camera == camera_id(metadata))
+
+        return None
+
+noiseLibraries = {}  # libraryDir -> NoiseLibrary, shared by the lookups of this process
+
+##############################################################################################################
+def noise_model_for(rawImgPath, rawImage=None, default=None, library=None, sigmaMap=True):
+    # The NoiseModel for a raw frame (by camera & ISO), or default (e.g. the old constant STDEV) if the library
+    # has none for this camera. Cheap enough to call per frame: reads the file header once, the library once.
+
+    if library is None or isinstance(library, str):
+        libraryDir = DEFAULT_NOISE_LIBRARY if library is None else library
+        library = noiseLibraries.setdefault(libraryDir, NoiseLibrary(libraryDir))
+
+    model = library.lookup(camera_metadata(rawImgPath, rawImage), sigmaMap=sigmaMap)
+
+    return default if model is None else model
+
+##############################################################################################################
+def calibrate_frames(rawImgPaths, camera, iso, sigmaMap=False, clipSigma=CLIP_SIGMA, size=3, backend=None,
+                     mode=None, memoryBudget=None, verbose=False):
+    # NoiseModel from dark / flat frames of one camera at one ISO. Each frame is read once and each Bayer plane
+    # is processed in bands (crdir_tiled), so memory stays within memoryBudget (plus the sigma maps, if asked for).
+
+    channelStats = {channel: RunningStats() for channel in cf.CRDIRFrame.CHANNELS}
+    pixelStats = {}
+
+    for rawImgPath in rawImgPaths:
+        with open_raw(rawImgPath) as rawImage:
+            planes = dict(zip(('RG1BG2',) + cf.CRDIRFrame.CHANNELS, cf.extract_from_raw(rawImage)))
+
+            for channel in cf.CRDIRFrame.CHANNELS:
+                plane = planes[channel]
+
+                # Robust sigma of the frame (MAD of a subsample) sets the clip level for hits & hot pixels
+                sample = _residual_sample(plane, size, backend, mode, memoryBudget)
+                clipLevel = clipSigma * 1.4826 * np.median(np.abs(sample - np.median(sample)))
+
+                if sigmaMap and channel not in pixelStats:
+                    pixelStats[channel] = RunningStatsMap(plane.shape)
+
+                bandRows = tiled.band_rows_for_budget(plane.shape[1], memoryBudget, size=size)
+                for firstRow, endRow in tiled.iter_bands(plane.shape[0], bandRows):
+                    residual = plane[firstRow:endRow] - tiled.neighbor_mean_band(plane, firstRow, endRow, size=size,
+                                                                                 backend=backend, mode=mode)
+                    keep = np.abs(residual) <= clipLevel if clipLevel > 0 else np.ones(residual.shape, dtype=bool)
+
+                    channelStats[channel].add(residual[keep])
+                    if sigmaMap:
+                        pixelStats[channel].add_band(firstRow, residual, keep)
+
+        if verbose:
+            print("{}: {}".format(os.path.basename(rawImgPath), ', '.join(
+                '{} {:0.2f}'.format(channel, stats.std) for channel, stats in channelStats.items())))
+
+    channelSigma = {channel: stats.std for channel, stats in channelStats.items()}
+    sigmaMaps = {channel: stats.std(fallback=channelSigma[channel]) for channel, stats in pixelStats.items()}
+
+    return NoiseModel(camera, iso, channelSigma, frames=len(rawImgPaths), sigmaMaps=sigmaMaps if sigmaMap else None)
+
+def _residual_sample(plane, size, backend, mode, memoryBudget=None, step=7):
+    # (pixel - neighbor mean) at every step-th row & column of a plane, a band at a time
+
+    bandRows = tiled.band_rows_for_budget(plane.shape[1], memoryBudget, size=size)
+    bandRows = max(step, bandRows - bandRows % step)
+    samples = []
+    for firstRow, endRow in tiled.iter_bands(plane.shape[0], bandRows):
+        meanBand = tiled.neighbor_mean_band(plane, firstRow, endRow, size=size, backend=backend, mode=mode)
+        samples.append((plane[firstRow:endRow] - meanBand)[0::step, 0::step].ravel())
+
+    return np.concatenate(samples)
+
+##############################################################################################################
+def calibrate(rawImgPaths, library=None, sigmaMap=False, clipSigma=CLIP_SIGMA, memoryBudget=None, verbose=False):
+    # Group dark / flat frames by camera & ISO, calibrate a NoiseModel for each group and save it to the library
+    # (a NoiseLibrary or its directory); returns the models
+
+    library = NoiseLibrary(library) if library is None or isinstance(library, str) else library
+
+    groups = {}
+    for rawImgPath in rawImgPaths:
+        metadata = camera_metadata(rawImgPath)
+        if metadata['iso'] is None:
+            with open_raw(rawImgPath) as rawImage:
+                metadata = camera_metadata(rawImgPath, rawImage)
+        groups.setdefault((camera_id(metadata), metadata['iso'] or 0), []).append(rawImgPath)
+
+    models = []
+    for (camera, iso), groupPaths in sorted(groups.items()):
+        if verbose:
+            print("Calibrating {} at ISO {} from {} frames".format(camera, iso, len(groupPaths)))
+
+        model = calibrate_frames(groupPaths, camera, iso, sigmaMap=sigmaMap, clipSigma=clipSigma,
+                                 memoryBudget=memoryBudget, verbose=verbose)
+        library.save(model)
+        models.append(model)
+
+        if verbose:
+            print("  {}".format(model))
+
+    return models
@@ -0,0 +1,236 @@
+# crdir_planestore.py
+# Memory-mapped store of ingested raw frames for the Cosmic Ray Damage Image Repair (CRDIR) project
+#
+# Decoding a NEF with LibRaw costs far more than any analysis pass over it. ingest() decodes each frame once and
+# writes its raw mosaic and metadata next to the images:
+#   <imgDir>/.crdir_planes/<file name>.npy    the raw mosaic (uint16, with margins, as rawpy's raw_image)
+#   <imgDir>/.crdir_planes/<file name>.json   CFA pattern, sizes / margins, black & white levels, white balance,
+#                                             camera (make, model, serial, ISO), and the source file's mtime & size
+# The four Bayer planes are not stored separately: they are strided views of the mosaic (cf.extract_from_raw),
+# so storing the mosaic keeps every plane zero-copy. A StoredFrame memory-maps the .npy and answers the rawpy
+# attributes the CRDIR routines read (raw_image, raw_image_visible, raw_pattern, sizes, ...), so it can be handed
+# to any of them in place of an open rawpy image. open_raw() - used by the raw frame cache, and so by the batch,
+# temporal, GUI and calibration code - returns the StoredFrame of a file if it has been ingested and has not
+# changed since, and only falls back to LibRaw otherwise.
+# The mosaic is mapped copy-on-write: writes (e.g. crdir_repair.render_repaired) stay in memory, and the store is
+# never modified. postprocess() needs LibRaw: it opens the original file and demosaics this frame's mosaic.
+#
+# Usage:  python crdir.py ingest <dir> [--ext .nef] [--force] [--quiet]
+#         with crdir_planestore.open_raw(rawImgPath) as rawImage: ...  # StoredFrame, or a rawpy image
+
+import json
+import os
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+
+STORE_VERSION = 1
+PLANE_STORE_NAME = '.crdir_planes'
+
+##############################################################################################################
+def store_paths(rawImgPath, storeDir=None):
+    # (.npy path, .json path) of a raw file in the plane store (default <dir of the file>/.crdir_planes)
+
+    storeDir = os.path.join(os.path.dirname(os.path.abspath(rawImgPath)), PLANE_STORE_NAME) if storeDir is None \
+        else storeDir
+    storedPath = os.path.join(storeDir, os.path.basename(rawImgPath))
+
+    return storedPath + '.npy', storedPath + '.json'
+
+def _sizes_dict(sizes):
+    # rawpy's ImageSizes (a namedtuple) as a plain dict
+    return dict(sizes._asdict()) if hasattr(sizes, '_asdict') else dict(vars(sizes))
+
+def _json_value(value):
+    # numpy scalars / arrays and bytes as JSON values
+    if isinstance(value, bytes):
+        return value.decode('ascii', 'replace')
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (np.integer, np.floating)):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_json_value(item) for item in value]
+    return value
+
+##############################################################################################################
+def ingest_frame(rawImgPath, storeDir=None, force=False):
+    # Decode one raw file and write its mosaic and metadata to the plane store, unless it is there and current
+    # (or force); returns the .npy path
+    import rawpy
+
+    import crdir_noise
+
+    npyPath, jsonPath = store_paths(rawImgPath, storeDir)
+    if not force and is_stored(rawImgPath, storeDir):
+        return npyPath
+
+    fileStat = os.stat(rawImgPath)
+    with rawpy.imread(rawImgPath) as rawImage:
+        rawMosaic = rawImage.raw_image
+        metadata = {'version': STORE_VERSION, 'source': os.path.basename(rawImgPath),
+                    'mtime_ns': fileStat.st_mtime_ns, 'size': fileStat.st_size,
+                    'shape': list(rawMosaic.shape), 'dtype': str(rawMosaic.dtype),
+                    'raw_pattern': _json_value(rawImage.raw_pattern),
+                    'sizes': {name: _json_value(value) for name, value in _sizes_dict(rawImage.sizes).items()},
+                    'camera': crdir_noise.camera_metadata(rawImgPath, rawImage)}
+        for name in ('black_level_per_channel', 'white_level', 'camera_whitebalance', 'daylight_whitebalance',
+                     'color_desc', 'num_colors'):
+            try:
+                metadata[name] = _json_value(getattr(rawImage, name))
+            except (AttributeError, rawpy.LibRawError):
+                pass
+
+        write_atomic(npyPath, lambda tmpFile: np.save(tmpFile, rawMosaic))
+
+    write_atomic(jsonPath, lambda tmpFile: tmpFile.write(json.dumps(metadata, indent=2).encode('utf-8')))
+
+    return npyPath
+
+def ingest(rawImgPaths, storeDir=None, force=False, verbose=False):
+    # ingest_frame every file; returns the number ingested (files already in the store and current are skipped)
+
+    nIngested = 0
+    for n, rawImgPath in enumerate(rawImgPaths):
+        if not force and is_stored(rawImgPath, storeDir):
+            status = 'already stored'
+        else:
+            ingest_frame(rawImgPath, storeDir, force=True)
+            nIngested += 1
+            status = 'ingested'
+
+        if verbose:
+            print("[{}/{}] {}: {}".format(n + 1, len(rawImgPaths), os.path.basename(rawImgPath), status))
+
+    return nIngested
+
+def write_atomic(path, write):
+    # write(file) to a temporary file next to path, then rename it into place (also used by crdir_diskcache)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmpPath = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmpPath, 'wb') as tmpFile:
+            write(tmpFile)
+        os.replace(tmpPath, path)
+    except BaseException:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
+
+##############################################################################################################
+class StoredFrame:
+    # An ingested frame, memory-mapped, standing in for an open rawpy image (see the top of this file)
+
+    def __init__(self, npyPath, metadata, sourcePath=None):
+        self.npyPath = npyPath
+        self.metadata = metadata
+        self.sourcePath = sourcePath
+
+        self.raw_image = np.load(npyPath, mmap_mode='c')  # Copy-on-write: no read until used, no write-back
+        self.raw_pattern = None if metadata['raw_pattern'] is None else np.array(metadata['raw_pattern'],
+                                                                                  dtype=np.uint8)
+        self.sizes = SimpleNamespace(**metadata['sizes'])
+        self.black_level_per_channel = metadata.get('black_level_per_channel')
+        self.white_level = metadata.get('white_level')
+        self.camera_whitebalance = metadata.get('camera_whitebalance')
+        self.daylight_whitebalance = metadata.get('daylight_whitebalance')
+        self.color_desc = metadata.get('color_desc', '').encode('ascii')
+        self.num_colors = metadata.get('num_colors')
+        self.camera = metadata.get('camera', {})
+        self.other = SimpleNamespace(iso_speed=self.camera.get('iso'))
+
+    @property
+    def raw_image_visible(self):
+        top, left = self.sizes.top_margin, self.sizes.left_margin
+        return self.raw_image[top:top + self.sizes.height, left:left + self.sizes.width]
+
+    @property
+    def raw_colors(self):
+        # Built on every access, like rawpy does
+        if self.raw_pattern is None:
+            raise ValueError("{} is not a flat (CFA) raw image".format(self.metadata['source']))
+        height, width = self.raw_image.shape[0:2]
+        reps = (-(-height // self.raw_pattern.shape[0]), -(-width // self.raw_pattern.shape[1]))
+        return np.tile(self.raw_pattern, reps)[0:height, 0:width]
+
+    @property
+    def raw_colors_visible(self):
+        top, left = self.sizes.top_margin, self.sizes.left_margin
+        return self.raw_colors[top:top + self.sizes.height, left:left + self.sizes.width]
+
+    def raw_color(self, row, column):
+        return int(self.raw_pattern[row % self.raw_pattern.shape[0], column % self.raw_pattern.shape[1]])
+
+    def postprocess(self, **postprocessParams):
+        # rawpy postprocess of this frame's mosaic (including any changes made to it), via the original file
+        import rawpy
+
+        if self.sourcePath is None or not os.path.exists(self.sourcePath):
+            raise FileNotFoundError("postprocess of {} needs its raw file".format(self.metadata['source']))
+
+        with rawpy.imread(self.sourcePath) as rawImage:
+            rawImage.raw_image[...] = self.raw_image
+            return rawImage.postprocess(**postprocessParams)
+
+    def close(self):
+        # Views of raw_image stay valid (the mapping lives as long as they do); only our references go
+        self.raw_image = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+    def __repr__(self):
+        return "StoredFrame({!r})".format(self.npyPath)
+
+##############################################################################################################
+def _stored_metadata(rawImgPath, storeDir=None):
+    # The metadata of a raw file in the plane store (from its .json), or None if it has not been ingested or has
+    # changed since
+
+    npyPath, jsonPath = store_paths(rawImgPath, storeDir)
+    try:
+        with open(jsonPath) as jsonFile:
+            metadata = json.load(jsonFile)
+        fileStat = os.stat(rawImgPath)
+    except (OSError, ValueError):
+        return None
+
+    if metadata.get('version') != STORE_VERSION or metadata.get('mtime_ns') != fileStat.st_mtime_ns \
+            or metadata.get('size') != fileStat.st_size:
+        return None
+
+    return metadata
+
+def is_stored(rawImgPath, storeDir=None):
+    # Is a raw file in the plane store and current? (Reads the .json only: nothing is mapped.)
+    npyPath, jsonPath = store_paths(rawImgPath, storeDir)
+    return _stored_metadata(rawImgPath, storeDir) is not None and os.path.exists(npyPath)
+
+def open_stored(rawImgPath, storeDir=None):
+    # StoredFrame of a raw file, or None if it has not been ingested or has changed since
+
+    npyPath, jsonPath = store_paths(rawImgPath, storeDir)
+    metadata = _stored_metadata(rawImgPath, storeDir)
+    if metadata is None:
+        return None
+
+    try:
+        return StoredFrame(npyPath, metadata, sourcePath=os.path.abspath(rawImgPath))
+    except (OSError, ValueError):  # .npy missing or truncated
+        return None
+
+def open_raw(rawImgPath, storeDir=None):
+    # The StoredFrame of a raw file if it is in the plane store, else the file opened with rawpy (imported on
+    # first use, so processes that only read the store never load LibRaw)
+
+    storedFrame = open_stored(rawImgPath, storeDir)
+    if storedFrame is not None:
+        return storedFrame
+
+    import rawpy
+    return rawpy.imread(rawImgPath)
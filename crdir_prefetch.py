@@ -0,0 +1,126 @@
+# crdir_prefetch.py
+# Background prefetch of views of neighbouring frames for the Cosmic Ray Damage Image Repair (CRDIR) project
+#
+# While the user looks at one frame, a small thread pool renders the views they are likely to ask for next (the
+# same view of the next and previous frames) and keeps a bounded number of them ready, so a page turn is a
+# lookup instead of a decode + render. A view is identified by a hashable key, e.g. (imgDir, fileName, view,
+# settings); the render function given to the Prefetcher turns a key into whatever the GUI displays.
+# Frames are decoded through the shared raw frame cache, whose pinned frames are exclusive, so the pool and the
+# GUI thread never work on one LibRaw handle at the same time.
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from crdir_jobs import raise_if_cancelled
+
+DEFAULT_PREFETCH_WORKERS = 2
+DEFAULT_MAX_READY = 8  # Rendered views kept (least recently used dropped first)
+DEFAULT_PREFETCH_RADIUS = 1  # Frames on either side of the current one to prefetch
+
+##############################################################################################################
+def neighbor_indices(i, nFiles, radius=DEFAULT_PREFETCH_RADIUS):
+    # Indices of the frames around i, nearest first (next before previous), wrapping around the list like the
+    # GUI's Next / Prev buttons do
+
+    indices = []
+    for distance in range(1, radius + 1):
+        for index in ((i + distance) % nFiles, (i - distance) % nFiles):
+            if index != i and index not in indices:
+                indices.append(index)
+
+    return indices
+
+##############################################################################################################
+class Prefetcher:
+    # Pool of render threads with a bounded LRU of ready results (see the top of this file)
+
+    def __init__(self, render, workers=DEFAULT_PREFETCH_WORKERS, maxReady=DEFAULT_MAX_READY, verbose=False):
+        self.render = render  # render(*key) -> result
+        self.maxReady = maxReady
+        self.verbose = verbose
+
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='crdir-prefetch')
+        self._lock = threading.Lock()
+        self._ready = OrderedDict()  # key -> result, least recently used first
+        self._inFlight = {}          # key -> Future of a render queued or running
+
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._ready
+
+    def get(self, key):
+        # The result for key: ready, or waited for if it is being prefetched, or rendered now (in this thread)
+
+        with self._lock:
+            if key in self._ready:
+                self._ready.move_to_end(key)
+                self.hits += 1
+                return self._ready[key]
+            future = self._inFlight.get(key)
+            self.misses += 1
+
+        if future is not None:
+            while not future.cancel():  # Already running: let it finish rather than start over
+                try:
+                    return future.result(timeout=0.1)
+                except TimeoutError:
+                    raise_if_cancelled()  # Stop waiting if the job calling get() has been cancelled
+            with self._lock:
+                self._inFlight.pop(key, None)
+
+        result = self.render(*key)
+        self._store(key, result)
+        return result
+
+    def prefetch(self, keys):
+        # Render keys (most wanted first) in the background unless ready or already on their way. Queued renders
+        # of keys no longer wanted are cancelled, so a fast reader does not leave a backlog behind.
+
+        keys = list(keys)
+        with self._lock:
+            for key, future in list(self._inFlight.items()):
+                if key not in keys and future.cancel():
+                    del self._inFlight[key]
+
+            for key in keys:
+                if key not in self._ready and key not in self._inFlight:
+                    self._inFlight[key] = self._pool.submit(self._prefetch_one, key)
+
+    def clear(self):
+        # Forget every ready result and cancel the queued renders (e.g. when the directory changes)
+        with self._lock:
+            self._ready.clear()
+            for future in self._inFlight.values():
+                future.cancel()
+            self._inFlight.clear()
+
+    def shutdown(self):
+        self.clear()
+        self._pool.shutdown(wait=False)
+
+    def _prefetch_one(self, key):
+        try:
+            result = self.render(*key)
+        except Exception as error:  # Shown again (and raised) if the user asks for this view
+            if self.verbose:
+                print("Prefetcher: rendering {} failed: {}".format(key, error))
+            with self._lock:
+                self._inFlight.pop(key, None)
+            raise
+
+        self._store(key, result)
+        if self.verbose:
+            print("Prefetcher: {} ready".format(key))
+        return result
+
+    def _store(self, key, result):
+        with self._lock:
+            self._inFlight.pop(key, None)
+            self._ready[key] = result
+            self._ready.move_to_end(key)
+            while len(self._ready) > self.maxReady:
+                self._ready.popitem(last=False)
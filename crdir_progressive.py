@@ -0,0 +1,95 @@
+# crdir_progressive.py
+# Progressive display of raw frames for the Cosmic Ray Damage Image Repair (CRDIR) project
+#
+# A full rawpy postprocess demosaics the whole frame at full resolution, which takes seconds per frame - far too
+# long to wait for while stepping through a directory. A ProgressiveRenderer hands back a quick preview at once
+# (the embedded JPEG preview, or a half-size render if there is none; see cf.preview_from_raw) and renders the
+# full image on a background thread. The GUI shows the preview, polls (Read with a timeout) and swaps in the
+# full render when it is ready.
+# Only the most recent request is rendered: frames skipped past while a render is running are never started,
+# and a render that finishes after the user has moved on is dropped.
+
+import threading
+
+import crdir_funcs_v2 as cf
+
+##############################################################################################################
+class ProgressiveRenderer:
+    # Preview now, full render in the background (see the top of this file). render(imgDir, rawImgFname,
+    # **renderParams) makes the full image (default cf.postprocessed_from_raw), preview(imgDir, rawImgFname) the
+    # quick one (default cf.preview_from_raw, returning (image, source)).
+
+    def __init__(self, render=None, preview=None, verbose=False):
+        self.render = cf.postprocessed_from_raw if render is None else render
+        self.preview = cf.preview_from_raw if preview is None else preview
+        self.verbose = verbose
+
+        self._condition = threading.Condition()
+        self._generation = 0  # Bumped by every request; results of older generations are dropped
+        self._pending = None  # (generation, imgDir, rawImgFname, renderParams) waiting for the worker
+        self._running = None  # Generation being rendered
+        self._result = None   # (rawImgFname, image) of the current generation, until polled
+        self._worker = None
+
+    def request(self, imgDir, rawImgFname, withPreview=True, **renderParams):
+        # Start rendering a frame (superseding any earlier request), passing renderParams (e.g. a postprocess
+        # preset) on to render; returns (preview image, source), or (None, None) without withPreview
+
+        with self._condition:
+            self._generation += 1
+            generation = self._generation
+            self._pending, self._result = None, None  # Never start a superseded render
+
+        # The preview is made before the worker is told, so the full render of this frame (which holds the frame
+        # until it is done) cannot get in its way
+        preview = self.preview(imgDir, rawImgFname) if withPreview else (None, None)
+
+        with self._condition:
+            if generation == self._generation:  # Not superseded meanwhile (by another thread)
+                self._pending = (generation, imgDir, rawImgFname, renderParams)
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._work, name='crdir-progressive', daemon=True)
+                    self._worker.start()
+                self._condition.notify()
+
+        return preview
+
+    def poll(self):
+        # (rawImgFname, full image) once the latest request has been rendered, else None
+
+        with self._condition:
+            result, self._result = self._result, None
+            return result
+
+    def busy(self):
+        # Is the latest request still waiting for its full render?
+        with self._condition:
+            return self._pending is not None or self._running == self._generation
+
+    def wait(self, timeout=None):
+        # Block until the latest request has been rendered (or timeout seconds); returns poll()
+
+        with self._condition:
+            self._condition.wait_for(lambda: self._result is not None or not self.busy(), timeout)
+        return self.poll()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending is not None)
+                generation, imgDir, rawImgFname, renderParams = self._pending
+                self._pending, self._running = None, generation
+
+            try:
+                image = self.render(imgDir, rawImgFname, **renderParams)
+            except Exception as error:  # Keep the worker alive; the preview stays up
+                print("ProgressiveRenderer: rendering {} failed: {}".format(rawImgFname, error))
+                image = None
+
+            with self._condition:
+                self._running = None
+                if generation == self._generation and image is not None:
+                    self._result = (rawImgFname, image)
+                elif self.verbose:
+                    print("ProgressiveRenderer: dropped the render of {} (superseded)".format(rawImgFname))
+                self._condition.notify_all()
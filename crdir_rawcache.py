@@ -0,0 +1,212 @@
+# crdir_rawcache.py
+# Bounded LRU cache of decoded raw frames for the Cosmic Ray Damage Image Repair (CRDIR) project
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from crdir_planestore import open_raw
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024  # Budget for decoded raw data (and anything memoized alongside it): 1 GB
+
+##############################################################################################################
+def frame_key(rawImgPath):
+    # Cache key for a raw file: absolute path + modification time + size, so an overwritten file is re-decoded
+
+    rawImgPath = os.path.abspath(rawImgPath)
+    fileStat = os.stat(rawImgPath)
+
+    return rawImgPath, fileStat.st_mtime_ns, fileStat.st_size
+
+##############################################################################################################
+class RawFrame:
+    # One decoded raw frame held open by a RawFrameCache.
+    # rawImage is the open rawpy handle (already unpacked), or a crdir_planestore.StoredFrame if the file was
+    # ingested; products is a dict in which callers may memoize arrays derived from this frame. Products are
+    # counted against the cache budget and dropped with the frame.
+
+    def __init__(self, key, rawImage):
+        self.key = key
+        self.path = key[0]
+        self.rawImage = rawImage
+        self.products = {}
+        self.pins = 0  # Number of callers currently using rawImage (see RawFrameCache.frame)
+        self.evicted = False
+        self.lock = threading.RLock()  # Held by the thread using rawImage: LibRaw handles are not thread-safe
+
+        self.rawBytes = rawImage.raw_image.nbytes  # Accessing raw_image forces LibRaw to unpack (decode) the frame
+
+    def nbytes(self):
+        # Bytes held by this frame: the decoded raw mosaic plus every ndarray memoized in products. An ndarray
+        # is counted by the buffer it lives in (its outermost base: np.argwhere results, for instance, are
+        # transposed views of a larger array), each buffer once, and not at all if it is raw_image's (Bayer
+        # planes sliced out of the mosaic).
+
+        rawImage = self.rawImage.raw_image if self.rawImage is not None else None
+        counted = set()
+        productBytes = 0
+        for product in list(self.products.values()):
+            if isinstance(product, np.ndarray):
+                while isinstance(product.base, np.ndarray):
+                    product = product.base
+                if id(product) in counted or (rawImage is not None and np.shares_memory(product, rawImage)):
+                    continue
+                counted.add(id(product))
+                productBytes += product.nbytes
+            elif hasattr(product, 'nbytes'):
+                productBytes += product.nbytes() if callable(product.nbytes) else product.nbytes
+
+        return self.rawBytes + productBytes
+
+    def close(self):
+        # Release the LibRaw handle. Views of raw_image become invalid after this!
+        self.products.clear()
+        if self.rawImage is not None:
+            self.rawImage.close()
+            self.rawImage = None
+
+##############################################################################################################
+class RawFrameCache:
+    # LRU cache of decoded raw frames, keyed by (path, mtime, size), with byte-based eviction.
+    # Evicted frames have their LibRaw handle closed explicitly; a frame that is in use (pinned via frame())
+    # when it is evicted is closed as soon as its last user releases it.
+
+    def __init__(self, maxBytes=DEFAULT_MAX_BYTES, verbose=False):
+        self.maxBytes = maxBytes
+        self.verbose = verbose
+
+        self._frames = OrderedDict()  # key -> RawFrame, least recently used first
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __contains__(self, rawImgPath):
+        try:
+            return frame_key(rawImgPath) in self._frames
+        except OSError:
+            return False
+
+    def nbytes(self):
+        with self._lock:
+            return sum(rawFrame.nbytes() for rawFrame in self._frames.values())
+
+    def get(self, rawImgPath):
+        # Return the (unpinned) RawFrame for rawImgPath, decoding it on a miss.
+        # Only use the result while nothing else can touch the cache; otherwise use frame() to pin it.
+
+        key = frame_key(rawImgPath)
+
+        with self._lock:
+            rawFrame = self._frames.get(key)
+            if rawFrame is not None:
+                self._frames.move_to_end(key)
+                self.hits += 1
+                return rawFrame
+
+        # Decode outside the lock so other threads can keep hitting the cache meanwhile (an ingested frame is only
+        # memory-mapped from the plane store; see crdir_planestore)
+        newFrame = RawFrame(key, open_raw(key[0]))
+
+        with self._lock:
+            rawFrame = self._frames.get(key)
+            if rawFrame is not None:  # Another thread decoded the same frame first; keep theirs
+                newFrame.close()
+                self._frames.move_to_end(key)
+                self.hits += 1
+                return rawFrame
+
+            self.misses += 1
+            for staleKey in [k for k in self._frames if k[0] == key[0]]:  # Older versions of the same file
+                self._evict(staleKey)
+
+            self._frames[key] = newFrame
+            self.trim(keep=key)
+
+            if self.verbose:
+                print("RawFrameCache: decoded {} ({:0.1f} MB); {} frames, {:0.1f} MB cached"
+                      .format(key[0], newFrame.rawBytes / 2**20, len(self._frames), self.nbytes() / 2**20))
+
+            return newFrame
+
+    def frame(self, rawImgPath):
+        # Context manager yielding a pinned RawFrame: it will not be closed until the with block exits, and the
+        # block has it to itself (other threads wait for the frame; a thread may pin one frame more than once, but
+        # should not hold one frame while waiting for another).
+        return _PinnedFrame(self, rawImgPath)
+
+    def trim(self, keep=None):
+        # Evict least-recently-used frames until the cache is within maxBytes. Call after memoizing products.
+
+        with self._lock:
+            totalBytes = self.nbytes()
+            for key in list(self._frames):
+                if totalBytes <= self.maxBytes:
+                    break
+                if key == keep:
+                    continue
+                totalBytes -= self._frames[key].nbytes()
+                self._evict(key)
+
+    def invalidate(self, rawImgPath):
+        # Drop every cached version of rawImgPath
+
+        rawImgPath = os.path.abspath(rawImgPath)
+        with self._lock:
+            for key in [k for k in self._frames if k[0] == rawImgPath]:
+                self._evict(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._frames):
+                self._evict(key)
+
+    def _evict(self, key):
+        rawFrame = self._frames.pop(key)
+        rawFrame.evicted = True
+        self.evictions += 1
+        if rawFrame.pins == 0:
+            rawFrame.close()
+
+    def _pin(self, rawImgPath):
+        while True:
+            rawFrame = self.get(rawImgPath)
+            with self._lock:
+                if not rawFrame.evicted:  # Else another thread evicted it between get() and here; fetch again
+                    rawFrame.pins += 1
+                    return rawFrame
+
+    def _unpin(self, rawFrame):
+        with self._lock:
+            rawFrame.pins -= 1
+            if rawFrame.pins == 0 and rawFrame.evicted:
+                rawFrame.close()
+            else:
+                self.trim()  # Products memoized while pinned may have pushed the cache over budget
+
+##############################################################################################################
+class _PinnedFrame:
+
+    def __init__(self, cache, rawImgPath):
+        self.cache = cache
+        self.rawImgPath = rawImgPath
+        self.rawFrame = None
+
+    def __enter__(self):
+        self.rawFrame = self.cache._pin(self.rawImgPath)
+        self.rawFrame.lock.acquire()
+        return self.rawFrame
+
+    def __exit__(self, excType, excValue, traceback):
+        self.rawFrame.lock.release()
+        self.cache._unpin(self.rawFrame)
+        return False
+
+##############################################################################################################
+rawCache = RawFrameCache()  # Shared by the *_from_raw view functions and batch code unless told otherwise
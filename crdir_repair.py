@@ -0,0 +1,235 @@
+# crdir_repair.py
+# Raw repair engine for the Cosmic Ray Damage Image Repair (CRDIR) project
+#
+# Replaces the flagged pixels of a raw mosaic with an estimate from their same-color neighbors, touching only
+# the hits: the neighborhoods of all hits of a Bayer plane are gathered in one vectorized operation (as for
+# the sparse statistics in crdir_filters), neighbors that are hits themselves are left out of the estimate, and
+# the estimates are scattered back into the mosaic with one fancy-indexed assignment per plane.
+# Only hits with a positive Z-score are replaced: the same-color neighbors of a hot pixel or a strong hit fall
+# below their (dragged up) neighbor mean by more than zLimit, but are valid pixels. They are left as they are,
+# and only left out of the estimates of the hits next to them.
+# Repaired mosaics can be written as .npy, 16-bit TIFF (needs tifffile) or losslessly compressed .npz, and
+# rendered to RGB with the frame's own rawpy postprocessing without decoding the file again (render_repaired).
+#
+# Usage:  python crdir.py repair <batch output dir> [--format npy|tiff|npz] [--statistic median] [--out DIR]
+
+import json
+import os
+
+import numpy as np
+
+import crdir_filters as filters
+import crdir_funcs_v2 as cf
+import crdir_hits
+from crdir_rawcache import rawCache
+
+REPAIR_STATISTICS = {'median': np.nanmedian, 'mean': np.nanmean}  # Over the neighbors that are not hits
+REPAIR_FORMATS = ('npy', 'tiff', 'npz')
+
+##############################################################################################################
+def _neighbor_is_hit(coords, hitCoords, shape, size=3, mode=None):
+    # (N, size * size - 1) bool: is each neighbor (in gather_neighborhoods order) of each pixel in coords one of
+    # the hits in hitCoords?
+
+    mode = filters.DEFAULT_BORDER_MODE if mode is None else mode
+    r = size // 2
+    h, w = shape
+
+    hitKeys = np.sort(hitCoords[:, 0].astype(np.int64) * w + hitCoords[:, 1])
+    offsets = np.arange(-r, r + 1)
+    rows = filters.border_index(coords[:, 0:1] + offsets, h, mode)[:, :, np.newaxis]
+    cols = filters.border_index(coords[:, 1:2] + offsets, w, mode)[:, np.newaxis, :]
+    neighborKeys = (rows.astype(np.int64) * w + cols).reshape(len(coords), size * size)
+    neighborKeys = np.delete(neighborKeys, (size * size) // 2, axis=1)
+
+    found = np.minimum(np.searchsorted(hitKeys, neighborKeys), len(hitKeys) - 1)
+    return hitKeys[found] == neighborKeys
+
+##############################################################################################################
+def repair_estimates(grayscaleImg, coords, statistic='median', size=3, mode=None, excludeCoords=None):
+    # Estimate of each pixel in coords (N x 2) from its size x size same-color neighbors, leaving out neighbors
+    # that are in coords or in excludeCoords (M x 2; pixels not to be replaced, but not to be trusted either);
+    # pixels whose neighbors are all left out are estimated from a neighborhood 2 larger. Returns N float32 values.
+
+    coords = np.asarray(coords, dtype=np.intp).reshape(-1, 2)
+    if len(coords) == 0:
+        return np.zeros(0, dtype=np.float32)
+
+    leftOut = coords if excludeCoords is None else np.concatenate(
+        [coords, np.asarray(excludeCoords, dtype=np.intp).reshape(-1, 2)])
+
+    neighborhoods = filters.gather_neighborhoods(grayscaleImg, coords, size=size, mode=mode).astype(np.float32)
+    neighborhoods[_neighbor_is_hit(coords, leftOut, grayscaleImg.shape[0:2], size=size, mode=mode)] = np.nan
+
+    surrounded = np.isnan(neighborhoods).all(axis=1)
+    neighborhoods[surrounded] = 0  # Filled in below; keeps nanmedian from warning about them
+    estimates = REPAIR_STATISTICS[statistic](neighborhoods, axis=1).astype(np.float32)
+
+    if surrounded.any():
+        if size + 2 <= min(grayscaleImg.shape[0:2]):
+            larger = filters.gather_neighborhoods(grayscaleImg, coords[surrounded], size=size + 2,
+                                                  mode=mode).astype(np.float32)
+            larger[_neighbor_is_hit(coords[surrounded], leftOut, grayscaleImg.shape[0:2], size=size + 2,
+                                    mode=mode)] = np.nan
+            larger[np.isnan(larger).all(axis=1)] = 0
+            estimates[surrounded] = REPAIR_STATISTICS[statistic](larger, axis=1)
+        else:
+            estimates[surrounded] = 0
+
+    return estimates
+
+##############################################################################################################
+def repair_mosaic(mosaic, offsets, channelHits, statistic='median', size=3, mode=None, excludeHits=None):
+    # Repair a Bayer mosaic in place. offsets is {channel: (row, col)} in the 2x2 cell (cf.bayer_offsets),
+    # channelHits is {channel: N x 2 plane coordinates} of the pixels to replace, and excludeHits (optional) is
+    # {channel: M x 2 plane coordinates} of pixels that are kept but left out of the estimates. Returns the number
+    # of pixels replaced.
+
+    h, w = mosaic.shape[0:2]
+    excludeHits = {} if excludeHits is None else excludeHits
+    estimates = {}
+    for channel, coords in channelHits.items():  # All estimates first: every plane is read before any write
+        coords = np.asarray(coords, dtype=np.intp).reshape(-1, 2)
+        plane = mosaic[offsets[channel][0]:h - h % 2:2, offsets[channel][1]:w - w % 2:2]
+        estimates[channel] = (plane, coords, repair_estimates(plane, coords, statistic=statistic, size=size,
+                                                              mode=mode, excludeCoords=excludeHits.get(channel)))
+
+    nRepaired = 0
+    for channel, (plane, coords, channelEstimates) in estimates.items():
+        if np.issubdtype(plane.dtype, np.integer):
+            channelEstimates = np.clip(np.rint(channelEstimates), np.iinfo(plane.dtype).min,
+                                       np.iinfo(plane.dtype).max)
+        plane[coords[:, 0], coords[:, 1]] = channelEstimates  # Scatter: writes through the view into the mosaic
+        nRepaired += len(coords)
+
+    return nRepaired
+
+##############################################################################################################
+def channel_hits(hits, frame=None, positive=True):
+    # {channel: N x 2 plane coordinates} of the hits with a positive Z-score (the ones to repair), or with a
+    # negative one if not positive, from a crdir_hits.HitList (one frame of it) or from {channel: (coordinates,
+    # Z-scores)}. Plain {channel: coordinates} are taken as positive hits.
+
+    if not isinstance(hits, crdir_hits.HitList):
+        signed = {}
+        for channel, channelHits in hits.items():
+            if isinstance(channelHits, tuple):
+                coords, Zscores = channelHits
+                Zscores = np.asarray(Zscores)
+                signed[channel] = np.asarray(coords).reshape(-1, 2)[Zscores > 0 if positive else Zscores < 0]
+            else:
+                coords = np.asarray(channelHits).reshape(-1, 2)
+                signed[channel] = coords if positive else coords[0:0]
+        return signed
+
+    hits = hits.select(hits['z'] > 0 if positive else hits['z'] < 0)
+    return {channel: hits.coords(channel, frame) for channel in cf.CRDIRFrame.CHANNELS}
+
+##############################################################################################################
+def repair_frame(rawImage, hits, frame=None, statistic='median', size=3, mode=None, inPlace=False):
+    # Repaired copy of the visible raw mosaic of a rawpy image (the mosaic itself if inPlace). hits is a
+    # HitList (only its frame-th frame, if given) or {channel: (plane coordinates, Z-scores)} (or plain plane
+    # coordinates); only the positive hits are replaced, and the negative ones left out of their estimates.
+
+    mosaic = rawImage.raw_image_visible if inPlace else rawImage.raw_image_visible.copy()
+
+    repair_mosaic(mosaic, cf.bayer_offsets(cf.bayer_pattern(rawImage)), channel_hits(hits, frame),
+                  statistic=statistic, size=size, mode=mode, excludeHits=channel_hits(hits, frame, positive=False))
+
+    return mosaic
+
+##############################################################################################################
+def render_repaired(rawImage, repairedMosaic, hits=None, frame=None, **postprocessParams):
+    # rawImage.postprocess() of a repaired mosaic, reusing the open (already decoded) rawpy image: the repaired
+    # pixels are written into its raw buffer, postprocessed, and the original values put back. With hits, only
+    # the repaired (positive) hit pixels are swapped; otherwise the whole mosaic is.
+
+    visibleMosaic = rawImage.raw_image_visible  # View of the LibRaw raw buffer
+
+    if hits is None:
+        original = visibleMosaic.copy()
+        visibleMosaic[...] = repairedMosaic
+        try:
+            return rawImage.postprocess(**postprocessParams)
+        finally:
+            visibleMosaic[...] = original
+
+    offsets = cf.bayer_offsets(cf.bayer_pattern(rawImage))
+    mosaicCoords = np.concatenate([2 * coords + offsets[channel]
+                                   for channel, coords in channel_hits(hits, frame).items()]
+                                  + [np.zeros((0, 2), dtype=np.intp)])
+    rows, cols = mosaicCoords[:, 0], mosaicCoords[:, 1]
+
+    original = visibleMosaic[rows, cols]
+    visibleMosaic[rows, cols] = repairedMosaic[rows, cols]
+    try:
+        return rawImage.postprocess(**postprocessParams)
+    finally:
+        visibleMosaic[rows, cols] = original
+
+##############################################################################################################
+def write_repaired(repairedPath, mosaic, pattern=None):
+    # Write a repaired mosaic, in the format given by the extension: .npy, .tif / .tiff (16-bit, lossless zlib;
+    # needs tifffile) or .npz (losslessly compressed, with the 2x2 Bayer pattern of the mosaic)
+
+    extension = os.path.splitext(repairedPath)[1].lower()
+
+    if extension == '.npy':
+        np.save(repairedPath, mosaic)
+    elif extension in ('.tif', '.tiff'):
+        try:
+            import tifffile
+        except ImportError:
+            raise ImportError("Writing TIFF needs tifffile (pip install tifffile); use .npy or .npz instead")
+        tifffile.imwrite(repairedPath, mosaic.astype(np.uint16, copy=False), compression='zlib')
+    elif extension == '.npz':
+        np.savez_compressed(repairedPath, mosaic=mosaic,
+                            pattern=np.zeros((0, 0), np.uint8) if pattern is None else pattern)
+    else:
+        raise ValueError("Unknown repaired frame format '{}'; use .npy, .tiff or .npz".format(extension))
+
+    return repairedPath
+
+def read_repaired(repairedPath):
+    # Mosaic written by write_repaired
+    extension = os.path.splitext(repairedPath)[1].lower()
+
+    if extension in ('.tif', '.tiff'):
+        import tifffile
+        return tifffile.imread(repairedPath)
+    if extension == '.npz':
+        with np.load(repairedPath) as npzFile:
+            return npzFile['mosaic']
+
+    return np.load(repairedPath)
+
+##############################################################################################################
+def repair_batch_output(outDir, repairedDir=None, repairFormat='npy', statistic='median', cache=None,
+                        verbose=False):
+    # Repair every frame of a crdir_batch run (its hits.npz, and the frames in the run's imgDir); the repaired
+    # mosaics go to repairedDir (default <outDir>/repaired) as <frame>.repaired.<format>. Returns their paths.
+
+    cache = rawCache if cache is None else cache
+    repairedDir = os.path.join(outDir, 'repaired') if repairedDir is None else repairedDir
+    os.makedirs(repairedDir, exist_ok=True)
+
+    with open(os.path.join(outDir, 'summary.json')) as jsonFile:
+        imgDir = json.load(jsonFile)['run']['imgDir']
+    hitList = crdir_hits.HitList.load(os.path.join(outDir, 'hits.npz'))
+
+    repairedPaths = []
+    for frame, frameName in enumerate(hitList.frameNames):
+        imgPath = os.path.join(imgDir, frameName)
+        with cache.frame(imgPath) as rawFrame:
+            mosaic = repair_frame(rawFrame.rawImage, hitList, frame=frame, statistic=statistic)
+            pattern = cf.bayer_pattern(rawFrame.rawImage)
+        cache.invalidate(imgPath)
+
+        repairedPaths.append(write_repaired(os.path.join(repairedDir, '{}.repaired.{}'.format(
+            os.path.splitext(frameName)[0], repairFormat)), mosaic, pattern))
+
+        if verbose:
+            nRepaired = np.count_nonzero((hitList['frame'] == frame) & (hitList['z'] > 0))
+            print("{}: {} pixels repaired -> {}".format(frameName, int(nRepaired), repairedPaths[-1]))
+
+    return repairedPaths
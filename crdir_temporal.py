@@ -0,0 +1,179 @@
+# crdir_temporal.py
+# Streaming multi-frame (temporal) detection for the Cosmic Ray Damage Image Repair (CRDIR) project
+#
+# For bursts and time-lapse sequences of the same scene, a pixel is best compared with itself in the frames
+# before it rather than with its neighbors. A TemporalDetector keeps running per-pixel statistics of the four
+# Bayer planes over (about) the last `window` frames, tests each new frame against them, then folds the frame in;
+# each frame costs O(pixels) and earlier frames are never re-read. Two methods:
+#   'welford'  running mean & variance: exact (Welford) over a pixel's first `window` samples, then exponentially
+#              weighted with alpha = 1 / window. Holds 2 float32 values and a uint16 sample count per pixel.
+#   'median'   median of a ring buffer of the last `window` frames, with the spread from its median absolute
+#              deviation. Robust to flicker and earlier hits; holds `window` raw values per pixel.
+# Flagged pixels are not folded into the statistics, so a hit does not raise the bar for the frames after it.
+# globalSigma (a number or a crdir_noise.NoiseModel) is the smallest sigma a pixel is tested against.
+#
+# Usage:  python crdir.py temporal <dir> [--window 8] [--method welford] [--zlimit 5] [--stdev 75] [--out DIR]
+
+import os
+
+import numpy as np
+
+import crdir_funcs_v2 as cf
+import crdir_hits
+import crdir_tiled as tiled
+from crdir_rawcache import rawCache
+
+TEMPORAL_METHODS = ('welford', 'median')
+
+DEFAULT_WINDOW = 8
+DEFAULT_MIN_FRAMES = 3  # Frames of history needed before anything is flagged
+DEFAULT_TEMPORAL_Z_LIMIT = 5
+
+##############################################################################################################
+class TemporalDetector:
+    # Running per-pixel statistics of a sequence of frames of one scene (see the top of this file)
+
+    def __init__(self, window=DEFAULT_WINDOW, method='welford', zLimit=DEFAULT_TEMPORAL_Z_LIMIT, globalSigma=1.0,
+                 minFrames=DEFAULT_MIN_FRAMES, memoryBudget=None):
+        if method not in TEMPORAL_METHODS:
+            raise ValueError("Unknown temporal method '{}'; use one of {}".format(method, TEMPORAL_METHODS))
+
+        self.window = window
+        self.method = method
+        self.zLimit = zLimit
+        self.globalSigma = globalSigma
+        self.minFrames = max(1, minFrames)
+        self.memoryBudget = memoryBudget
+        self.reset()
+
+    def reset(self):
+        # Forget the history (e.g. when the scene changes)
+        self.frames = 0
+        self._shape = None
+        self.mean = None    # 'welford': (4, H/2, W/2) float32 running mean & variance, and the number of
+        self.var = None     #            samples (frames the pixel was not flagged in, up to window) behind them
+        self.count = None
+        self.buffer = None  # 'median': (window, 4, H/2, W/2) ring buffer of the last frames
+
+    def _sigma_floor(self, shape):
+        # globalSigma for each plane (R, G1, G2, B), shaped to broadcast against the (4, H/2, W/2) stack
+        if not hasattr(self.globalSigma, 'channel_sigma'):
+            return np.float32(self.globalSigma)
+        return np.stack([np.broadcast_to(np.float32(self.globalSigma.channel_sigma(channel)), shape)
+                         for channel in cf.CRDIRFrame.CHANNELS])
+
+    def add(self, rawImage):
+        # Test one frame (an open rawpy image) against the history, then add it: {channel: (coords, Zscores)}
+        # of the pixels that deviate by more than zLimit sigmas (empty until minFrames frames have been seen)
+        RG1BG2Image, planes = cf.extract_from_raw(rawImage, stacked=True)
+        return self.add_planes(planes)
+
+    def add_planes(self, planes):
+        # add() for a (4, H/2, W/2) R, G1, G2, B stack, e.g. from extract_from_raw(rawImage, stacked=True)
+
+        if self.frames and planes.shape != self._shape:
+            raise ValueError("Frame planes are {}, the sequence's are {}".format(planes.shape, self._shape))
+        self._shape = planes.shape
+
+        if self.method == 'welford':
+            flagged, Zscores = self._add_welford(planes)
+        else:
+            flagged, Zscores = self._add_median(planes)
+        self.frames += 1
+
+        channelHits = {}
+        for plane, channel in enumerate(cf.CRDIRFrame.CHANNELS):
+            coords = np.argwhere(flagged[plane])
+            channelHits[channel] = (coords, Zscores[plane][coords[:, 0], coords[:, 1]])
+
+        return channelHits
+
+    def _add_welford(self, planes):
+        # Running mean & variance; exact over each pixel's first window samples, exponentially weighted after
+        # that. A flagged pixel is left out of the update, and its sample count with it.
+
+        planes = planes.astype(np.float32)
+        if self.frames == 0:
+            self.mean, self.var = planes.copy(), np.zeros(planes.shape, dtype=np.float32)
+            self.count = np.ones(planes.shape, dtype=np.uint16)
+            return np.zeros(planes.shape, dtype=bool), np.zeros(planes.shape, dtype=np.float32)
+
+        delta = planes - self.mean
+        sigma = np.maximum(np.sqrt(self.var), self._sigma_floor(planes.shape[1:]))
+        Zscores = delta / sigma
+        flagged = np.abs(Zscores) > self.zLimit if self.frames >= self.minFrames else np.zeros(planes.shape, bool)
+
+        exact = self.count < self.window  # Still within the pixel's first window samples
+        newCount = np.minimum(self.count + ~flagged, self.window).astype(np.uint16)
+        alpha = 1 / newCount.astype(np.float32)  # 1 / n while exact, then 1 / window
+        delta[flagged] = 0  # Flagged pixels keep their statistics
+        self.mean += alpha * delta
+        self.var = np.where(flagged, self.var,
+                            np.where(exact, self.var + alpha * ((planes - self.mean) * delta - self.var),  # Welford
+                                     (1 - alpha) * (self.var + alpha * delta * delta)))  # Exponentially weighted
+        self.count = newCount
+
+        return flagged, Zscores
+
+    def _add_median(self, planes):
+        # Median & MAD of the ring buffer, a band of rows at a time to bound the temporaries
+
+        if self.buffer is None:
+            self.buffer = np.empty((self.window,) + planes.shape, dtype=planes.dtype)
+
+        nFrames = min(self.frames, self.window)
+        flagged = np.zeros(planes.shape, dtype=bool)
+        Zscores = np.zeros(planes.shape, dtype=np.float32)
+        newFrame = planes.copy()  # What goes into the buffer: the frame, with flagged pixels replaced by the median
+
+        if nFrames > 0:
+            sigmaFloor = self._sigma_floor(planes.shape[1:])
+            bytesPerRow = planes.shape[0] * planes.shape[2] * 8 * (2 * nFrames + 4)
+            bandRows = max(1, int((self.memoryBudget or tiled.DEFAULT_MEMORY_BUDGET) // bytesPerRow))
+
+            for firstRow, endRow in tiled.iter_bands(planes.shape[1], bandRows):
+                rows = slice(firstRow, endRow)
+                history = self.buffer[0:nFrames, :, rows].astype(np.float32)
+                median = np.median(history, axis=0)
+                mad = np.median(np.abs(history - median), axis=0)
+                del history
+
+                sigma = np.maximum(1.4826 * mad, sigmaFloor if np.ndim(sigmaFloor) == 0 else sigmaFloor[:, rows])
+                Zscores[:, rows] = (planes[:, rows] - median) / sigma
+                if self.frames >= self.minFrames:
+                    flagged[:, rows] = np.abs(Zscores[:, rows]) > self.zLimit
+                    np.copyto(newFrame[:, rows], median, where=flagged[:, rows], casting='unsafe')
+
+        self.buffer[self.frames % self.window] = newFrame
+
+        return flagged, Zscores
+
+    def nbytes(self):
+        # Memory held for the history
+        return sum(array.nbytes for array in (self.mean, self.var, self.count, self.buffer)
+                   if array is not None)
+
+##############################################################################################################
+def temporal_hits(rawImgPaths, window=DEFAULT_WINDOW, method='welford', zLimit=DEFAULT_TEMPORAL_Z_LIMIT,
+                  globalSigma=1.0, minFrames=DEFAULT_MIN_FRAMES, hitList=None, cache=None, verbose=False):
+    # Stream a sequence of raw frames (in order) through a TemporalDetector; returns a crdir_hits.HitList with
+    # one frame per file. Each file is decoded once and dropped from the cache as soon as it has been added.
+
+    cache = rawCache if cache is None else cache
+    detector = TemporalDetector(window=window, method=method, zLimit=zLimit, globalSigma=globalSigma,
+                                minFrames=minFrames)
+    hitList = crdir_hits.HitList() if hitList is None else hitList
+
+    for rawImgPath in rawImgPaths:
+        with cache.frame(rawImgPath) as rawFrame:
+            offsets = cf.CRDIRFrame(rawFrame.rawImage, rawFrame.products).offsets()
+            channelHits = detector.add(rawFrame.rawImage)
+        cache.invalidate(rawImgPath)
+
+        crdir_hits.hits_from_planes(channelHits, offsets, hitList, frameName=os.path.basename(rawImgPath))
+
+        if verbose:
+            print("{}: {} temporal hits".format(os.path.basename(rawImgPath),
+                                                sum(len(coords) for coords, Zscores in channelHits.values())))
+
+    return hitList
@@ -0,0 +1,125 @@
+# crdir_tiled.py
+# Bounded-memory (banded) Z-score detection for the Cosmic Ray Damage Image Repair (CRDIR) project
+#
+# The whole-frame path materializes several full-size mean / Z-score / mask arrays per plane. Here each Bayer
+# plane is processed in horizontal bands of full width, each read with a halo of size // 2 rows above and below
+# so every size x size neighborhood is complete; the band height is chosen from a memory budget. Neighbor sums
+# are exact integers, so the hits are bit-identical to the whole-frame path with the same backend & border mode.
+
+import os
+
+import numpy as np
+
+import crdir_filters as filters
+import crdir_funcs_v2 as cf
+
+# Memory budget for the per-band temporaries (bytes); set CRDIR_MEMORY_BUDGET_MB to override the default
+DEFAULT_MEMORY_BUDGET = int(float(os.environ.get('CRDIR_MEMORY_BUDGET_MB', 256)) * 2**20)
+
+# Bytes of temporaries per band pixel: padded int32 band, int32 row & window sums, float32 mean & Z-score, and a
+# bool comparison (the cumsum method uses int64 sums, so it is budgeted at twice that)
+BAND_BYTES_PER_PIXEL = {'boxsum': 4 + 4 + 4 + 4 + 4 + 1, 'cumsum': 4 + 8 + 8 + 8 + 4 + 4 + 1}
+
+EXACT_BACKENDS = ('boxsum', 'cumsum')  # Integer neighbor sums: results do not depend on the banding
+
+##############################################################################################################
+def band_rows_for_budget(width, memoryBudget=None, size=3, backend='boxsum'):
+    # Number of plane rows per band so the band temporaries (halo included) stay within memoryBudget bytes
+
+    memoryBudget = DEFAULT_MEMORY_BUDGET if memoryBudget is None else memoryBudget
+    bytesPerRow = (width + 2 * (size // 2)) * BAND_BYTES_PER_PIXEL[backend]
+
+    return max(1, int(memoryBudget // bytesPerRow) - 2 * (size // 2))
+
+##############################################################################################################
+def iter_bands(height, bandRows):
+    # (firstRow, lastRow + 1) of each band
+    for firstRow in range(0, height, bandRows):
+        yield firstRow, min(firstRow + bandRows, height)
+
+##############################################################################################################
+def neighbor_mean_band(grayscaleImg, firstRow, endRow, size=3, backend=None, mode=None):
+    # Neighbor mean of rows firstRow:endRow of grayscaleImg, computed from those rows plus a halo of size // 2
+    # rows on either side. Rows beyond the top / bottom of the image are filled in by the border mode exactly as
+    # padding the whole image would, so the result equals the same rows of filters.neighbor_mean(grayscaleImg).
+
+    backend = filters.DEFAULT_NEIGHBOR_MEAN_BACKEND if backend is None else backend
+    mode = filters.DEFAULT_BORDER_MODE if mode is None else mode
+
+    if backend not in EXACT_BACKENDS:
+        raise ValueError("Banded processing needs an exact (integer) backend, one of {}, not '{}'"
+                         .format(EXACT_BACKENDS, backend))
+
+    halo = size // 2
+    rows = np.arange(firstRow - halo, endRow + halo)
+    band = grayscaleImg[filters.border_index(rows, grayscaleImg.shape[0], mode)]  # Only the band is copied
+    band = band.astype(np.int32 if backend == 'boxsum' else band.dtype, copy=False)
+    if mode == 'constant':
+        band[(rows < 0) | (rows >= grayscaleImg.shape[0])] = 0
+
+    paddedBand = np.pad(band, ((0, 0), (halo, halo)), mode=filters.BORDER_MODES[mode])  # Full width: pad columns
+
+    neighborSum = filters.neighborhood_sum(paddedBand, size, method=backend)
+
+    return filters._mean_from_sum(neighborSum, size * size - 1, np.dtype(np.float32))
+
+##############################################################################################################
+def find_where_Zscore_exceeds_Z_limit_tiled(grayscaleImg, globalSigma, ZscoreLimit, size=3, backend=None, mode=None,
+                                            memoryBudget=None, bandRows=None, returnZscores=False, label='',
+                                            verbose=False):
+    # Banded equivalent of find_where_Zscore_exceeds_Z_limit(calculate Z-scores of grayscaleImg): returns the
+    # same N x 2 (row, col) array, in the same order, without ever holding a full-size float image.
+    # bandRows overrides the band height derived from memoryBudget. With returnZscores, return
+    # (coords, Zscores) with the (float32) Z-score of each hit. globalSigma may be a per-pixel sigma map.
+
+    backend = filters.DEFAULT_NEIGHBOR_MEAN_BACKEND if backend is None else backend
+    h, w = grayscaleImg.shape[0:2]
+
+    if bandRows is None:
+        bandRows = band_rows_for_budget(w, memoryBudget, size=size, backend=backend)
+
+    bandHits, bandZscores = [], []
+    for firstRow, endRow in iter_bands(h, bandRows):
+        meanBand = neighbor_mean_band(grayscaleImg, firstRow, endRow, size=size, backend=backend, mode=mode)
+        sigmaBand = globalSigma[firstRow:endRow] if np.ndim(globalSigma) == 2 else globalSigma
+        ZscoreBand = (grayscaleImg[firstRow:endRow] - meanBand) / sigmaBand  # Same arithmetic as CRDIRFrame
+        del meanBand
+
+        hits = np.argwhere(abs(ZscoreBand) > ZscoreLimit)
+        if returnZscores:
+            bandZscores.append(ZscoreBand[hits[:, 0], hits[:, 1]])
+        hits[:, 0] += firstRow
+        bandHits.append(hits)
+
+    exceedsZlimitArray = np.concatenate(bandHits) if bandHits else np.zeros((0, 2), dtype=np.intp)
+
+    if verbose:
+        print("np.abs({}_ZscoreImage) > {} StDev: [{:4d} / {:5.2f}M pixels, {} bands of {} rows]"
+              .format(label, ZscoreLimit, len(exceedsZlimitArray), (w * h) / (1024 * 1024),
+                      len(bandHits), bandRows))
+
+    if returnZscores:
+        return exceedsZlimitArray, (np.concatenate(bandZscores) if bandZscores else np.zeros(0, dtype=np.float32))
+
+    return exceedsZlimitArray
+
+##############################################################################################################
+def find_hits_tiled(rawImage, globalSigma, zLimit, channels=cf.CRDIRFrame.CHANNELS, size=3, backend=None,
+                    mode=None, memoryBudget=None, returnZscores=False, verbose=False):
+    # Banded detection on each Bayer plane of a raw image: {channel: N x 2 hits}, identical to
+    # CRDIRFrame(rawImage).exceeds_Zlimit(channel, globalSigma, zLimit) for the same backend and border mode
+    # ({channel: (hits, Zscores)} with returnZscores; see crdir_hits.hits_from_planes).
+    # globalSigma may be a crdir_noise.NoiseModel, as for CRDIRFrame.
+
+    RG1BG2Image, Rimage, G1image, G2image, Bimage = cf.extract_from_raw(rawImage, verbose=verbose)
+    planes = {'RG1BG2': RG1BG2Image, 'R': Rimage, 'G1': G1image, 'G2': G2image, 'B': Bimage}
+
+    def channel_sigma(channel):
+        return globalSigma.channel_sigma(channel) if hasattr(globalSigma, 'channel_sigma') else globalSigma
+
+    return {channel: find_where_Zscore_exceeds_Z_limit_tiled(planes[channel], channel_sigma(channel), zLimit,
+                                                             size=size, backend=backend, mode=mode,
+                                                             memoryBudget=memoryBudget,
+                                                             returnZscores=returnZscores, label=channel,
+                                                             verbose=verbose)
+            for channel in channels}
@@ -0,0 +1,386 @@
+# crdir_watch.py
+# Watch-folder detection for the Cosmic Ray Damage Image Repair (CRDIR) project
+#
+# A capture rig writes raw frames into a directory continuously. watch() waits for new or changed frames, hands
+# each one to a pool of crdir_batch workers as soon as it is complete, and keeps the batch outputs of the
+# directory up to date (<outDir>/<frame>.hits.npz as each frame finishes; hits.npz, events.npz and
+# summary.json / .csv whenever the queue runs dry), so 'crdir.py repair' works on a watched directory too.
+#   Detecting files:   inotify (through libc, so no extra package) where the platform has it; otherwise, or
+#                      with usePolling, the directory is rescanned every interval seconds.
+#   Complete files:    a frame is queued once its writer has closed it (inotify) or, when polling, once its
+#                      size and modification time have not changed for settleSeconds. A file that changes
+#                      again later is processed again.
+#   Manifest:          <outDir>/manifest.json records every frame processed: its size and modification time,
+#                      the detection parameters, its outputs and its batch summary. It is rewritten (atomically)
+#                      after every frame, so a watch that is stopped and started again - or a 'batch'-style
+#                      rescan of the whole directory - resumes where it left off: frames already processed with
+#                      the same parameters, unchanged since and with their outputs in place are not processed
+#                      again. Frames that failed are retried only once they change.
+#
+# Usage:  python crdir.py watch <dir> [--out DIR] [--stdev 75] [--zlimit 3] [--workers N] [--ext .nef]
+#                                     [--settle 2] [--interval 1] [--poll] [--idle-exit SECONDS] [--quiet]
+#         watcher = DirectoryWatcher(imgDir); while ...: for imgPath in watcher.poll(timeout=1.0): ...
+
+import ctypes
+import ctypes.util
+import datetime
+import json
+import os
+import select
+import struct
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import crdir_batch
+import crdir_events
+import crdir_filters as filters
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+
+DEFAULT_SETTLE_SECONDS = 2.0  # Polling: a file unchanged for this long is complete
+DEFAULT_POLL_INTERVAL = 1.0   # Seconds between rescans (polling), or the longest wait for an event (inotify)
+
+# inotify (see inotify(7))
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len (then len bytes of NUL-padded name)
+
+##############################################################################################################
+def _libc_inotify():
+    # libc, if it has inotify (Linux), else None
+
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+
+    return libc
+
+def _matches(fileName, fileExtension):
+    # The files batch_img_files takes: not hidden, with the extension (either case) in the name
+    return not fileName.startswith('.') and (fileExtension.lower() in fileName or fileExtension.upper() in fileName)
+
+##############################################################################################################
+class DirectoryWatcher:
+    # New or changed, complete raw files of a directory (see the top of this file). poll() returns the files that
+    # have become complete since the last call, starting with every file already there.
+
+    def __init__(self, imgDir, fileExtension='.nef', settleSeconds=DEFAULT_SETTLE_SECONDS, usePolling=False,
+                 verbose=False):
+        self.imgDir = imgDir
+        self.fileExtension = fileExtension
+        self.settleSeconds = settleSeconds
+        self.verbose = verbose
+
+        self._reported = {}  # path -> (size, mtime_ns) when poll() last returned it
+        self._pending = {}   # path -> [size, mtime_ns, time first seen so, closed by its writer]
+        self._fd = None
+        self._rescan = True  # Scan the whole directory at the next poll()
+
+        libc = None if usePolling else _libc_inotify()
+        if libc is not None:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0 and libc.inotify_add_watch(fd, os.fsencode(os.path.abspath(imgDir)),
+                                                  IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) >= 0:
+                self._fd = fd
+            elif fd >= 0:
+                os.close(fd)
+        self.mode = 'inotify' if self._fd is not None else 'polling'
+
+        if self.verbose:
+            print("DirectoryWatcher: watching {} ({})".format(imgDir, self.mode))
+
+    def poll(self, timeout=DEFAULT_POLL_INTERVAL):
+        # Paths of the files that have become complete, sorted; waits up to timeout seconds for news if nothing
+        # is waiting to settle
+
+        if self._fd is not None:
+            self._read_events(0.0 if self._rescan else timeout if not self._pending
+                              else min(timeout, self.settleSeconds))
+        elif not self._rescan:
+            time.sleep(timeout if not self._pending else min(timeout, self.settleSeconds))
+            self._rescan = True
+
+        if self._rescan:
+            self._rescan = self._fd is None  # Polling rescans every time; inotify only after an overflow
+            self._scan()
+
+        return self._settled()
+
+    def pending(self):
+        # Number of files seen but not complete yet
+        return len(self._pending)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+    def _scan(self):
+        for entry in os.scandir(self.imgDir):
+            if _matches(entry.name, self.fileExtension) and entry.is_file():
+                self._seen(entry.path, closed=False)
+
+    def _read_events(self, timeout):
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return
+        try:
+            buffer = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(buffer):
+            wd, mask, cookie, nameLength = INOTIFY_EVENT.unpack_from(buffer, offset)
+            name = os.fsdecode(buffer[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + nameLength]
+                               .rstrip(b'\0'))
+            offset += INOTIFY_EVENT.size + nameLength
+
+            if mask & (IN_Q_OVERFLOW | IN_IGNORED):  # Events lost (or the directory is gone): look again
+                self._rescan = True
+            elif name and _matches(name, self.fileExtension):
+                self._seen(os.path.join(self.imgDir, name), closed=bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO)))
+
+    def _seen(self, path, closed):
+        # Note that path exists (and, if closed, that its writer has just closed it)
+        try:
+            fileStat = os.stat(path)
+        except OSError:
+            return
+        stamp = (fileStat.st_size, fileStat.st_mtime_ns)
+
+        if self._reported.get(path) == stamp and path not in self._pending:
+            return
+        pending = self._pending.get(path)
+        if pending is None or tuple(pending[0:2]) != stamp:
+            self._pending[path] = [stamp[0], stamp[1], time.monotonic(), closed]
+        elif closed:
+            pending[3] = True
+
+    def _settled(self):
+        settled = []
+        now = time.monotonic()
+        for path, (size, mtime, since, closed) in list(self._pending.items()):
+            try:
+                fileStat = os.stat(path)
+            except OSError:  # Deleted (or renamed) before it was complete
+                del self._pending[path]
+                continue
+
+            if (fileStat.st_size, fileStat.st_mtime_ns) != (size, mtime):  # Still being written
+                self._pending[path] = [fileStat.st_size, fileStat.st_mtime_ns, now, False]
+            elif size > 0 and (closed or now - since >= self.settleSeconds):
+                del self._pending[path]
+                if self._reported.get(path) != (size, mtime):
+                    self._reported[path] = (size, mtime)
+                    settled.append(path)
+
+        return sorted(settled)
+
+##############################################################################################################
+def detection_params(stDev, zLimit, noiseLibrary=None, defectLibrary=None):
+    # The parameters a frame's hits depend on, as recorded in the manifest
+    return {'stDev': stDev, 'zLimit': zLimit, 'noiseLibrary': noiseLibrary, 'defectLibrary': defectLibrary,
+            'backend': filters.DEFAULT_NEIGHBOR_MEAN_BACKEND, 'mode': filters.DEFAULT_BORDER_MODE}
+
+class Manifest:
+    # The frames of a watched directory processed so far, in <outDir>/manifest.json (see the top of this file)
+
+    def __init__(self, outDir):
+        self.outDir = outDir
+        self.path = os.path.join(outDir, MANIFEST_NAME)
+        self.imgDir = None
+        self.files = {}  # file name -> {'size', 'mtime_ns', 'params', 'outputs', 'summary', 'processed'}
+
+        try:
+            with open(self.path) as jsonFile:
+                manifest = json.load(jsonFile)
+        except (OSError, ValueError):
+            return
+        if manifest.get('version') == MANIFEST_VERSION:
+            self.imgDir = manifest.get('imgDir')
+            self.files = manifest.get('files', {})
+
+    def __len__(self):
+        return len(self.files)
+
+    def is_current(self, imgPath, params, fileStat=None):
+        # Has imgPath been processed with params, is it unchanged since, and are its outputs still there?
+
+        entry = self.files.get(os.path.basename(imgPath))
+        if entry is None:
+            return False
+        fileStat = os.stat(imgPath) if fileStat is None else fileStat
+        if (entry['size'], entry['mtime_ns']) != (fileStat.st_size, fileStat.st_mtime_ns) \
+                or entry['params'] != json.loads(json.dumps(params)):
+            return False
+
+        return bool(entry['summary']['error']) or all(os.path.exists(os.path.join(self.outDir, output))
+                                                      for output in entry['outputs'].values())
+
+    def record(self, imgPath, fileStat, params, frameSummary):
+        # Note a processed frame (fileStat as it was when it was queued) and save the manifest
+
+        outputs = {} if frameSummary['error'] else {
+            'hits': os.path.basename(crdir_batch.frame_hits_path(self.outDir, imgPath))}
+        self.files[os.path.basename(imgPath)] = {
+            'size': fileStat.st_size, 'mtime_ns': fileStat.st_mtime_ns, 'params': params, 'outputs': outputs,
+            'summary': frameSummary, 'processed': datetime.datetime.now().isoformat(timespec='seconds')}
+        self.imgDir = os.path.abspath(os.path.dirname(imgPath))
+        self.save()
+
+    def frame_summaries(self):
+        return [self.files[fileName]['summary'] for fileName in sorted(self.files)]
+
+    def processed_files(self):
+        # Paths of the frames processed without error, sorted
+        return [os.path.join(self.imgDir, fileName) for fileName in sorted(self.files)
+                if not self.files[fileName]['summary']['error']]
+
+    def save(self):
+        os.makedirs(self.outDir, exist_ok=True)
+        tmpPath = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmpPath, 'w') as jsonFile:
+            json.dump({'version': MANIFEST_VERSION, 'imgDir': self.imgDir, 'files': self.files}, jsonFile, indent=2)
+        os.replace(tmpPath, self.path)
+
+##############################################################################################################
+def write_outputs(manifest, runSummary):
+    # hits.npz, events.npz and summary.json / .csv of every frame in the manifest (as run_batch writes them);
+    # returns the number of events
+
+    allHits = crdir_batch.merge_hit_lists(manifest.outDir, manifest.processed_files())
+    events = crdir_events.find_events(allHits, globalSigma=crdir_batch.frame_sigmas(
+        runSummary['imgDir'], allHits, runSummary['stDev'], runSummary['noiseLibrary']))
+    events.save(os.path.join(manifest.outDir, 'events.npz'))
+
+    frameSummaries = manifest.frame_summaries()
+    runSummary.update({'frames': len(frameSummaries),
+                       'failed': sum(1 for frameSummary in frameSummaries if frameSummary['error']),
+                       'hits': sum(frameSummary['hits'] for frameSummary in frameSummaries),
+                       'events': len(events)})
+    crdir_batch.write_summary(manifest.outDir, frameSummaries, runSummary)
+
+    return len(events)
+
+def watch(imgDir, outDir=None, stDev=crdir_batch.DEFAULT_STDEV, zLimit=crdir_batch.DEFAULT_Z_LIMIT, workers=None,
+          fileExtension='.nef', memoryBudget=None, noiseLibrary=None, defectLibrary=None, cacheDir=None,
+          settleSeconds=DEFAULT_SETTLE_SECONDS, interval=DEFAULT_POLL_INTERVAL, usePolling=False, idleExit=None,
+          verbose=True):
+    # Process the frames of imgDir as they arrive, with a pool of crdir_batch workers, until interrupted (Ctrl-C)
+    # or, with idleExit, until nothing has happened for idleExit seconds. The other arguments are run_batch's.
+    # Returns the run summary dict (over every frame in the manifest).
+
+    outDir = os.path.join(imgDir, 'crdir_out') if outDir is None else outDir
+    os.makedirs(outDir, exist_ok=True)
+    workers = os.cpu_count() if workers is None else workers
+
+    manifest = Manifest(outDir)
+    params = detection_params(stDev, zLimit, noiseLibrary, defectLibrary)
+    runSummary = {'imgDir': os.path.abspath(imgDir), 'stDev': stDev, 'zLimit': zLimit, 'workers': workers,
+                  'memoryBudget': memoryBudget, 'noiseLibrary': noiseLibrary, 'defectLibrary': defectLibrary,
+                  'cacheDir': cacheDir, 'watch': True}
+
+    inFlight = {}    # Future -> (imgPath, its os.stat when queued)
+    changed = set()  # Frames that changed again while being processed: queued again when they finish
+    nProcessed = nSkipped = 0
+    outputsStale = False
+    lastActivity = time.monotonic()
+
+    def queue(imgPath):
+        task = (imgPath, outDir, stDev, zLimit, memoryBudget, noiseLibrary, defectLibrary, cacheDir, None)
+        inFlight[executor.submit(crdir_batch._process_frame_task, task)] = (imgPath, os.stat(imgPath))
+
+    def finish(future):
+        nonlocal nProcessed, outputsStale
+        imgPath, fileStat = inFlight.pop(future)
+        frameSummary, frameRecords = future.result()
+        manifest.record(imgPath, fileStat, params, frameSummary)
+        nProcessed += 1
+        outputsStale = True
+
+        if verbose:
+            status = frameSummary['error'] or '{:7d} hits{}'.format(
+                frameSummary['hits'], ' (cached)' if frameSummary.get('cached') else '')
+            print("{} {}: {} ({:0.2f} s)".format(datetime.datetime.now().strftime('%H:%M:%S'), frameSummary['file'],
+                                                 status, frameSummary['seconds']))
+
+    executor = ProcessPoolExecutor(max_workers=workers)
+    watcher = DirectoryWatcher(imgDir, fileExtension, settleSeconds, usePolling)
+    if verbose:
+        print("Watching {} for '{}' frames ({}, {} workers; {} already in the manifest); output to {}. "
+              "Ctrl-C to stop.".format(imgDir, fileExtension, watcher.mode, workers, len(manifest), outDir))
+
+    try:
+        while True:
+            for imgPath in watcher.poll(timeout=min(interval, 0.2) if inFlight else interval):
+                lastActivity = time.monotonic()
+                try:
+                    if manifest.is_current(imgPath, params):
+                        nSkipped += 1
+                        continue
+                except OSError:  # Gone already
+                    continue
+                if any(path == imgPath for path, fileStat in inFlight.values()):
+                    changed.add(imgPath)
+                else:
+                    queue(imgPath)
+
+            for future in [future for future in inFlight if future.done()]:
+                imgPath = inFlight[future][0]
+                finish(future)
+                lastActivity = time.monotonic()
+                if imgPath in changed:
+                    changed.discard(imgPath)
+                    if os.path.exists(imgPath) and not manifest.is_current(imgPath, params):
+                        queue(imgPath)
+
+            if not inFlight and outputsStale:  # Caught up: bring the directory-wide outputs up to date
+                write_outputs(manifest, runSummary)
+                outputsStale = False
+                if verbose:
+                    print("{} frames processed ({} failed), {} hits, {} events".format(
+                        runSummary['frames'], runSummary['failed'], runSummary['hits'], runSummary['events']))
+
+            if idleExit is not None and not inFlight and not watcher.pending() \
+                    and time.monotonic() - lastActivity >= idleExit:
+                break
+
+    except KeyboardInterrupt:
+        if verbose:
+            print("\nStopping: finishing the {} frames being processed".format(len(inFlight)))
+
+    finally:
+        watcher.close()
+        executor.shutdown(wait=True, cancel_futures=True)
+        for future in list(inFlight):
+            if future.cancelled() or future.exception() is not None:  # Not in the manifest: redone next time
+                del inFlight[future]
+            else:
+                finish(future)
+        if outputsStale or not os.path.exists(os.path.join(outDir, 'summary.json')):
+            write_outputs(manifest, runSummary)
+
+    runSummary.update({'processed': nProcessed, 'skipped': nSkipped})
+    if verbose:
+        print("{} frames processed this run, {} already in the manifest".format(nProcessed, nSkipped))
+
+    return runSummary